@@ -0,0 +1,389 @@
+"""Live aggregation of the counts of several workstations.
+
+Operators counting different slides of the same day stream their counts to
+an aggregation server, which keeps the merged totals by day and taxon:
+
+    python aggregator.py serve --host 0.0.0.0 --port 8765
+    python aggregator.py totals 2022-04-01 --host server --port 8765
+
+The protocol is made of JSON messages, one per line:
+
+    hello     {"type": "hello", "client": name}
+              answered by {"type": "welcome", "ack": last seq received}
+    update    {"type": "update", "seq": n, "day": iso date, "session": id,
+               "counts": [[famiglia, nome, total], ...]}
+              answered by {"type": "ack", "seq": n}
+    totals    {"type": "totals", "day": iso date}
+              answered by {"type": "totals", "day": ..., "clients": n,
+                           "totals": [[famiglia, nome, total], ...]}
+    subscribe {"type": "subscribe", "day": iso date}
+              answered by the totals of the day, sent again when they change
+
+Clients send the total of every changed taxon over all the slides of a
+counting session, not the single keypresses: updates are idempotent, so a
+client that reconnects simply sends its whole state again, and updates with
+a sequence number already seen from the same client are ignored. A client
+starts a new session when its counts are reset or replaced by a load, so
+the slides counted before stay in the totals. The merged total of a taxon
+is the sum of the last totals sent for every session of every client.
+"""
+
+from collections import Counter
+from typing import Dict, List, Optional, Set, Tuple
+import argparse
+import asyncio
+import json
+import logging
+import threading
+from config import (
+    _AGGREGATOR_BROADCAST_MS,
+    _AGGREGATOR_PORT,
+    _AGGREGATOR_RETRY_S,
+    _AGGREGATOR_MAX_RETRY_S,
+)
+
+
+custom_logger = logging.getLogger(name="pollen_logger")
+
+Taxon = Tuple[str, str]
+# (day, session) of the totals sent by a client
+Key = Tuple[str, str]
+# Longest message accepted, in bytes
+_LINE_LIMIT = 1 << 20
+
+
+def _encode(message: Dict) -> bytes:
+    return json.dumps(message).encode("utf-8") + b"\n"
+
+
+class AggregationServer:
+    """Merged totals of the connected workstations, by day and taxon."""
+
+    def __init__(self) -> None:
+        # Last sequence number received from every client
+        self.last_seq: Dict[str, int] = {}
+        # Day -> client -> session -> taxon -> last total sent by the client
+        self.contributions: Dict[str, Dict[str, Dict[str, Dict[Taxon, int]]]] = {}
+        # Day -> taxon -> merged total
+        self.totals: Dict[str, Counter] = {}
+        # Subscribed connections and their day
+        self.subscribers: Dict[asyncio.StreamWriter, str] = {}
+        self.connections = 0
+        self._changed: Set[str] = set()
+        self._broadcast: Optional[asyncio.Task] = None
+
+    def apply(
+        self, client: str, seq: int, day: str, counts: List, session: str = ""
+    ) -> bool:
+        """Merge an update, returning False if it was already received."""
+        if seq <= self.last_seq.get(client, 0):
+            return False
+        day = str(day)
+        session = str(session)
+        # Parsed first, so that a malformed update changes nothing
+        updates = [
+            ((str(famiglia), str(nome)), int(total)) for famiglia, nome, total in counts
+        ]
+        self.last_seq[client] = seq
+        contribution = (
+            self.contributions.setdefault(day, {})
+            .setdefault(client, {})
+            .setdefault(session, {})
+        )
+        totals = self.totals.setdefault(day, Counter())
+        for taxon, total in updates:
+            totals[taxon] += total - contribution.get(taxon, 0)
+            contribution[taxon] = total
+        self._changed.add(day)
+        return True
+
+    def day_totals(self, day: str) -> Dict:
+        return {
+            "type": "totals",
+            "day": day,
+            "clients": len(self.contributions.get(day, {})),
+            "totals": [
+                [famiglia, nome, total]
+                for (famiglia, nome), total in sorted(
+                    self.totals.get(day, Counter()).items()
+                )
+            ],
+        }
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        peer = writer.get_extra_info("peername")
+        client = None
+        self.connections += 1
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    message = json.loads(line)
+                    kind = message["type"]
+                    if kind == "hello":
+                        client = str(message["client"])
+                        custom_logger.info(f"Client {client} connected from {peer}.")
+                        reply = {"type": "welcome", "ack": self.last_seq.get(client, 0)}
+                    elif kind == "update":
+                        if client is None:
+                            raise ValueError("update before hello")
+                        seq = int(message["seq"])
+                        if self.apply(
+                            client,
+                            seq,
+                            message["day"],
+                            message["counts"],
+                            message.get("session", ""),
+                        ):
+                            self._schedule_broadcast()
+                        reply = {"type": "ack", "seq": seq}
+                    elif kind == "totals":
+                        reply = self.day_totals(message["day"])
+                    elif kind == "subscribe":
+                        self.subscribers[writer] = message["day"]
+                        reply = self.day_totals(message["day"])
+                    else:
+                        raise ValueError(f"unknown message {kind!r}")
+                except (ValueError, KeyError, TypeError) as e:
+                    reply = {"type": "error", "message": str(e)}
+                writer.write(_encode(reply))
+                await writer.drain()
+        except (ConnectionError, ValueError) as e:
+            # ValueError: line longer than the limit
+            custom_logger.warning(f"Connection with {peer} dropped: {e}")
+        finally:
+            self.connections -= 1
+            self.subscribers.pop(writer, None)
+            writer.close()
+            custom_logger.info(f"Client {client} from {peer} disconnected.")
+
+    def _schedule_broadcast(self) -> None:
+        if self.subscribers and self._broadcast is None:
+            self._broadcast = asyncio.ensure_future(self._send_totals())
+
+    async def _send_totals(self) -> None:
+        """Send the changed totals to the subscribers, at most once
+        per _AGGREGATOR_BROADCAST_MS however many updates arrive.
+        """
+        await asyncio.sleep(_AGGREGATOR_BROADCAST_MS / 1000)
+        self._broadcast = None
+        changed, self._changed = self._changed, set()
+        messages = {day: _encode(self.day_totals(day)) for day in changed}
+        for writer, day in list(self.subscribers.items()):
+            if day in messages:
+                try:
+                    writer.write(messages[day])
+                except ConnectionError:
+                    self.subscribers.pop(writer, None)
+
+    async def serve(self, host: str, port: int) -> asyncio.AbstractServer:
+        server = await asyncio.start_server(self.handle, host, port, limit=_LINE_LIMIT)
+        custom_logger.info(f"Aggregation server listening on {host}:{port}.")
+        return server
+
+
+class AggregatorClient:
+    """Stream the totals of a workstation to an aggregation server.
+    The connection runs in an asyncio loop on a background thread, so
+    send never blocks the Tk thread: totals are merged with the ones not
+    yet sent, and when the server is unreachable they wait there while the
+    client retries, with an increasing delay.
+    """
+
+    def __init__(self, host: str, port: int, client: str) -> None:
+        self.host = host
+        self.port = port
+        self.client = client
+        self.seq = 0
+        self.connected = False
+        # (day, session) -> taxon -> total, waiting to be sent
+        self.pending: Dict[Key, Dict[Taxon, int]] = {}
+        # (day, session) -> taxon -> last total sent, sent again on reconnection
+        self.sent: Dict[Key, Dict[Taxon, int]] = {}
+        self._lock = threading.Lock()
+        self._loop = asyncio.new_event_loop()
+        # Created by _run inside the loop
+        self._wakeup: Optional[asyncio.Event] = None
+        self._closing = False
+        self._thread = threading.Thread(
+            target=self._loop.run_until_complete,
+            args=(self._run(),),
+            name="aggregator",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def send(
+        self,
+        day: str,
+        counts: Dict[Taxon, int],
+        replace: bool = False,
+        session: str = "",
+    ) -> None:
+        """Queue the totals of the taxa of a day counted in a session,
+        called from any thread. With replace, counts is the whole state of
+        the session for the day: the taxa sent before and missing from
+        counts are set to zero. Other sessions are never changed.
+        """
+        key = (day, session)
+        with self._lock:
+            pending = self.pending.setdefault(key, {})
+            if replace:
+                for taxon in self.sent.get(key, {}):
+                    pending[taxon] = 0
+            pending.update(counts)
+        self._loop.call_soon_threadsafe(self._wake)
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """Send the pending totals and disconnect."""
+        self._closing = True
+        self._loop.call_soon_threadsafe(self._wake)
+        self._thread.join(timeout)
+
+    def _wake(self) -> None:
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _take(self) -> List[Dict]:
+        with self._lock:
+            pending, self.pending = self.pending, {}
+            for key, counts in pending.items():
+                self.sent.setdefault(key, {}).update(counts)
+        messages = []
+        for (day, session), counts in pending.items():
+            self.seq += 1
+            messages.append(
+                {
+                    "type": "update",
+                    "seq": self.seq,
+                    "day": day,
+                    "session": session,
+                    "counts": [[f, n, total] for (f, n), total in counts.items()],
+                }
+            )
+        return messages
+
+    async def _run(self) -> None:
+        self._wakeup = asyncio.Event()
+        delay = _AGGREGATOR_RETRY_S
+        while not self._closing:
+            try:
+                reader, writer = await asyncio.open_connection(
+                    self.host, self.port, limit=_LINE_LIMIT
+                )
+            except OSError as e:
+                custom_logger.warning(
+                    f"Aggregation server {self.host}:{self.port} unreachable: {e}"
+                )
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                # Pending totals are merged until the next attempt
+                self._wakeup.clear()
+                delay = min(delay * 2, _AGGREGATOR_MAX_RETRY_S)
+                continue
+            delay = _AGGREGATOR_RETRY_S
+            try:
+                await self._session(reader, writer)
+            except (ConnectionError, ValueError, KeyError) as e:
+                custom_logger.warning(f"Connection to the aggregation server lost: {e}")
+            finally:
+                self.connected = False
+                writer.close()
+
+    async def _session(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        writer.write(_encode({"type": "hello", "client": self.client}))
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError("closed by the server")
+        # Sequence numbers go on from the last one seen by the server,
+        # which may come from a previous run of the app
+        self.seq = max(self.seq, json.loads(line)["ack"])
+        self.connected = True
+        custom_logger.info(f"Connected to the aggregation server as {self.client}.")
+        # The whole state is sent again, in case the server restarted
+        with self._lock:
+            for key, counts in self.sent.items():
+                self.pending[key] = {**counts, **self.pending.get(key, {})}
+        receiver = asyncio.ensure_future(self._receive(reader))
+        try:
+            while True:
+                for message in self._take():
+                    writer.write(_encode(message))
+                await writer.drain()
+                if self._closing:
+                    return
+                waiter = asyncio.ensure_future(self._wakeup.wait())
+                done, _ = await asyncio.wait(
+                    {receiver, waiter}, return_when=asyncio.FIRST_COMPLETED
+                )
+                if receiver in done:
+                    waiter.cancel()
+                    receiver.result()
+                    raise ConnectionError("closed by the server")
+                self._wakeup.clear()
+        finally:
+            receiver.cancel()
+
+    async def _receive(self, reader: asyncio.StreamReader) -> None:
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            message = json.loads(line)
+            if message.get("type") == "error":
+                custom_logger.error(f"Aggregation server: {message.get('message')}")
+
+
+async def _request(host: str, port: int, message: Dict) -> Dict:
+    reader, writer = await asyncio.open_connection(host, port, limit=_LINE_LIMIT)
+    try:
+        writer.write(_encode(message))
+        return json.loads(await reader.readline())
+    finally:
+        writer.close()
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Aggregate the counts of several workstations."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    parser_serve = subparsers.add_parser("serve", help="Run the server")
+    parser_serve.add_argument("--host", default="127.0.0.1")
+    parser_serve.add_argument("--port", type=int, default=_AGGREGATOR_PORT)
+    parser_totals = subparsers.add_parser("totals", help="Print the totals of a day")
+    parser_totals.add_argument("day", help="ISO date")
+    parser_totals.add_argument("--host", default="127.0.0.1")
+    parser_totals.add_argument("--port", type=int, default=_AGGREGATOR_PORT)
+    args = parser.parse_args(argv)
+    if args.command == "serve":
+
+        async def serve() -> None:
+            server = await AggregationServer().serve(args.host, args.port)
+            async with server:
+                await server.serve_forever()
+
+        try:
+            asyncio.run(serve())
+        except KeyboardInterrupt:
+            pass
+    else:
+        reply = asyncio.run(
+            _request(args.host, args.port, {"type": "totals", "day": args.day})
+        )
+        print(f"{reply['day']}: {reply['clients']} workstations")
+        for famiglia, nome, total in reply["totals"]:
+            print(f"{famiglia};{nome};{total}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -1,9 +1,22 @@
-import pandas as pd
 import logging
-from typing import TypeVar, Dict, List
-from frames import SaveFrame, LoadFrame, PollenFrame, HelpFrame, ExtraInfoFrame
+from datetime import date
+from typing import TypeVar, Dict, List, Optional, Set, Tuple
+from frames import (
+    DaySaveFrame,
+    SaveFrame,
+    LoadFrame,
+    PollenGrid,
+    HelpFrame,
+    ExtraInfoFrame,
+)
 from tkinter import ttk, Tk
 from config import (
+    _AGGREGATOR_CLOSE_S,
+    _AGGREGATOR_INTERVAL_MS,
+    _AUTOSAVE_CLOSE_S,
+    _AUTOSAVE_FILE,
+    _AUTOSAVE_IDLE_MS,
+    _BATCH_UPDATES,
     _UNDO_KEY,
     _REDO_KEY,
     _UNDO_KEY_HELP,
@@ -11,12 +24,53 @@ from config import (
     _GOOGLE_FORM_URL,
     _HELP_TEXT,
     _GOOGLE_FORM_TEXT,
+    _JOURNAL_FILE,
+    _JOURNAL_INTERVAL_MS,
+    _LOG_DIR,
+    _CONFIG_PATH,
+    _CONFIG_POLL_MS,
+    _NEXT_PAGE_KEY,
+    _PREV_PAGE_KEY,
+    _LINE_KEYS,
+    _NEXT_SLIDE_KEY,
+    _PREV_SLIDE_KEY,
+    _SEARCH_KEY,
+    _SEARCH_KEY_HELP,
+)
+from configuration import (
+    Configuration,
+    ConfigurationError,
+    ConfigWatcher,
+    load_configuration,
 )
-from collections import deque
+from autosave import Autosave
+from engine import CountSession, OP_MOVE
+from journal import Journal, recover
+from latency import LatencyTracker
+from slide_file import iso_date
+from store import Store, StoreError
+from tasks import wait_for_tasks
+import os
+import uuid
 import webbrowser
 
 custom_logger = logging.getLogger(name="pollen_logger")
 A = TypeVar("A", bound="Application")
+# Keys pressed along with others, which must not break a key sequence
+_MODIFIER_KEYS = frozenset(
+    (
+        "Shift_L",
+        "Shift_R",
+        "Control_L",
+        "Control_R",
+        "Alt_L",
+        "Alt_R",
+        "Caps_Lock",
+        "Meta_L",
+        "Meta_R",
+        "ISO_Level3_Shift",
+    )
+)
 
 
 class Application(Tk):
@@ -29,53 +83,71 @@ class Application(Tk):
         self.title("Pollen Register")
         self.cols = cols
         self.rows = rows
-        # A list to keep all pollen frames
-        self.pollen_frames = []
-        self.data_extra = pd.DataFrame([])
-        # Stacks to implement the undo and redo functionality
-        # These stacks don't actually keep the states of the pollen counts
-        # but only references to the widget that changed
-        # This way, the PollenFrame manage the undo/redo individually
-        # whereas the app orchestrate their turns
-        self.undo_stack = deque()
-        self.redo_stack = deque()
-        # Add buttons inside a separate Frame
-        self.button_frame = ttk.Frame(self)
-        # Add footer inside a separate Frame
-        self.footer_frame = ttk.Frame(self)
+        # The headless engine holding all counts
+        # The pollen grid only observes it
+        self.session = CountSession()
+        self.session.subscribe(self._on_session_change)
+        # Indexes of the active pollens, in display order
+        self.order: List[int] = []
+        # (famiglia, nome) of the pollens shown on every page of the grid
+        self.pinned: Set[Tuple[str, str]] = set()
+        self.grid_view = PollenGrid(self, self.session, rows, cols)
+        # Pollens changed since the last refresh of the grid, in order of
+        # change, and whether the whole session changed
+        self.batch_updates = _BATCH_UPDATES
+        self._changed: Dict[int, None] = {}
+        self._changed_all = False
+        self._refresh_scheduled = False
+        # Extra info: operatore, data and linee_vetrino
+        self.data_extra: Dict[str, str] = {}
+        # Crash recovery journal, opened by start
+        self.journal: Optional[Journal] = None
+        # Background autosave of the whole day, started by start_autosave
+        self.autosave: Optional[Autosave] = None
+        # Client of the aggregation server, started by start_aggregator,
+        # with the pollens changed since the last update and its day.
+        # The counts are sent under the id of the counting session, which
+        # changes at each reset or load so previous slides stay counted
+        self.aggregator = None
+        self.session_id = uuid.uuid4().hex
+        self._aggregate: Set[int] = set()
+        self._aggregate_all = False
+        self._aggregate_day: Optional[str] = None
+        # Configuration watcher, started by watch_configuration
+        self.watcher: Optional[ConfigWatcher] = None
+        # Optional database of the saved counts, opened by start
+        self.store: Optional[Store] = None
+        # Keystroke latency histograms, written to log_dir on exit
+        self.latency = LatencyTracker()
+        self.log_dir: Optional[str] = None
+        self._build_buttons()
+        self._build_footer()
         # Undo and Redo bindings
         self.bind(f"<{_UNDO_KEY}>", self.undo)
         self.bind(f"<{_REDO_KEY}>", self.redo)
-        self.bind("<<Changed>>", lambda event: self.undo_stack.append(event.widget))
+        # Paging and search of the pollen grid
+        self.bind(f"<{_NEXT_PAGE_KEY}>", self.grid_view.next_page)
+        self.bind(f"<{_PREV_PAGE_KEY}>", self.grid_view.prev_page)
+        self.bind(f"<{_SEARCH_KEY}>", lambda e: self.grid_view.search_entry.focus_set())
+        self.grid_view.search_entry.bind("<Return>", lambda e: self.focus_set())
+        self.grid_view.search_entry.bind("<Escape>", lambda e: self.focus_set())
+        # Lines and slides
+        for line, key in enumerate(_LINE_KEYS, start=1):
+            self.bind(f"<{key}>", lambda e, line=line: self.move_to_line(line))
+        self.bind(f"<{_NEXT_SLIDE_KEY}>", lambda e: self.move_to_slide(1))
+        self.bind(f"<{_PREV_SLIDE_KEY}>", lambda e: self.move_to_slide(-1))
+        # Pollen keys are resolved by the session through its key table
+        self.bind("<Key>", self._on_key)
 
     def _grid_config(self):
-        for i in range(self.cols):
-            self.columnconfigure(i, weight=1)
-        for i in range(self.rows):
+        self.columnconfigure(0, weight=1)
+        for i in range(3):
             self.rowconfigure(i, weight=1)
         self.resizable(0, 0)
 
-    def _draw_grid(self):
-        # Place pollens in frame master
-        for i, pollen in enumerate(self.pollen_frames):
-            # Calculate the position of each pollen family
-            col = i % self.cols
-            row = i // self.cols + 1
-            pollen.grid(column=col, row=row, padx=10, pady=10, sticky="w")
-        # Recompute rows in case they changed (not enough specified in configuration)
-        self.rows = row + 2
+    def _build_buttons(self) -> None:
         # Add buttons inside a separate Frame
-        # Destroy it before to avoid duplicates due to pack
-        self.button_frame.destroy()
         self.button_frame = ttk.Frame(self)
-        self.button_frame.grid(
-            column=0,
-            row=self.rows - 1,
-            columnspan=self.cols,
-            padx=10,
-            pady=10,
-            sticky="e",
-        )
         # Buttons: Reset count, Load, Save, Quit, Help
         self.buttons = [
             ttk.Button(
@@ -102,6 +174,12 @@ class Application(Tk):
                 command=self._save,
                 style="Generic.TButton",
             ),
+            ttk.Button(
+                self.button_frame,
+                text="Salva giornata",
+                command=self._save_day,
+                style="Generic.TButton",
+            ),
             ttk.Button(
                 self.button_frame,
                 text="Chiudi",
@@ -115,13 +193,10 @@ class Application(Tk):
         for i, button in enumerate(self.buttons):
             # button.grid(column=i, row=0, padx=5, sticky="e")
             button.pack(padx=5, side="left")
+
+    def _build_footer(self) -> None:
         # Add footer inside a separate Frame
-        # Destroy it before to avoid duplicates due to pack
-        self.footer_frame.destroy()
         self.footer_frame = ttk.Frame(self)
-        self.footer_frame.grid(
-            column=0, row=self.rows, columnspan=self.cols, pady=5, padx=10
-        )
         google_form_label = ttk.Label(
             self.footer_frame,
             text=_GOOGLE_FORM_TEXT,
@@ -132,88 +207,357 @@ class Application(Tk):
         google_form_label.bind(
             "<Button-1>", lambda e: webbrowser.open_new(_GOOGLE_FORM_URL)
         )
+
+    def _draw_grid(self):
+        # Place the pollen grid, the buttons and the footer
+        self.grid_view.set_pollens(self.order, self.pinned)
+        self.grid_view.draw()
+        self.grid_view.grid(column=0, row=0, padx=10, pady=5, sticky="nsew")
+        self.button_frame.grid(column=0, row=1, padx=10, pady=10, sticky="e")
+        self.footer_frame.grid(column=0, row=2, pady=5, padx=10)
         # Grid config
         self._grid_config()
 
     def _extra_info(self) -> None:
-        id_frame = ExtraInfoFrame(self)
-        id_frame.mainloop()
+        ExtraInfoFrame(self)
 
     def _reset_count(self):
         custom_logger.info("Reset pollen count and stacks.")
-        self.undo_stack = deque()
-        self.redo_stack = deque()
-        for p in self.pollen_frames:
-            p.reset()
+        self._new_session_id()
+        self.session.reset()
 
     def _help(self) -> None:
-        help_frame = HelpFrame(self, _HELP_TEXT.format(_UNDO_KEY_HELP, _REDO_KEY_HELP))
-        help_frame.mainloop()
+        HelpFrame(
+            self, _HELP_TEXT.format(_UNDO_KEY_HELP, _REDO_KEY_HELP, _SEARCH_KEY_HELP)
+        )
 
     def _load(self) -> None:
-        id_frame = LoadFrame(self)
-        id_frame.mainloop()
+        LoadFrame(self)
 
     def _save(self) -> None:
-        id_frame = SaveFrame(self)
-        id_frame.mainloop()
+        SaveFrame(self)
+
+    def _save_day(self) -> None:
+        DaySaveFrame(self)
+
+    def move_to_line(self, line: int) -> None:
+        self.session.move_to(self.session.slide, line)
+
+    def move_to_slide(self, step: int) -> None:
+        """Move to the first line of the next (step 1) or previous (-1) slide."""
+        self.session.move_to(max(self.session.slide + step, 1), 1)
+
+    def _on_key(self, event) -> None:
+        # Keys typed in the search filter are not counted
+        if event.widget is self.grid_view.search_entry:
+            return
+        if event.keysym in _MODIFIER_KEYS:
+            return
+        latency = self.latency
+        latency.key_pressed()
+        if self.session.press(event.keysym) is None:
+            latency.key_ignored()
+        elif latency.key_handled() and not self.batch_updates:
+            self.after_idle(latency.rendered)
+
+    def _on_session_change(self, op: str, index: int, delta: int) -> None:
+        self.latency.stage("engine")
+        if not self.batch_updates:
+            if index >= 0:
+                self.grid_view.refresh(index)
+            else:
+                self.grid_view.refresh_all()
+            self.latency.stage("label")
+            return
+        # Bursts of keypresses are shown with a single refresh per idle cycle
+        if index >= 0:
+            self._changed.pop(index, None)
+            self._changed[index] = None
+        else:
+            # Indexes may not be valid anymore after a whole session change
+            self._changed.clear()
+            self._changed_all = True
+        if not self._refresh_scheduled:
+            self._refresh_scheduled = True
+            self.after_idle(self._refresh_changed)
+
+    def _refresh_changed(self) -> None:
+        self._refresh_scheduled = False
+        if self._changed_all:
+            self._changed_all = False
+            self.grid_view.refresh_all()
+        changed = list(self._changed)
+        self._changed.clear()
+        self.grid_view.refresh_many(changed)
+        if self.latency.pending:
+            self.latency.labels_updated()
+            # Queued after the redraw of the labels just updated
+            self.after_idle(self.latency.rendered)
+
+    def set_data_extra(self, data_extra: Dict[str, str]) -> None:
+        self.data_extra = data_extra
+        if self.journal is not None:
+            self.journal.record_metadata(self.extra_info())
+        if self.autosave is not None:
+            self.autosave.touch()
+        self._aggregate_all = True
+
+    def extra_info(self) -> Dict[str, str]:
+        return dict(self.data_extra)
+
+    def _open_journal(self, path: str) -> None:
+        """Replay the journal of an unfinished session, if any,
+        then start journaling the current one.
+        """
+        recovered = recover(path)
+        if recovered is not None:
+            custom_logger.info(
+                f"Recovering {len(recovered.events)} events "
+                "from an unfinished session."
+            )
+            self.clear()
+            # Counts are restored from the cells of the checkpoint
+            self.add_pollens([dict(p, conteggio=0) for p in recovered.pollens])
+            self.session.load_cells(recovered.cells, recovered.position)
+            self.session.restore_history(*recovered.history)
+            self.session.replay(recovered.events)
+            self.data_extra = dict(recovered.metadata)
+            self.session_id = recovered.session_id or self.session_id
+        self.journal = Journal(path)
+        self.session.subscribe(self.journal.on_change)
+        self._checkpoint_journal()
+        self.after(_JOURNAL_INTERVAL_MS, self._commit_journal)
+
+    def start_autosave(self, path: str) -> None:
+        self.autosave = Autosave(
+            path, lambda: (self.extra_info(), self.session.day_records())
+        )
+        self.session.subscribe(self.autosave.on_change)
+        self.after(_AUTOSAVE_IDLE_MS, self._poll_autosave)
+
+    def _poll_autosave(self) -> None:
+        if self.autosave is not None:
+            self.autosave.poll()
+            self.after(_AUTOSAVE_IDLE_MS // 4, self._poll_autosave)
+
+    def start_aggregator(self, host: str, port: int, client: str) -> None:
+        # asyncio is only loaded by the workstations using the server
+        from aggregator import AggregatorClient
+
+        self.aggregator = AggregatorClient(host, port, client)
+        self.session.subscribe(self._on_aggregated_change)
+        self._aggregate_all = True
+        self.after(_AGGREGATOR_INTERVAL_MS, self._poll_aggregator)
+
+    def _on_aggregated_change(self, op: str, index: int, delta: int) -> None:
+        if index >= 0:
+            self._aggregate.add(index)
+        elif op != OP_MOVE:
+            self._aggregate_all = True
+
+    def _new_session_id(self) -> None:
+        """Start a new counting session, sending first the last totals of
+        the current one, which the server keeps.
+        """
+        if self.aggregator is not None:
+            self._send_totals()
+        self.session_id = uuid.uuid4().hex
+
+    def _send_totals(self) -> None:
+        """Send the totals of the pollens changed since the last call."""
+        session = self.session
+        day = iso_date(self.data_extra.get("data", "")) or date.today().isoformat()
+        if day != self._aggregate_day:
+            if self._aggregate_day is not None:
+                # The counts were moved to another day
+                self.aggregator.send(
+                    self._aggregate_day, {}, replace=True, session=self.session_id
+                )
+            self._aggregate_day = day
+            self._aggregate_all = True
+        if self._aggregate_all:
+            indexes = range(len(session))
+        else:
+            indexes = self._aggregate
+        if indexes:
+            self.aggregator.send(
+                day,
+                {
+                    (session.famiglie[i], session.nomi[i]): session.taxon_total(i)
+                    for i in indexes
+                },
+                replace=self._aggregate_all,
+                session=self.session_id,
+            )
+        self._aggregate = set()
+        self._aggregate_all = False
+
+    def _poll_aggregator(self) -> None:
+        if self.aggregator is not None:
+            self._send_totals()
+            self.after(_AGGREGATOR_INTERVAL_MS, self._poll_aggregator)
+
+    def _checkpoint_journal(self) -> None:
+        if self.journal is not None:
+            self.journal.checkpoint(self.session, self.extra_info(), self.session_id)
+
+    def _commit_journal(self) -> None:
+        if self.journal is not None:
+            self.journal.commit()
+            self.after(_JOURNAL_INTERVAL_MS, self._commit_journal)
+
+    def watch_configuration(self, path: str = _CONFIG_PATH) -> None:
+        """Apply the changes to the configuration file while the app runs."""
+        self.watcher = ConfigWatcher(path)
+        self.watcher.start()
+        self.after(_CONFIG_POLL_MS, self._check_configuration)
+
+    def _check_configuration(self) -> None:
+        if self.watcher is None:
+            return
+        result = self.watcher.poll()
+        if isinstance(result, ConfigurationError):
+            custom_logger.error(f"Configuration not reloaded: {result}")
+        elif result is not None:
+            self.apply_configuration(result)
+        self.after(_CONFIG_POLL_MS, self._check_configuration)
+
+    def apply_configuration(self, config: Configuration) -> None:
+        """Apply only the differences between the configuration and the
+        current pollens: new pollens get a frame, removed ones are unbound
+        and their frame destroyed, changed keys are rebound in place.
+        Counts and undo history are preserved.
+        """
+        custom_logger.info("Apply configuration changes.")
+        session = self.session
+        wanted = {(p.famiglia, p.nome) for p in config.pollens}
+        # Removed pollens first, freeing their keys
+        for index in self.order:
+            if (session.famiglie[index], session.nomi[index]) not in wanted:
+                session.retire(index)
+        # Changed keys and labels of the existing pollens
+        keys = {}
+        new_pollens = []
+        for pollen in config.pollens:
+            index = session.taxon_table.get((pollen.famiglia, pollen.nome))
+            if index is None:
+                new_pollens.append(pollen.to_dict())
+                continue
+            if session.keys[index] != pollen.key:
+                keys[index] = pollen.key
+            session.set_use_family(index, pollen.use_family)
+        session.rebind(keys)
+        for pollen in config.pollens:
+            index = session.taxon_table.get((pollen.famiglia, pollen.nome))
+            if index is not None and not session.active[index]:
+                session.restore(index)
+        for pollen in new_pollens:
+            self._add_pollen(pollen)
+        self.order = [session.taxon_table[(p.famiglia, p.nome)] for p in config.pollens]
+        self.pinned = config.pinned
+        self.grid_view.set_layout(config.rows, config.columns)
+        self._draw_grid()
+        self._checkpoint_journal()
+        custom_logger.info("Finished applying configuration changes.")
+
+    def destroy(self) -> None:
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+        if self.log_dir is not None:
+            self.latency.dump(self.log_dir)
+        if self.store is not None:
+            # Saves still running use the store
+            wait_for_tasks()
+            self.store.close()
+            self.store = None
+        if self.aggregator is not None:
+            self._send_totals()
+            self.aggregator.close(_AGGREGATOR_CLOSE_S)
+            self.aggregator = None
+        if self.autosave is not None:
+            self.autosave.close(_AUTOSAVE_CLOSE_S)
+            self.autosave = None
+        # Closing the app is a clean end of the session
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        super().destroy()
 
     def undo(self, event) -> None:
-        try:
-            widget = self.undo_stack.pop()
-            self.redo_stack.append(widget)
-            widget.undo()
-        except IndexError as e:
-            custom_logger.info(f"{e}")
+        self.session.undo()
 
     def redo(self, event) -> None:
-        try:
-            widget = self.redo_stack.pop()
-            self.undo_stack.append(widget)
-            widget.redo()
-        except IndexError as e:
-            custom_logger.info(f"{e}")
+        self.session.redo()
 
     def clear(self):
-        self.pollen_frames = []
-        self.undo_stack = deque()
-        self.redo_stack = deque()
+        self.order = []
+        self.grid_view.clear()
+        self._new_session_id()
+        self.session.clear()
+
+    def _add_pollen(self, pollen: Dict[str, str]) -> int:
+        active = pollen.get("active", True)
+        index = self.session.add_pollen(
+            pollen["famiglia"],
+            pollen["nome"],
+            pollen["key"],
+            pollen["use_family"],
+            pollen.get("conteggio", 0),
+            active,
+        )
+        if active:
+            self.order.append(index)
+            custom_logger.info(
+                f"Added pollen {pollen['famiglia']} - {pollen['nome']} "
+                f"bound to key {self.session.keys[index]}"
+            )
+        return index
 
     def add_pollens(self, pollens: List[Dict[str, str]]) -> None:
-        """Function to generate all bindings needed for the whole app."""
+        """Function to add pollens to the session and redraw the grid."""
         custom_logger.info("Add pollens.")
         for pollen in pollens:
-            try:
-                pln = PollenFrame.generate_with_binding(
-                    self,
-                    pollen["famiglia"],
-                    pollen["nome"],
-                    pollen["key"],
-                    pollen["use_family"],
-                    pollen["conteggio"],
-                )
-            except KeyError:
-                pln = PollenFrame.generate_with_binding(
-                    self,
-                    pollen["famiglia"],
-                    pollen["nome"],
-                    pollen["key"],
-                    pollen["use_family"],
-                )
-            custom_logger.info(
-                f"Added pollen {pln.pollen.famiglia} - {pln.pollen.nome}"
-            )
-            self.pollen_frames.append(pln)
+            self._add_pollen(pollen)
         # We redraw the grid
         custom_logger.info("Finished adding pollens.")
         self._draw_grid()
+        self._checkpoint_journal()
+
+    def load_counts(
+        self, pollens: List[Dict[str, str]], cells: List[Tuple[int, int, int, int]]
+    ) -> None:
+        """Replace the session with pollens and their (slide, line,
+        index in pollens, count) cells, moving to the first slide.
+        """
+        self.clear()
+        self.add_pollens(pollens)
+        self.session.load_cells(cells, (1, 1))
+        self._checkpoint_journal()
 
     @classmethod
-    def start(cls) -> A:
-        config = LoadFrame._load_config()["general"]
-        app = Application(config["rows"], config["columns"])
+    def start(cls, pollen_dir: Optional[str] = None) -> A:
+        try:
+            config = load_configuration()
+        except ConfigurationError as e:
+            custom_logger.error(f"{e}")
+            raise e
+        app = Application(config.rows, config.columns)
+        app.pinned = config.pinned
+        if config.database is not None:
+            try:
+                app.store = Store(config.database)
+            except StoreError as e:
+                custom_logger.error(f"{e}")
         custom_logger.info("Adding all standard pollens.")
-        app.add_pollens(LoadFrame._load_config()["pollens"])
+        app.add_pollens(config.pollen_dicts())
         custom_logger.info("Finished adding standard pollens.")
+        if pollen_dir is not None:
+            app.log_dir = os.path.join(pollen_dir, _LOG_DIR)
+            app._open_journal(os.path.join(pollen_dir, _JOURNAL_FILE))
+            app.start_autosave(os.path.join(pollen_dir, _AUTOSAVE_FILE))
+        if config.aggregator is not None:
+            app.start_aggregator(*config.aggregator, config.workstation)
+        app.watch_configuration()
         custom_logger.info("Application generated.")
         return app
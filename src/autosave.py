@@ -0,0 +1,96 @@
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+from config import _AUTOSAVE_CHANGES, _AUTOSAVE_IDLE_MS
+from slide_file import write_day
+
+
+custom_logger = logging.getLogger(name="pollen_logger")
+
+# Metadata and (vetrino, linea, nome, famiglia, conteggio) rows of a day
+Snapshot = Tuple[Dict[str, str], List[Tuple[int, int, str, str, int]]]
+
+
+class Autosave:
+    """Save the whole day in the background.
+    A snapshot of the session is taken on the Tk thread after changes
+    changes, or once no change happened for idle_ms milliseconds, and
+    written by a worker thread as a day file, replaced atomically.
+    Taking a snapshot only copies the counted cells, so counting is never
+    blocked by the disk: when a write is slow (e.g. on a network share)
+    the snapshots taken meanwhile are merged and only the latest is written.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        snapshot: Callable[[], Snapshot],
+        changes: int = _AUTOSAVE_CHANGES,
+        idle_ms: int = _AUTOSAVE_IDLE_MS,
+    ) -> None:
+        self.path = path
+        self.snapshot = snapshot
+        self.changes = changes
+        self.idle = idle_ms / 1000
+        # Changes not yet in a snapshot
+        self.dirty = 0
+        self.last_change = time.monotonic()
+        self._pending: Optional[Snapshot] = None
+        self._wakeup = threading.Condition()
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, name="autosave", daemon=True)
+        self._thread.start()
+
+    def on_change(self, op: str, index: int, delta: int) -> None:
+        """Session listener counting the changes."""
+        self.touch()
+
+    def touch(self) -> None:
+        self.dirty += 1
+        self.last_change = time.monotonic()
+        if self.dirty >= self.changes:
+            self.save()
+
+    def poll(self) -> None:
+        """Save if no change happened for a while, called from the Tk loop."""
+        if self.dirty and time.monotonic() - self.last_change >= self.idle:
+            self.save()
+
+    def save(self) -> None:
+        """Take a snapshot and hand it over to the worker thread."""
+        snapshot = self.snapshot()
+        self.dirty = 0
+        with self._wakeup:
+            self._pending = snapshot
+            self._wakeup.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self._wakeup:
+                while self._pending is None and not self._stop:
+                    self._wakeup.wait()
+                if self._pending is None:
+                    return
+                metadata, rows = self._pending
+                self._pending = None
+            try:
+                write_day(self.path, metadata, rows)
+                custom_logger.debug("Autosaved %d counts to %s", len(rows), self.path)
+            except Exception:
+                # The next snapshot is tried anyway: the thread must outlive
+                # a failed write
+                custom_logger.exception(f"Unable to autosave to {self.path}")
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """Save the last changes and stop the worker, waiting at most
+        timeout seconds for the write to complete.
+        """
+        if self.dirty:
+            self.save()
+        with self._wakeup:
+            self._stop = True
+            self._wakeup.notify()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            custom_logger.warning(f"Autosave to {self.path} still in progress.")
@@ -0,0 +1,177 @@
+"""Startup benchmark.
+
+Reports, for every application module, the cumulative import time measured
+in a fresh interpreter (python -X importtime) and whether pandas was loaded,
+then the time from process start to the first idle callback of the Tk
+main loop. Each measure is the median of --repeat runs.
+
+    python src/benchmarks/startup.py --repeat 5 --output startup.json
+
+The time-to-mainloop measure needs a display: without one it runs under a
+virtual X server (xvfb-run) when available, and is skipped otherwise.
+"""
+
+from statistics import median
+from typing import Dict, List, Optional
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ROOT_DIR = os.path.dirname(SRC_DIR)
+MODULES = [
+    "config",
+    "history",
+    "engine",
+    "journal",
+    "slide_file",
+    "frames",
+    "app",
+    "ingest",
+]
+
+_MAINLOOP_SCRIPT = """
+import time
+t_start = time.perf_counter()
+import json
+from app import Application
+t_import = time.perf_counter()
+app = Application.start()
+t_built = time.perf_counter()
+
+def ready():
+    t_ready = time.perf_counter()
+    print(json.dumps({
+        "import_s": t_import - t_start,
+        "start_s": t_built - t_import,
+        "mainloop_s": t_ready - t_start,
+    }))
+    app.destroy()
+
+app.after_idle(ready)
+app.mainloop()
+"""
+
+
+def _env(home: Optional[str] = None) -> Dict[str, str]:
+    """Environment of the benchmark processes. Processes running the app
+    get home as their home directory, so they never write to the user's.
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        p for p in (SRC_DIR, env.get("PYTHONPATH")) if p
+    )
+    if home is not None:
+        env["HOME"] = home
+        env["LOCALAPPDATA"] = home
+    return env
+
+
+def _has_display() -> bool:
+    return (
+        sys.platform.startswith("win")
+        or sys.platform == "darwin"
+        or bool(os.environ.get("DISPLAY"))
+    )
+
+
+def _gui_command(command: List[str]) -> Optional[List[str]]:
+    """command, run under xvfb-run without a display,
+    None if there is no display and xvfb-run is not installed.
+    """
+    if _has_display():
+        return command
+    if shutil.which("xvfb-run") is None:
+        return None
+    return ["xvfb-run", "-a"] + command
+
+
+def import_time(module: str) -> Dict[str, float]:
+    """Cumulative import time of module in a fresh interpreter."""
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-X",
+            "importtime",
+            "-c",
+            f"import sys, {module}; print('pandas' in sys.modules)",
+        ],
+        capture_output=True,
+        text=True,
+        cwd=ROOT_DIR,
+        env=_env(),
+        check=True,
+    )
+    cumulative = None
+    for line in result.stderr.splitlines():
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].strip() == module:
+            cumulative = int(fields[1]) / 1e6
+    return {
+        "import_s": cumulative,
+        "pandas_loaded": result.stdout.strip() == "True",
+    }
+
+
+def time_to_mainloop(command: List[str]) -> Dict[str, float]:
+    t0 = time.perf_counter()
+    with tempfile.TemporaryDirectory() as home:
+        result = subprocess.run(
+            command,
+            capture_output=True,
+            text=True,
+            cwd=ROOT_DIR,
+            env=_env(home),
+            check=True,
+        )
+    measures = json.loads(result.stdout.strip().splitlines()[-1])
+    measures["process_s"] = time.perf_counter() - t0
+    return measures
+
+
+def _median(runs: List[Dict]) -> Dict:
+    return {
+        k: median(r[k] for r in runs) if isinstance(runs[0][k], float) else runs[0][k]
+        for k in runs[0]
+    }
+
+
+def run(repeat: int = 5) -> Dict:
+    report = {
+        "python": sys.version.split()[0],
+        "platform": sys.platform,
+        "repeat": repeat,
+        "modules": {
+            module: _median([import_time(module) for _ in range(repeat)])
+            for module in MODULES
+        },
+    }
+    command = _gui_command([sys.executable, "-c", _MAINLOOP_SCRIPT])
+    if command is not None:
+        report["mainloop"] = _median([time_to_mainloop(command) for _ in range(repeat)])
+    else:
+        report["mainloop"] = None
+    return report
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Measure the startup time.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", default=None, help="JSON output file")
+    args = parser.parse_args(argv)
+    report = run(args.repeat)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
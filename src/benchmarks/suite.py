@@ -0,0 +1,333 @@
+"""Benchmark suite.
+
+Measures the counting engine and the file formats without any display,
+then drives the real widgets in a separate process:
+
+    engine.press          keypresses through CountSession.press
+    engine.undo_redo      undo and redo chains on the session
+    engine.replay         journal replay of a long session
+    files.write_day       write_day of a large day file
+    files.read_day        read_day of the same file
+    gui.pollen_frame_add  keypresses through PollenFrame.add, with redraws
+    gui.undo_redo         undo and redo chains through Application.undo/redo
+    gui.save              SaveFrame._save of a slide with a large catalog
+    gui.save_day          DaySaveFrame._save of every slide and line
+    gui.load              LoadFrame._load of the day file
+    gui.start             Application.start with a large catalog
+
+The GUI benchmarks need a display: without one they run under a virtual
+X server (xvfb-run) when available, and are skipped otherwise.
+Each measure is the median of --repeat runs; the report is written as JSON
+and can be compared with a previous one to spot regressions:
+
+    python src/benchmarks/suite.py --output bench.json
+    python src/benchmarks/suite.py --compare bench.json --tolerance 0.2
+"""
+
+from statistics import median
+from typing import Callable, Dict, List, Optional
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+# The app modules live in the parent directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config import _UNDO_LIMIT  # noqa: E402
+from startup import ROOT_DIR, _env, _gui_command  # noqa: E402
+import startup  # noqa: E402
+
+
+# Size of the synthetic workload
+N_POLLENS = 500
+N_KEYS = 200_000
+N_GUI_KEYS = 20_000
+# Undo chains go back through the whole history
+N_UNDO = _UNDO_LIMIT
+N_SLIDES = 10
+N_LINES = 4
+
+
+def _measure(run: Callable[[], None], repeat: int, ops: int) -> Dict[str, float]:
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - t0)
+    result = {"median_s": median(times), "min_s": min(times), "ops": ops}
+    result["ops_per_s"] = ops / result["median_s"] if result["median_s"] else None
+    return result
+
+
+def _pollens(n: int = N_POLLENS) -> List[Dict]:
+    return [
+        {
+            "famiglia": f"Famiglia{i // 5}",
+            "nome": f"Polline{i}",
+            "key": f"k{i}",
+            "use_family": False,
+        }
+        for i in range(n)
+    ]
+
+
+def _session():
+    from engine import CountSession
+
+    session = CountSession()
+    for p in _pollens():
+        session.add_pollen(p["famiglia"], p["nome"], p["key"], p["use_family"])
+    return session
+
+
+def _keys(n: int) -> List[str]:
+    # Runs of a few equal keys, as typed when counting
+    return [f"k{(i // 3 * 7919) % N_POLLENS}" for i in range(n)]
+
+
+def bench_engine(repeat: int, workdir: str) -> Dict[str, Dict]:
+    from engine import OP_ADD, OP_UNDO, OP_REDO
+    from slide_file import read_day, write_day
+
+    results = {}
+    keys = _keys(N_KEYS)
+
+    def press():
+        session = _session()
+        press = session.press
+        for key in keys:
+            press(key)
+
+    results["engine.press"] = _measure(press, repeat, N_KEYS)
+
+    session = _session()
+    for key in keys[:N_UNDO]:
+        session.press(key)
+
+    def undo_redo():
+        for _ in range(N_UNDO):
+            session.undo()
+        for _ in range(N_UNDO):
+            session.redo()
+
+    results["engine.undo_redo"] = _measure(undo_redo, repeat, 2 * N_UNDO)
+
+    events = [(OP_ADD, i % N_POLLENS, 1) for i in range(N_KEYS)]
+    # Undo of the last 1000 keypresses, then redo of 500 of them
+    events += [
+        (OP_UNDO, i % N_POLLENS, -1) for i in range(N_KEYS - 1, N_KEYS - 1001, -1)
+    ]
+    events += [(OP_REDO, i % N_POLLENS, 1) for i in range(N_KEYS - 1000, N_KEYS - 500)]
+    results["engine.replay"] = _measure(
+        lambda: _session().replay(events), repeat, len(events)
+    )
+
+    rows = [
+        (slide, line, p["nome"], p["famiglia"], slide * line + i)
+        for slide in range(1, N_SLIDES + 1)
+        for line in range(1, N_LINES + 1)
+        for i, p in enumerate(_pollens())
+    ]
+    metadata = {"operatore": "Benchmark", "data": "01/04/2022", "linee_vetrino": "4"}
+    path = os.path.join(workdir, "day.csv")
+    results["files.write_day"] = _measure(
+        lambda: write_day(path, metadata, rows), repeat, len(rows)
+    )
+    results["files.read_day"] = _measure(lambda: read_day(path), repeat, len(rows))
+    return results
+
+
+def gui_worker(repeat: int) -> Dict[str, Dict]:
+    """GUI benchmarks, run inside the process with the display."""
+    from app import Application
+    from frames import DaySaveFrame, LoadFrame, SaveFrame
+
+    results = {}
+    starts = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        app = Application.start()
+        app.update()
+        starts.append(time.perf_counter() - t0)
+        app.destroy()
+    results["gui.start"] = {
+        "median_s": median(starts),
+        "min_s": min(starts),
+        "ops": 1,
+        "ops_per_s": 1 / median(starts),
+    }
+
+    app = Application.start()
+    app.update()
+    frames = list(app.grid_view.visible.values())
+
+    def frame_add():
+        for i in range(N_GUI_KEYS):
+            frames[i // 3 % len(frames)].add()
+            if i % 100 == 99:
+                app.update()
+        app.update()
+
+    results["gui.pollen_frame_add"] = _measure(frame_add, repeat, N_GUI_KEYS)
+
+    def undo_redo():
+        for i in range(N_UNDO):
+            app.undo(None)
+            if i % 100 == 99:
+                app.update()
+        for i in range(N_UNDO):
+            app.redo(None)
+            if i % 100 == 99:
+                app.update()
+        app.update()
+
+    results["gui.undo_redo"] = _measure(undo_redo, repeat, 2 * N_UNDO)
+
+    # Counts on every pollen and line for the save and load
+    session = app.session
+    for slide in range(1, N_SLIDES + 1):
+        for line in range(1, N_LINES + 1):
+            session.move_to(slide, line)
+            for index in range(len(session)):
+                session.add(index)
+    session.move_to(1, 1)
+    app.update()
+
+    def wait(frame):
+        # Saves and loads complete in the background
+        while frame.winfo_exists():
+            app.update()
+            time.sleep(0.001)
+
+    def save():
+        frame = SaveFrame(app)
+        frame.entry.insert(0, "bench_slide")
+        frame._save()
+        wait(frame)
+
+    results["gui.save"] = _measure(save, repeat, len(session))
+    n_cells = len(session) * N_SLIDES * N_LINES
+
+    def save_day():
+        frame = DaySaveFrame(app)
+        frame.entry.insert(0, "bench_day")
+        frame._save()
+        wait(frame)
+
+    results["gui.save_day"] = _measure(save_day, repeat, n_cells)
+
+    def load():
+        frame = LoadFrame(app)
+        frame.entry.insert(0, "bench_day.csv")
+        frame._load()
+        wait(frame)
+
+    results["gui.load"] = _measure(load, repeat, n_cells)
+    app.destroy()
+    return results
+
+
+def bench_gui(repeat: int, workdir: str) -> Dict:
+    command = _gui_command(
+        [sys.executable, os.path.abspath(__file__), "--gui-worker"]
+        + ["--repeat", str(repeat)]
+    )
+    if command is None:
+        return {"skipped": "no display and xvfb-run not found"}
+    # Synthetic configuration with a large catalog, read from the cwd
+    with open(os.path.join(workdir, "configuration.json"), "w") as f:
+        json.dump({"general": {"rows": 6, "columns": 5}, "pollens": _pollens()}, f)
+    result = subprocess.run(
+        command, capture_output=True, text=True, cwd=workdir, env=_env(workdir)
+    )
+    if result.returncode != 0:
+        return {"failed": result.stderr.strip().splitlines()[-1:]}
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def _revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            capture_output=True,
+            text=True,
+            cwd=ROOT_DIR,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(repeat: int = 5, gui: bool = True) -> Dict:
+    with tempfile.TemporaryDirectory() as workdir:
+        results = bench_engine(repeat, workdir)
+        report = {
+            "python": sys.version.split()[0],
+            "platform": sys.platform,
+            "revision": _revision(),
+            "repeat": repeat,
+            "sizes": {
+                "pollens": N_POLLENS,
+                "keys": N_KEYS,
+                "gui_keys": N_GUI_KEYS,
+                "undo": N_UNDO,
+                "slides": N_SLIDES,
+                "lines": N_LINES,
+            },
+            "results": results,
+        }
+        if gui:
+            gui_results = bench_gui(repeat, workdir)
+            if "skipped" in gui_results or "failed" in gui_results:
+                report["gui"] = gui_results
+            else:
+                results.update(gui_results)
+    report["startup"] = startup.run(repeat)
+    return report
+
+
+def compare(report: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Benchmarks slower than the baseline by more than tolerance."""
+    regressions = []
+    for name, result in report["results"].items():
+        old = baseline.get("results", {}).get(name)
+        if not old or not old.get("median_s") or not result.get("median_s"):
+            continue
+        ratio = result["median_s"] / old["median_s"]
+        if ratio > 1 + tolerance:
+            regressions.append(f"{name}: {ratio:.2f}x slower than the baseline")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Run the benchmark suite.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", default=None, help="JSON output file")
+    parser.add_argument("--no-gui", action="store_true", help="Skip the GUI")
+    parser.add_argument("--compare", default=None, help="Baseline JSON report")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--gui-worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.gui_worker:
+        print(json.dumps(gui_worker(args.repeat)))
+        return 0
+    report = run(args.repeat, not args.no_gui)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    print(text)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(regression, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
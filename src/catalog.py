@@ -0,0 +1,202 @@
+"""Taxonomic catalog of the configured pollens.
+
+The (famiglia, nome) pairs read from slide and day files are matched to
+the pollens of configuration.json by, in order:
+
+    exact       the same famiglia and nome
+    normalized  the same names, ignoring case, accents, spaces and punctuation
+    alias       nome is one of the "aliases" of a configured pollen
+    fuzzy       a famiglia differing from a single configured family by at
+                most one edit every four characters, ignoring case and
+                accents, and within that family the same nome, the family
+                itself for family level taxa (nome equal to famiglia), or a
+                nome differing from that of a single pollen by at most one
+                edit every eight characters; at most _CATALOG_MAX_EDITS edits
+                for each name
+
+Every distinct pair is resolved once and cached, so matching the rows of a
+bulk import costs a dictionary lookup per row. Rows matched by any rule but
+the first are remapped to the configured names; the others, including names
+as close to two families or pollens, are rejected. MatchReport collects both, to tell
+the user what happened to every row.
+"""
+
+from collections import Counter
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+import re
+import unicodedata
+from config import _CATALOG_MAX_EDITS
+
+
+EXACT = "exact"
+NORMALIZED = "normalized"
+ALIAS = "alias"
+FUZZY = "fuzzy"
+
+Taxon = Tuple[str, str]
+_SEPARATORS = re.compile(r"[\W_]+")
+
+
+def normalize_name(text: str) -> str:
+    """Name without case, accents, punctuation and repeated spaces."""
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return _SEPARATORS.sub(" ", text.casefold()).strip()
+
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    """Levenshtein distance of a and b, or limit + 1 when it exceeds limit."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, start=1):
+        current = [i]
+        for j, cb in enumerate(b, start=1):
+            current.append(
+                min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb))
+            )
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return min(previous[-1], limit + 1)
+
+
+class Match(NamedTuple):
+    # Index of the pollen in the catalog, as in configuration.json
+    index: int
+    famiglia: str
+    nome: str
+    kind: str
+
+
+class Catalog:
+    """Index of the configured taxa by exact, normalized and alias names."""
+
+    def __init__(
+        self,
+        taxa: Iterable[Taxon],
+        aliases: Optional[Dict[int, Iterable[str]]] = None,
+        max_edits: int = _CATALOG_MAX_EDITS,
+    ) -> None:
+        self.taxa: List[Taxon] = list(taxa)
+        self.max_edits = max_edits
+        self.exact: Dict[Taxon, int] = {}
+        self.normalized: Dict[Taxon, int] = {}
+        self.aliases: Dict[str, int] = {}
+        # Normalized famiglia -> normalized nome -> index, for the fuzzy matches
+        self.families: Dict[str, Dict[str, int]] = {}
+        for index, (famiglia, nome) in enumerate(self.taxa):
+            self.exact.setdefault((famiglia, nome), index)
+            key = (normalize_name(famiglia), normalize_name(nome))
+            self.normalized.setdefault(key, index)
+            self.families.setdefault(key[0], {}).setdefault(key[1], index)
+        for index, names in (aliases or {}).items():
+            for name in names:
+                self.aliases.setdefault(normalize_name(name), index)
+        self._cache: Dict[Taxon, Optional[Match]] = {}
+
+    def __contains__(self, taxon: Taxon) -> bool:
+        return self.resolve(*taxon) is not None
+
+    def _match(self, index: int, kind: str) -> Match:
+        famiglia, nome = self.taxa[index]
+        return Match(index, famiglia, nome, kind)
+
+    def resolve(self, famiglia: str, nome: str) -> Optional[Match]:
+        """Configured taxon matching famiglia and nome, None if none does."""
+        taxon = (famiglia, nome)
+        try:
+            return self._cache[taxon]
+        except KeyError:
+            pass
+        match = self._find(famiglia, nome)
+        self._cache[taxon] = match
+        return match
+
+    def _find(self, famiglia: str, nome: str) -> Optional[Match]:
+        index = self.exact.get((famiglia, nome))
+        if index is not None:
+            return self._match(index, EXACT)
+        key = (normalize_name(famiglia), normalize_name(nome))
+        index = self.normalized.get(key)
+        if index is not None:
+            return self._match(index, NORMALIZED)
+        index = self.aliases.get(key[1])
+        if index is not None:
+            return self._match(index, ALIAS)
+        famiglia_key, family = self._family(key[0])
+        if family is None:
+            return None
+        index = family.get(key[1])
+        if index is None and key[1] == key[0]:
+            # Family level taxon, under a misspelled family name
+            index = family.get(famiglia_key)
+        if index is not None:
+            return self._match(index, FUZZY)
+        # Misspelled names are only looked for in the same family, so that
+        # genera and species are never folded into another taxon
+        limit = min(self.max_edits, len(key[1]) // 8)
+        candidates = [
+            index
+            for name, index in family.items()
+            if edit_distance(key[1], name, limit) <= limit
+        ]
+        if len(candidates) != 1:
+            return None
+        return self._match(candidates[0], FUZZY)
+
+    def _family(self, famiglia: str) -> Tuple[str, Optional[Dict[str, int]]]:
+        """Normalized name and pollens of the configured family matching the
+        normalized famiglia, exactly or as the only one close enough.
+        """
+        family = self.families.get(famiglia)
+        if family is not None:
+            return famiglia, family
+        limit = min(self.max_edits, len(famiglia) // 4)
+        candidates = [
+            name
+            for name in self.families
+            if edit_distance(famiglia, name, limit) <= limit
+        ]
+        if len(candidates) != 1:
+            return famiglia, None
+        return candidates[0], self.families[candidates[0]]
+
+
+class MatchReport:
+    """Rows remapped to a configured taxon under another name,
+    and rows rejected, by (famiglia, nome) found in the files.
+    """
+
+    def __init__(self) -> None:
+        self.remapped: Dict[Taxon, Match] = {}
+        self.remapped_rows: Counter = Counter()
+        self.rejected: Counter = Counter()
+
+    def add(self, famiglia: str, nome: str, match: Optional[Match], rows: int = 1):
+        taxon = (famiglia, nome)
+        if match is None:
+            self.rejected[taxon] += rows
+        elif match.kind != EXACT:
+            self.remapped[taxon] = match
+            self.remapped_rows[taxon] += rows
+
+    def update(self, other: "MatchReport") -> None:
+        self.remapped.update(other.remapped)
+        self.remapped_rows.update(other.remapped_rows)
+        self.rejected.update(other.rejected)
+
+    def __bool__(self) -> bool:
+        return bool(self.remapped or self.rejected)
+
+    def lines(self) -> List[str]:
+        lines = [
+            f"remapped {famiglia} - {nome} to {match.famiglia} - {match.nome} "
+            f"({match.kind}, {self.remapped_rows[(famiglia, nome)]} rows)"
+            for (famiglia, nome), match in sorted(self.remapped.items())
+        ]
+        lines.extend(
+            f"{famiglia} - {nome} not in configuration ({rows} rows)"
+            for (famiglia, nome), rows in sorted(self.rejected.items())
+        )
+        return lines
@@ -0,0 +1,284 @@
+"""Command line mode, running without any display.
+
+    python main.py report <slides directory> --period week --output report.csv
+    python main.py merge <file> <file> ... --output day.csv
+    python main.py validate <file or directory> ...
+    python main.py convert day.csv day.snap
+    python main.py ingest <slides directory> <dataset directory>
+
+Slide and day files are read with the same code used by the app, and
+checked against the same configuration.json. Files are parsed in a pool of
+processes; the outputs are sorted, so they do not depend on the order in
+which the workers finish.
+"""
+
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from typing import Dict, List, Optional, Tuple
+import argparse
+import csv
+import logging
+import multiprocessing
+import os
+import sys
+from catalog import Catalog
+from config import _CONFIG_PATH
+from configuration import ConfigurationError, load_configuration
+from ingest import add_arguments as add_ingest_arguments, run as run_ingest
+from slide_file import SlideFileError, iso_date, read_day, write_day
+from snapshot import EXTENSION, SnapshotError, to_csv, to_snapshot
+
+
+custom_logger = logging.getLogger(name="pollen_logger")
+
+PERIODS = ("day", "week", "month", "season")
+# Files handed to a worker process at once
+_CHUNK_SIZE = 16
+
+
+def _period(day: str, period: str) -> str:
+    """Label of the period of an ISO date."""
+    if period == "day":
+        return day
+    if period == "week":
+        year, week, _ = date.fromisoformat(day).isocalendar()
+        return f"{year}-W{week:02d}"
+    if period == "month":
+        return day[:7]
+    return day[:4]
+
+
+def _find_files(paths: List[str]) -> List[str]:
+    """CSV files in paths, looking inside directories, sorted."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(
+                    os.path.join(root, name)
+                    for name in names
+                    if name.lower().endswith(".csv")
+                )
+        else:
+            files.append(path)
+    return sorted(files)
+
+
+def period_totals(
+    path: str, period: str
+) -> Tuple[str, Optional[Dict[Tuple[str, str, str], int]], Optional[str]]:
+    """Totals of a file by (period, famiglia, nome).
+    Runs inside the worker processes: returns the path, the totals
+    and an error message, if the file could not be used.
+    """
+    try:
+        day = read_day(path)
+    except (OSError, SlideFileError) as e:
+        return path, None, str(e)
+    data = iso_date(day.metadata.get("data", ""))
+    if data is None:
+        return path, None, f"{path}: missing or invalid date"
+    label = _period(data, period)
+    totals = Counter()
+    for _, _, nome, famiglia, conteggio in day.counts:
+        totals[(label, famiglia.strip(), nome.strip())] += conteggio
+    return path, dict(totals), None
+
+
+def report(
+    paths: List[str],
+    output: str,
+    period: str = "day",
+    config_path: str = _CONFIG_PATH,
+    workers: Optional[int] = None,
+) -> List[str]:
+    """Write the totals by period and taxon of the files in paths.
+    Taxa are matched to the configuration by name, alias or similar name;
+    taxa missing from it are kept and flagged.
+    Returns the errors of the files that were skipped.
+    """
+    catalog = load_configuration(config_path).catalog
+    files = _find_files(paths)
+    totals = Counter()
+    errors = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for _, file_totals, error in executor.map(
+            period_totals, files, [period] * len(files), chunksize=_CHUNK_SIZE
+        ):
+            if error is not None:
+                errors.append(error)
+            else:
+                totals.update(file_totals)
+    # Remapping in the parent process resolves every distinct taxon only once
+    configured = set()
+    canonical = Counter()
+    for (label, famiglia, nome), conteggio in totals.items():
+        match = catalog.resolve(famiglia, nome)
+        if match is not None:
+            famiglia, nome = match.famiglia, match.nome
+            configured.add((famiglia, nome))
+        canonical[(label, famiglia, nome)] += conteggio
+    with open(output, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f, delimiter=";", lineterminator="\n")
+        writer.writerow(("periodo", "famiglia", "nome", "conteggio", "configurato"))
+        writer.writerows(
+            (label, famiglia, nome, conteggio, int((famiglia, nome) in configured))
+            for (label, famiglia, nome), conteggio in sorted(canonical.items())
+        )
+    custom_logger.info(f"Written report of {len(files)} files to {output}.")
+    return errors
+
+
+def merge(paths: List[str], output: str) -> List[str]:
+    """Merge slide and day files into a single day file, numbering their
+    slides one after the other in the order of paths. The metadata of the
+    first file is kept; returns warnings for files with another date.
+    """
+    metadata = None
+    counts = []
+    warnings = []
+    offset = 0
+    for path in paths:
+        day = read_day(path)
+        if metadata is None:
+            metadata = dict(day.metadata)
+        elif day.metadata.get("data", "") != metadata.get("data", ""):
+            warnings.append(
+                f"{path}: date {day.metadata.get('data', '')!r} differs "
+                f"from {metadata.get('data', '')!r}"
+            )
+        slides = sorted({vetrino for vetrino, _, _, _, _ in day.counts})
+        numbers = {vetrino: offset + i for i, vetrino in enumerate(slides, start=1)}
+        counts.extend(
+            (numbers[vetrino], linea, nome, famiglia, conteggio)
+            for vetrino, linea, nome, famiglia, conteggio in day.counts
+        )
+        offset += len(slides)
+    write_day(output, metadata or {}, counts)
+    return warnings
+
+
+def validate_file(path: str, catalog: Catalog) -> List[str]:
+    """Problems found in a slide or day file. Runs inside the worker processes."""
+    try:
+        day = read_day(path)
+    except (OSError, SlideFileError) as e:
+        return [f"error: {e}"]
+    problems = []
+    if iso_date(day.metadata.get("data", "")) is None:
+        problems.append(f"warning: {path}: missing or invalid date")
+    for famiglia, nome in sorted({(f, n) for _, _, n, f, _ in day.counts}):
+        match = catalog.resolve(famiglia, nome)
+        if match is None:
+            problems.append(
+                f"warning: {path}: {famiglia} - {nome} not in configuration"
+            )
+        elif (match.famiglia, match.nome) != (famiglia, nome):
+            problems.append(
+                f"warning: {path}: {famiglia} - {nome} read as "
+                f"{match.famiglia} - {match.nome} ({match.kind} match)"
+            )
+    for vetrino, linea, nome, famiglia, conteggio in day.counts:
+        if conteggio < 0:
+            problems.append(
+                f"error: {path}: negative count of {famiglia} - {nome} "
+                f"on slide {vetrino}, line {linea}"
+            )
+    return problems
+
+
+def validate(
+    paths: List[str], config_path: str = _CONFIG_PATH, workers: Optional[int] = None
+) -> List[str]:
+    """Validate the configuration and the files in paths, returning the
+    problems found, in file order.
+    """
+    catalog = load_configuration(config_path).catalog
+    files = _find_files(paths)
+    problems = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for file_problems in executor.map(
+            validate_file, files, [catalog] * len(files), chunksize=_CHUNK_SIZE
+        ):
+            problems.extend(file_problems)
+    return problems
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="pollen", description="Pollen Register command line tools."
+    )
+    parser.add_argument("--config", default=_CONFIG_PATH, help="Configuration file")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    parser_report = subparsers.add_parser(
+        "report", help="Totals by period and taxon of a set of files"
+    )
+    parser_report.add_argument("paths", nargs="+", help="Files or directories")
+    parser_report.add_argument("--period", choices=PERIODS, default="day")
+    parser_report.add_argument("--output", default="report.csv")
+    parser_report.add_argument("--workers", type=int, default=None)
+    parser_merge = subparsers.add_parser("merge", help="Merge files in a day file")
+    parser_merge.add_argument("paths", nargs="+", help="Slide or day files")
+    parser_merge.add_argument("--output", required=True)
+    parser_validate = subparsers.add_parser(
+        "validate", help="Check the configuration and a set of files"
+    )
+    parser_validate.add_argument("paths", nargs="*", help="Files or directories")
+    parser_validate.add_argument("--workers", type=int, default=None)
+    parser_convert = subparsers.add_parser(
+        "convert", help=f"Convert between day files and {EXTENSION} snapshots"
+    )
+    parser_convert.add_argument("source", help=f"Day file or {EXTENSION} snapshot")
+    parser_convert.add_argument("target")
+    parser_ingest = subparsers.add_parser(
+        "ingest", help="Ingest files into a Parquet dataset"
+    )
+    add_ingest_arguments(parser_ingest)
+    # Also accepted after the ingest arguments, as by ingest.py
+    parser_ingest.add_argument(
+        "--config", default=argparse.SUPPRESS, help="Configuration file"
+    )
+    args = parser.parse_args(argv)
+    try:
+        if args.command == "report":
+            errors = report(
+                args.paths, args.output, args.period, args.config, args.workers
+            )
+            for error in errors:
+                print(f"Skipped {error}", file=sys.stderr)
+            print(f"Written {args.output}.")
+        elif args.command == "convert":
+            if args.source.lower().endswith(EXTENSION):
+                n = to_csv(args.source, args.target)
+            else:
+                n = to_snapshot(args.source, args.target)
+            print(f"Converted {n} rows to {args.target}.")
+        elif args.command == "ingest":
+            return run_ingest(args)
+        elif args.command == "merge":
+            for warning in merge(args.paths, args.output):
+                print(f"warning: {warning}", file=sys.stderr)
+            print(f"Written {args.output}.")
+        else:
+            problems = validate(args.paths, args.config, args.workers)
+            for problem in problems:
+                print(problem)
+            if any(problem.startswith("error") for problem in problems):
+                return 1
+    except (
+        ConfigurationError,
+        SlideFileError,
+        SnapshotError,
+        OSError,
+        ImportError,
+    ) as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(main())
@@ -0,0 +1,187 @@
+"""Daily pollen concentrations (grains/m³) from the stored counts.
+
+A volumetric sampler draws flusso_l_min litres of air per minute over a
+tape, so a day of sampling is a trace larghezza_traccia_mm wide holding
+the pollen of flusso_l_min * 1440 / 1000 m³ of air. Reading n lines of the
+trace with a field of view of diameter d = numero_di_campo_mm / ingrandimento
+covers n * d / larghezza_traccia_mm of the trace, hence:
+
+    concentration = conteggio * larghezza_traccia_mm / (n * d * volume_m3)
+
+The parameters come from the "campionatore" section of configuration.json.
+The number of lines of a slide is read from its linee_vetrino metadata
+(e.g. "1,2,3,4" or "1-4"), falling back to campionatore.linee. When several
+slides share a date their counts and lines are pooled.
+
+Counts are gathered into (days x taxa) arrays, so the conversion runs on
+a whole period and all the configured taxa at once:
+
+    python concentration.py counts.db --from 2022-01-01 --to 2022-12-31 \\
+        --output concentrazioni.csv
+"""
+
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+import argparse
+import csv
+import logging
+import re
+from catalog import Catalog
+from config import _CONFIG_PATH
+from configuration import SamplerConfig, load_configuration
+from store import Store
+
+try:
+    import numpy as np
+except ImportError as e:
+    raise ImportError("The concentration engine needs numpy: pip install numpy") from e
+
+
+custom_logger = logging.getLogger(name="pollen_logger")
+
+_LINE_SEPARATORS = re.compile(r"[\s,;]+")
+
+
+def count_lines(text: str) -> Optional[int]:
+    """Number of lines listed in the linee_vetrino metadata,
+    None if the text is empty or is not a list of lines.
+    """
+    lines = set()
+    for token in _LINE_SEPARATORS.split(text.strip()):
+        if not token:
+            continue
+        start, sep, end = token.partition("-")
+        try:
+            if sep:
+                lines.update(range(int(start), int(end) + 1))
+            else:
+                lines.add(int(token))
+        except ValueError:
+            return None
+    return len(lines) or None
+
+
+def concentration_factor(lines, sampler: SamplerConfig) -> "np.ndarray":
+    """Grains/m³ corresponding to a single grain counted on lines lines."""
+    lines = np.asarray(lines, dtype=np.float64)
+    return sampler.larghezza_traccia_mm / (
+        lines * sampler.diametro_campo_mm * sampler.volume_giornaliero_m3
+    )
+
+
+def concentrations(counts, lines, sampler: SamplerConfig) -> "np.ndarray":
+    """Convert a (slides x taxa) array of counts, with the number of lines
+    read on each slide, to concentrations in grains/m³.
+    """
+    return (
+        np.asarray(counts, dtype=np.float64)
+        * concentration_factor(lines, sampler)[:, None]
+    )
+
+
+class DailyConcentrations(NamedTuple):
+    # ISO dates, sorted
+    dates: "np.ndarray"
+    # (famiglia, nome) of the columns
+    taxa: List[Tuple[str, str]]
+    # (days x taxa) counts and number of lines read in each day
+    counts: "np.ndarray"
+    lines: "np.ndarray"
+    # (days x taxa) concentrations in grains/m³
+    values: "np.ndarray"
+
+
+def daily_concentrations(
+    rows: Iterable[Tuple[str, str, int, str, str, str, int]],
+    catalog: Catalog,
+    sampler: SamplerConfig,
+) -> DailyConcentrations:
+    """Compute the daily concentrations of the taxa of catalog from
+    (data, name, vetrino, linee_vetrino, famiglia, nome, conteggio) rows,
+    as returned by Store.slide_counts. Names are matched in the catalog as
+    when loading files; taxa not found are ignored.
+    """
+    taxa = catalog.taxa
+    slide_index = {}
+    slide_dates = []
+    slide_lines = []
+    row_slides = []
+    row_taxa = []
+    row_counts = []
+    ignored = 0
+    for data, name, vetrino, linee_vetrino, famiglia, nome, conteggio in rows:
+        slide = slide_index.get((name, vetrino))
+        if slide is None:
+            slide = slide_index[(name, vetrino)] = len(slide_dates)
+            slide_dates.append(data)
+            slide_lines.append(count_lines(linee_vetrino) or sampler.linee)
+        match = catalog.resolve(famiglia, nome)
+        if match is None:
+            ignored += 1
+            continue
+        row_slides.append(slide)
+        row_taxa.append(match.index)
+        row_counts.append(conteggio)
+    if ignored:
+        custom_logger.info(f"Ignored {ignored} counts of taxa not configured.")
+    n_taxa = len(taxa)
+    dates, slide_days = np.unique(np.array(slide_dates, dtype=str), return_inverse=True)
+    n_days = len(dates)
+    lines = np.bincount(slide_days, weights=slide_lines, minlength=n_days)
+    cells = slide_days[np.array(row_slides, dtype=np.intp)] * n_taxa + np.array(
+        row_taxa, dtype=np.intp
+    )
+    counts = (
+        np.bincount(cells, weights=row_counts, minlength=n_days * n_taxa)
+        .reshape(n_days, n_taxa)
+        .astype(np.int64)
+    )
+    return DailyConcentrations(
+        dates, taxa, counts, lines, concentrations(counts, lines, sampler)
+    )
+
+
+def write_concentrations(path: str, result: DailyConcentrations) -> None:
+    """Write data;famiglia;nome;conteggio;linee;concentrazione rows."""
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f, delimiter=";", lineterminator="\n")
+        writer.writerow(
+            ("data", "famiglia", "nome", "conteggio", "linee", "concentrazione")
+        )
+        for day, date in enumerate(result.dates):
+            lines = int(result.lines[day])
+            writer.writerows(
+                (date, famiglia, nome, count, lines, f"{value:.2f}")
+                for (famiglia, nome), count, value in zip(
+                    result.taxa,
+                    result.counts[day].tolist(),
+                    result.values[day].tolist(),
+                )
+            )
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Compute the daily pollen concentrations from the database."
+    )
+    parser.add_argument("database", help="Database file")
+    parser.add_argument("--from", dest="date_from", default=None)
+    parser.add_argument("--to", dest="date_to", default=None)
+    parser.add_argument("--config", default=_CONFIG_PATH, help="Configuration file")
+    parser.add_argument(
+        "--output", default="concentrazioni.csv", help="Output CSV file"
+    )
+    args = parser.parse_args(argv)
+    configuration = load_configuration(args.config)
+    store = Store(args.database)
+    try:
+        rows = store.slide_counts(args.date_from, args.date_to)
+    finally:
+        store.close()
+    result = daily_concentrations(rows, configuration.catalog, configuration.sampler)
+    write_concentrations(args.output, result)
+    print(f"Written the concentrations of {len(result.dates)} days to {args.output}.")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -1,3 +1,14 @@
+_CONFIG_PATH = "./configuration.json"
+# Logging: one file in the logs directory, rotated and compressed when
+# larger than _LOG_MAX_BYTES or older than _LOG_ROTATE_S seconds
+_LOG_DIR = "logs"
+_LOG_FILE = "pollen.log"
+_LOG_LEVEL = "INFO"
+_LOG_MAX_BYTES = 5 * 1024 * 1024
+_LOG_ROTATE_S = 7 * 24 * 3600
+_LOG_BACKUP_COUNT = 10
+# Interval between two checks for changes to the configuration file
+_CONFIG_POLL_MS = 1000
 # _WIDTH = 1280
 # _HEIGHT = 350
 _TLW_HEIGHT = 40
@@ -8,10 +19,65 @@ _UNDO_KEY_HELP = "Ctrl+z"
 # Ctrl+Shift+z
 _REDO_KEY = "Control-Key-Z"
 _REDO_KEY_HELP = "Ctrl+Shift+z"
+# Ctrl+f
+_SEARCH_KEY = "Control-Key-f"
+_SEARCH_KEY_HELP = "Ctrl+f"
+# Page down/up
+_NEXT_PAGE_KEY = "Next"
+_PREV_PAGE_KEY = "Prior"
+# F1-F8 select the line of the slide being counted
+_LINE_KEYS = ("F1", "F2", "F3", "F4", "F5", "F6", "F7", "F8")
+# F11/F12 move to the previous/next slide
+_PREV_SLIDE_KEY = "F11"
+_NEXT_SLIDE_KEY = "F12"
+# Keys bound to the commands above, which can not be part of the key
+# sequence of a pollen: the command would take the keystroke
+_COMMAND_KEYS = frozenset(
+    (_NEXT_PAGE_KEY, _PREV_PAGE_KEY, *_LINE_KEYS, _PREV_SLIDE_KEY, _NEXT_SLIDE_KEY)
+)
+# Refresh the pollen labels once per idle cycle instead of on every
+# keypress: counts are always updated right away
+_BATCH_UPDATES = True
+# Pollens can be bound to sequences of keys separated by spaces ("b e"):
+# a sequence not completed within this time is dropped
+_KEY_SEQUENCE_TIMEOUT_MS = 1500
+# Names read from files that match no configured pollen exactly, by
+# normalized name or by alias are remapped to the only configured family
+# differing by one edit every 4 characters, and within it to the only pollen
+# whose nome differs by one edit every 8 characters, at most by this
+_CATALOG_MAX_EDITS = 2
+# Maximum number of runs of equal keypresses kept for undo/redo
+_UNDO_LIMIT = 10000
+# Crash recovery journal, written in the Pollen app data directory
+_JOURNAL_FILE = "journal.log"
+# Events are fsynced in groups by a writer thread: every _JOURNAL_BATCH
+# events or after _JOURNAL_INTERVAL_MS milliseconds, whichever comes first
+_JOURNAL_BATCH = 32
+_JOURNAL_INTERVAL_MS = 500
+# The whole day is autosaved in the app data directory every
+# _AUTOSAVE_CHANGES changes, or after _AUTOSAVE_IDLE_MS milliseconds
+# without changes
+_AUTOSAVE_FILE = "autosave.csv"
+_AUTOSAVE_CHANGES = 200
+_AUTOSAVE_IDLE_MS = 3000
+# Maximum time to wait for the last autosave when closing the app
+_AUTOSAVE_CLOSE_S = 5
+# Polling period of the saves and loads running in the background
+_TASK_POLL_MS = 50
+# Aggregation server of the counts of several workstations: totals are
+# sent every _AGGREGATOR_INTERVAL_MS, and the connection is retried after
+# _AGGREGATOR_RETRY_S seconds, doubling up to _AGGREGATOR_MAX_RETRY_S
+_AGGREGATOR_PORT = 8765
+_AGGREGATOR_INTERVAL_MS = 1000
+_AGGREGATOR_RETRY_S = 1
+_AGGREGATOR_MAX_RETRY_S = 30
+_AGGREGATOR_CLOSE_S = 2
+# Subscribers get the merged totals at most once every
+_AGGREGATOR_BROADCAST_MS = 500
 _FONT = "Arial"
 _FONT_SIZE_MAIN = 10
 _FONT_SIZE_HELP = 11
 _FONT_SIZE_FOOTER = 8
 _GOOGLE_FORM_URL = "https://docs.google.com/forms/d/e/1FAIpQLScb56x4qFFO4iFOs8HHm59en611sn1XH-lrR9j5EbjgMj1T9w/viewform"
-_HELP_TEXT = "Ogni tasto è associato ad un polline, come mostrato nella finestra principale.\nPer modificare i tasti ed aggiungere/togliere pollini, modificare il file configuration.json.\n\nAltre chiavi:\n- Undo: {}\n- Redo: {}"
+_HELP_TEXT = "Ogni tasto è associato ad un polline, come mostrato nella finestra principale.\nPer modificare i tasti ed aggiungere/togliere pollini, modificare il file configuration.json.\n\nAltre chiavi:\n- Undo: {}\n- Redo: {}\n- Cerca un polline: {}\n- Pagina successiva/precedente: PagGiù/PagSu\n- Linea del vetrino: F1-F8\n- Vetrino precedente/successivo: F11/F12"
 _GOOGLE_FORM_TEXT = "Clicca qui per mandare un suggerimento o segnalare un bug"
@@ -0,0 +1,341 @@
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple, Union
+from config import _COMMAND_KEYS, _CONFIG_PATH, _CONFIG_POLL_MS
+from catalog import Catalog, normalize_name
+from keys import find_conflicts, normalize_keys, split_keys
+
+
+custom_logger = logging.getLogger(name="pollen_logger")
+
+
+class ConfigurationError(ValueError):
+    """Raised when configuration.json is missing or invalid.
+    The message lists every problem found in the file.
+    """
+
+    def __init__(self, path: str, errors: List[str]) -> None:
+        super().__init__(
+            f"Invalid configuration file {path}:\n"
+            + "\n".join(f"- {e}" for e in errors)
+        )
+        self.path = path
+        self.errors = errors
+
+    def __reduce__(self):
+        # Keep the error picklable, so it can cross process boundaries
+        return ConfigurationError, (self.path, self.errors)
+
+
+class PollenConfig(NamedTuple):
+    famiglia: str
+    nome: str
+    key: str
+    use_family: bool
+    # Pinned pollens are shown on every page of the grid
+    pinned: bool = False
+    # Other names of the pollen, matched when loading files
+    aliases: Tuple[str, ...] = ()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return self._asdict()
+
+
+class SamplerConfig(NamedTuple):
+    """Parameters of the volumetric sampler and of the microscope,
+    from the "campionatore" section of configuration.json.
+    """
+
+    # Air flow of the sampler, in litres per minute
+    flusso_l_min: float = 10.0
+    # Width of the daily trace on the slide, in mm
+    larghezza_traccia_mm: float = 14.0
+    # Field number of the eyepiece, in mm, and objective magnification:
+    # the diameter of the field of view is their ratio
+    numero_di_campo_mm: float = 20.0
+    ingrandimento: float = 40.0
+    # Lines read on each slide, when not given in the slide metadata
+    linee: int = 4
+
+    @property
+    def diametro_campo_mm(self) -> float:
+        return self.numero_di_campo_mm / self.ingrandimento
+
+    @property
+    def volume_giornaliero_m3(self) -> float:
+        return self.flusso_l_min * 60 * 24 / 1000
+
+
+class Configuration:
+    """Parsed and validated content of configuration.json, along with the
+    catalog of the pollens, looking them up by name and alias, built on
+    first use. Keys are resolved by the KeyDispatcher of the session.
+    """
+
+    def __init__(
+        self,
+        general: Dict[str, Any],
+        pollens: List[PollenConfig],
+        sampler: SamplerConfig = SamplerConfig(),
+    ) -> None:
+        self.general = general
+        self.pollens = pollens
+        self.sampler = sampler
+        self.pinned = {(p.famiglia, p.nome) for p in pollens if p.pinned}
+        self._catalog: Optional[Catalog] = None
+
+    @property
+    def rows(self) -> int:
+        return self.general["rows"]
+
+    @property
+    def columns(self) -> int:
+        return self.general["columns"]
+
+    @property
+    def database(self) -> Optional[str]:
+        """Path of the SQLite store, None when not configured."""
+        return self.general.get("database")
+
+    @property
+    def aggregator(self) -> Optional[Tuple[str, int]]:
+        """(host, port) of the aggregation server, None when not configured."""
+        address = self.general.get("aggregator")
+        if address is None:
+            return None
+        host, _, port = address.rpartition(":")
+        return host, int(port)
+
+    @property
+    def workstation(self) -> str:
+        """Name of this workstation for the aggregation server."""
+        return self.general.get("workstation") or socket.gethostname()
+
+    @property
+    def catalog(self) -> Catalog:
+        if self._catalog is None:
+            self._catalog = Catalog(
+                [(p.famiglia, p.nome) for p in self.pollens],
+                {i: p.aliases for i, p in enumerate(self.pollens) if p.aliases},
+            )
+        return self._catalog
+
+    def pollen_dicts(self) -> List[Dict[str, Any]]:
+        return [p.to_dict() for p in self.pollens]
+
+
+def _is_int(value: Any) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _is_text(value: Any) -> bool:
+    return isinstance(value, str) and value.strip() != ""
+
+
+def _is_address(value: Any) -> bool:
+    if not _is_text(value):
+        return False
+    host, _, port = value.rpartition(":")
+    return host != "" and port.isdigit() and 0 < int(port) < 65536
+
+
+def _is_positive(value: Any) -> bool:
+    return (_is_int(value) or isinstance(value, float)) and value > 0
+
+
+def _validate_sampler(raw: Any, errors: List[str]) -> SamplerConfig:
+    if raw is None:
+        return SamplerConfig()
+    if not isinstance(raw, dict):
+        errors.append('"campionatore" must be an object')
+        return SamplerConfig()
+    defaults = SamplerConfig()
+    values = {}
+    for field in SamplerConfig._fields:
+        value = raw.get(field, getattr(defaults, field))
+        if field == "linee" and not (_is_int(value) and value > 0):
+            errors.append(f'"campionatore.{field}" must be a positive integer')
+        elif not _is_positive(value):
+            errors.append(f'"campionatore.{field}" must be a positive number')
+        values[field] = value
+    unknown = sorted(set(raw) - set(SamplerConfig._fields))
+    if unknown:
+        errors.append(f'unknown fields in "campionatore": {", ".join(unknown)}')
+    return SamplerConfig(**values)
+
+
+def validate(raw: Any, path: str = _CONFIG_PATH) -> Configuration:
+    """Check the structure of a parsed configuration file
+    and build the Configuration, raising ConfigurationError on problems.
+    """
+    errors = []
+    if not isinstance(raw, dict):
+        raise ConfigurationError(path, ["the file must contain a JSON object"])
+    general = raw.get("general")
+    if not isinstance(general, dict):
+        errors.append('missing "general" section')
+        general = {}
+    for field in ("rows", "columns"):
+        if not _is_int(general.get(field)) or general[field] < 1:
+            errors.append(f'"general.{field}" must be a positive integer')
+    if "database" in general and not _is_text(general["database"]):
+        errors.append('"general.database" must be the path of the database file')
+    if "aggregator" in general and not _is_address(general["aggregator"]):
+        errors.append('"general.aggregator" must be a "host:port" address')
+    if "workstation" in general and not _is_text(general["workstation"]):
+        errors.append('"general.workstation" must be a non empty string')
+    sampler = _validate_sampler(raw.get("campionatore"), errors)
+    pollens = []
+    raw_pollens = raw.get("pollens")
+    if not isinstance(raw_pollens, list) or not raw_pollens:
+        errors.append('"pollens" must be a non empty list')
+        raw_pollens = []
+    keys = {}
+    taxa = {}
+    aliases_table = {}
+    for i, pollen in enumerate(raw_pollens):
+        where = f"pollens[{i}]"
+        if not isinstance(pollen, dict):
+            errors.append(f"{where} must be an object")
+            continue
+        problems = []
+        for field in ("famiglia", "nome"):
+            if not _is_text(pollen.get(field)):
+                problems.append(f'{where}: "{field}" must be a non empty string')
+        key = pollen.get("key")
+        if not (_is_text(key) or _is_int(key)):
+            problems.append(f'{where}: "key" must be a non empty string or a number')
+        if not isinstance(pollen.get("use_family"), bool):
+            problems.append(f'{where}: "use_family" must be true or false')
+        if not isinstance(pollen.get("pinned", False), bool):
+            problems.append(f'{where}: "pinned" must be true or false')
+        aliases = pollen.get("aliases", [])
+        if not isinstance(aliases, list) or not all(map(_is_text, aliases)):
+            problems.append(f'{where}: "aliases" must be a list of non empty strings')
+        if problems:
+            errors.extend(problems)
+            continue
+        p = PollenConfig(
+            pollen["famiglia"],
+            pollen["nome"],
+            normalize_keys(key),
+            pollen["use_family"],
+            pollen.get("pinned", False),
+            tuple(aliases),
+        )
+        reserved = [part for part in split_keys(p.key) if part in _COMMAND_KEYS]
+        if reserved:
+            errors.append(
+                f'{where}: key "{p.key}" uses "{reserved[0]}", '
+                "reserved for the commands of the app"
+            )
+        if p.key in keys:
+            errors.append(f'{where}: key "{p.key}" already used by {keys[p.key]}')
+        else:
+            keys[p.key] = where
+        if (p.famiglia, p.nome) in taxa:
+            errors.append(
+                f"{where}: {p.famiglia} - {p.nome} already defined in "
+                f"{taxa[(p.famiglia, p.nome)]}"
+            )
+        else:
+            taxa[(p.famiglia, p.nome)] = where
+        for alias in p.aliases:
+            name = normalize_name(alias)
+            if name in aliases_table and aliases_table[name] != where:
+                errors.append(
+                    f'{where}: alias "{alias}" already used by {aliases_table[name]}'
+                )
+            else:
+                aliases_table[name] = where
+        pollens.append(p)
+    for prefix, key in find_conflicts(keys):
+        errors.append(
+            f'{keys[key]}: key "{key}" starts with key "{prefix}" '
+            f"already used by {keys[prefix]}"
+        )
+    if errors:
+        raise ConfigurationError(path, errors)
+    return Configuration(general, pollens, sampler)
+
+
+# Cache of the parsed configurations: path -> (mtime_ns, size, configuration)
+_cache: Dict[str, Tuple[int, int, Configuration]] = {}
+
+
+def load_configuration(path: str = _CONFIG_PATH) -> Configuration:
+    """Return the configuration stored in path.
+    The file is parsed and validated only when it changed since the last call.
+    """
+    key = os.path.abspath(path)
+    try:
+        stat = os.stat(key)
+    except OSError as e:
+        raise ConfigurationError(path, [f"unable to read the file: {e}"]) from e
+    cached = _cache.get(key)
+    if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+    try:
+        with open(key, "r", encoding="utf-8") as f:
+            raw = json.load(f)
+    except ValueError as e:
+        raise ConfigurationError(path, [f"not a valid JSON file: {e}"]) from e
+    configuration = validate(raw, path)
+    _cache[key] = (stat.st_mtime_ns, stat.st_size, configuration)
+    custom_logger.info(f"Read configuration file {key}.")
+    return configuration
+
+
+class ConfigWatcher:
+    """Watch the configuration file from a background thread.
+    When the file changes it is parsed and validated off the Tk thread,
+    and the result (a Configuration or a ConfigurationError) is handed
+    over through a queue, to be collected with poll.
+    """
+
+    def __init__(self, path: str = _CONFIG_PATH, interval_ms: int = _CONFIG_POLL_MS):
+        self.path = path
+        self.interval = interval_ms / 1000
+        self.results = queue.Queue()
+        self._stop = threading.Event()
+        self._signature = self._stat()
+        self._thread = threading.Thread(
+            target=self._run, name="config-watcher", daemon=True
+        )
+
+    def _stat(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            signature = self._stat()
+            if signature is None or signature == self._signature:
+                continue
+            self._signature = signature
+            try:
+                self.results.put(load_configuration(self.path))
+            except ConfigurationError as e:
+                self.results.put(e)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def poll(self) -> Optional[Union[Configuration, ConfigurationError]]:
+        """Return the latest result, if the file changed since the last call."""
+        result = None
+        while True:
+            try:
+                result = self.results.get_nowait()
+            except queue.Empty:
+                return result
@@ -0,0 +1,408 @@
+import logging
+from array import array
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+from config import _UNDO_LIMIT
+from history import OperationLog
+from keys import KeyDispatcher, normalize_keys
+
+
+custom_logger = logging.getLogger(name="pollen_logger")
+
+# Operations notified to the session listeners
+OP_ADD = "add"
+OP_UNDO = "undo"
+OP_REDO = "redo"
+OP_RESET = "reset"
+OP_SET = "set"
+OP_LOAD = "load"
+OP_MOVE = "move"
+
+# A listener receives the operation, the index of the pollen that changed
+# (-1 when the whole session changed or the active line moved)
+# and the applied delta
+Listener = Callable[[str, int, int], None]
+# Undo/redo run of a pollen: (pollen index, delta, slide, line)
+Run = Tuple[int, int, int, int]
+
+
+class CountSession:
+    """Headless engine holding the state of a counting session.
+    All counts live in a single array indexed by pollen, and keys are
+    mapped to the same indexes through a precomputed table, so a keypress
+    costs the same regardless of the number of configured pollens.
+    Widgets never own any state: they only observe the session.
+
+    A session holds the counts of several slides, each made of several
+    lines, and keys count on the active line. Counts are kept sparse per
+    (slide, line, pollen), along with the totals of every line and the
+    totals of every slide by pollen, all updated at each step: counts is
+    the array of the active slide.
+
+    Pollens are stored as parallel arrays: every distinct name is kept once
+    in a string table shared by the name lists, and the flags are bytes.
+    """
+
+    def __init__(self, undo_limit: int = _UNDO_LIMIT) -> None:
+        # Distinct names and keys, each stored once
+        self.strings: Dict[str, str] = {}
+        self.famiglie: List[str] = []
+        self.nomi: List[str] = []
+        self.use_family = bytearray()
+        self.keys: List[str] = []
+        # Pollens removed from the configuration keep their index and count
+        # but are no longer bound to a key
+        self.active = bytearray()
+        self.counts = array("q")
+        # Active slide and line, numbered from 1
+        self.slide = 1
+        self.line = 1
+        # (slide, line) positions and their ids, as stored in the undo log
+        self.positions: List[Tuple[int, int]] = [(1, 1)]
+        self.position_ids: Dict[Tuple[int, int], int] = {(1, 1): 0}
+        self.position = 0
+        # Sparse counts: (slide, line, pollen index) -> count
+        self.cells: Dict[Tuple[int, int, int], int] = {}
+        # (slide, line) -> total count of the line
+        self.line_totals: Dict[Tuple[int, int], int] = {}
+        # Slide -> counts by pollen index of the slide
+        self.slide_counts: Dict[int, array] = {1: self.counts}
+        # Key sequence -> pollen index table, and its prefix tree
+        # resolving the keystrokes
+        self.key_table: Dict[str, int] = {}
+        self.dispatcher = KeyDispatcher()
+        # (famiglia, nome) -> pollen index table
+        self.taxon_table: Dict[Tuple[str, str], int] = {}
+        # Bounded log of (pollen index, delta) runs for undo/redo
+        self.history = OperationLog(undo_limit)
+        self.listeners: List[Listener] = []
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def _string(self, text: str) -> str:
+        return self.strings.setdefault(text, text)
+
+    def subscribe(self, listener: Listener) -> None:
+        self.listeners.append(listener)
+
+    def unsubscribe(self, listener: Listener) -> None:
+        self.listeners.remove(listener)
+
+    def _notify(self, op: str, index: int, delta: int) -> None:
+        for listener in self.listeners:
+            listener(op, index, delta)
+
+    def add_pollen(
+        self,
+        famiglia: str,
+        nome: str,
+        key: Union[str, int],
+        use_family: bool,
+        conteggio: int = 0,
+        active: bool = True,
+    ) -> int:
+        """Register a new pollen and return its index."""
+        index = len(self.counts)
+        key = self._string(normalize_keys(key))
+        famiglia = self._string(famiglia)
+        nome = self._string(nome)
+        self.famiglie.append(famiglia)
+        self.nomi.append(nome)
+        self.use_family.append(bool(use_family))
+        self.keys.append(key)
+        self.active.append(bool(active))
+        for counts in self.slide_counts.values():
+            counts.append(0)
+        self.taxon_table[(famiglia, nome)] = index
+        if conteggio:
+            self._apply(index, int(conteggio))
+        if active:
+            self._bind(index, key)
+        custom_logger.debug("Created pollen %s", self.describe(index))
+        return index
+
+    def _bind(self, index: int, key: str) -> None:
+        if key in self.key_table:
+            custom_logger.warning(
+                "Key %s already bound to %s, rebinding it to %s",
+                key,
+                self.nomi[self.key_table[key]],
+                self.nomi[index],
+            )
+        if not self.dispatcher.add(key, index):
+            custom_logger.warning(
+                "Key %s of %s conflicts with the start of another key sequence, "
+                "not bound",
+                key,
+                self.nomi[index],
+            )
+            return
+        self.key_table[key] = index
+
+    def _unbind(self, index: int) -> None:
+        if self.key_table.get(self.keys[index]) == index:
+            del self.key_table[self.keys[index]]
+            self.dispatcher.remove(self.keys[index], index)
+
+    def rebind(self, keys: Dict[int, str]) -> None:
+        """Change the keys of several pollens at once, so that keys
+        can be swapped between pollens.
+        """
+        for index in keys:
+            self._unbind(index)
+        for index, key in keys.items():
+            self.keys[index] = self._string(normalize_keys(key))
+            if self.active[index]:
+                self._bind(index, self.keys[index])
+            custom_logger.info("Changed binding of %s to %s", self.nomi[index], key)
+
+    def retire(self, index: int) -> None:
+        """Unbind a pollen, keeping its count and undo history."""
+        self._unbind(index)
+        self.active[index] = 0
+        custom_logger.info("Retired pollen %s", self.describe(index))
+
+    def restore(self, index: int) -> None:
+        self.active[index] = 1
+        self._bind(index, self.keys[index])
+        custom_logger.info("Restored pollen %s", self.describe(index))
+
+    def set_use_family(self, index: int, use_family: bool) -> None:
+        self.use_family[index] = bool(use_family)
+
+    def clear(self) -> None:
+        self.strings = {}
+        self.famiglie = []
+        self.nomi = []
+        self.use_family = bytearray()
+        self.keys = []
+        self.active = bytearray()
+        self.counts = array("q")
+        self.slide = 1
+        self.line = 1
+        self.positions = [(1, 1)]
+        self.position_ids = {(1, 1): 0}
+        self.position = 0
+        self.cells = {}
+        self.line_totals = {}
+        self.slide_counts = {1: self.counts}
+        self.key_table = {}
+        self.dispatcher = KeyDispatcher()
+        self.taxon_table = {}
+        self.history.clear()
+        self._notify(OP_RESET, -1, 0)
+
+    def _position_id(self, slide: int, line: int) -> int:
+        position = self.position_ids.get((slide, line))
+        if position is None:
+            position = len(self.positions)
+            self.positions.append((slide, line))
+            self.position_ids[(slide, line)] = position
+        return position
+
+    def _set_position(self, position: int) -> None:
+        self.position = position
+        self.slide, self.line = self.positions[position]
+        counts = self.slide_counts.get(self.slide)
+        if counts is None:
+            counts = array("q", bytes(8 * len(self.famiglie)))
+            self.slide_counts[self.slide] = counts
+        self.counts = counts
+
+    def _apply(self, index: int, delta: int) -> None:
+        """Add delta to the count of a pollen on the active line."""
+        cell = (self.slide, self.line, index)
+        count = self.cells.get(cell, 0) + delta
+        if count:
+            self.cells[cell] = count
+        else:
+            self.cells.pop(cell, None)
+        line = (self.slide, self.line)
+        self.line_totals[line] = self.line_totals.get(line, 0) + delta
+        self.counts[index] += delta
+
+    def move_to(self, slide: int, line: int) -> None:
+        """Make (slide, line) the line where the keys count."""
+        if slide < 1 or line < 1:
+            raise ValueError("Slides and lines are numbered from 1.")
+        if (slide, line) == (self.slide, self.line):
+            return
+        self._set_position(self._position_id(slide, line))
+        custom_logger.debug("Moved to slide %d, line %d", slide, line)
+        self._notify(OP_MOVE, -1, 0)
+
+    def line_total(self, slide: int, line: int) -> int:
+        return self.line_totals.get((slide, line), 0)
+
+    def count_at(self, slide: int, line: int, index: int) -> int:
+        return self.cells.get((slide, line, index), 0)
+
+    def load_cells(
+        self, cells: Iterable[Tuple[int, int, int, int]], position: Tuple[int, int]
+    ) -> None:
+        """Add (slide, line, pollen index, count) cells to the session,
+        without undo history, then make position the active line.
+        Listeners are notified only once at the end.
+        """
+        for slide, line, index, count in cells:
+            self._set_position(self._position_id(slide, line))
+            self._apply(index, count)
+        self._set_position(self._position_id(*position))
+        self._notify(OP_LOAD, -1, 0)
+
+    def index_of_key(self, key: str) -> Optional[int]:
+        return self.key_table.get(key)
+
+    def press(self, key: str) -> Optional[int]:
+        """Follow a keystroke and, if it completes the key sequence of a
+        pollen, increment the pollen and return its index.
+        """
+        index = self.dispatcher.feed(key)
+        if index is not None:
+            self.add(index)
+        return index
+
+    def add(self, index: int) -> None:
+        self._apply(index, 1)
+        self.history.record(index, 1, self.position)
+        if custom_logger.isEnabledFor(logging.DEBUG):
+            custom_logger.debug("Updated pollen %s", self.describe(index))
+        self._notify(OP_ADD, index, 1)
+
+    def undo(self) -> Optional[int]:
+        op = self.history.undo()
+        if op is None:
+            custom_logger.info("Nothing to undo.")
+            return None
+        index, delta, position = op
+        # Steps are undone on the line where they were counted
+        if position != self.position:
+            self._set_position(position)
+            self._notify(OP_MOVE, -1, 0)
+        self._apply(index, delta)
+        custom_logger.debug("Undo on pollen %d", index)
+        self._notify(OP_UNDO, index, delta)
+        return index
+
+    def redo(self) -> Optional[int]:
+        op = self.history.redo()
+        if op is None:
+            custom_logger.info("Nothing to redo.")
+            return None
+        index, delta, position = op
+        if position != self.position:
+            self._set_position(position)
+            self._notify(OP_MOVE, -1, 0)
+        self._apply(index, delta)
+        custom_logger.debug("Redo on pollen %d", index)
+        self._notify(OP_REDO, index, delta)
+        return index
+
+    def _zero(self) -> None:
+        self.cells.clear()
+        self.line_totals.clear()
+        for counts in self.slide_counts.values():
+            for i in range(len(counts)):
+                counts[i] = 0
+
+    def reset(self) -> None:
+        """Zero the counts of every slide and line."""
+        self._zero()
+        self.history.clear()
+        custom_logger.debug("Reset all pollen counts")
+        self._notify(OP_RESET, -1, 0)
+
+    def set_count(self, index: int, count: int) -> None:
+        """Set the count of a pollen on the active line."""
+        delta = count - self.count_at(self.slide, self.line, index)
+        self._apply(index, delta)
+        custom_logger.debug("Set pollen %s", self.describe(index))
+        self._notify(OP_SET, index, delta)
+
+    def history_runs(self) -> Tuple[List[Run], List[Run]]:
+        """Undo and redo runs, from the oldest, as (pollen index, delta,
+        slide, line) tuples.
+        """
+        positions = self.positions
+        return tuple(
+            [(index, delta, *positions[position]) for index, delta, position in runs]
+            for runs in (
+                self.history.undo_stack.runs(),
+                self.history.redo_stack.runs(),
+            )
+        )
+
+    def restore_history(self, undo: Iterable[Run], redo: Iterable[Run]) -> None:
+        """Replace the undo history with runs as returned by history_runs."""
+        self.history.clear()
+        for stack, runs in (
+            (self.history.undo_stack, undo),
+            (self.history.redo_stack, redo),
+        ):
+            for index, delta, slide, line in runs:
+                stack.push(index, delta, self._position_id(slide, line))
+
+    def replay(self, events: Iterable[Tuple[str, int, int]]) -> None:
+        """Apply a sequence of (operation, index, delta) events, as notified
+        to the listeners, rebuilding counts and undo history.
+        Move events carry the slide and the line in place of index and delta.
+        Undo and redo events are applied as they are, on the active line,
+        and step the history restored by restore_history.
+        Listeners are notified only once at the end.
+        """
+        history = self.history
+        for op, index, delta in events:
+            if op == OP_ADD:
+                self._apply(index, 1)
+                history.record(index, 1, self.position)
+            elif op == OP_UNDO or op == OP_REDO:
+                if op == OP_UNDO:
+                    history.undo()
+                else:
+                    history.redo()
+                self._apply(index, delta)
+            elif op == OP_SET:
+                self._apply(index, delta)
+            elif op == OP_MOVE:
+                self._set_position(self._position_id(index, delta))
+            elif op == OP_RESET:
+                self._zero()
+                history.clear()
+        custom_logger.debug("Replayed session events")
+        self._notify(OP_LOAD, -1, 0)
+
+    def short_str(self, index: int) -> str:
+        return (
+            f"{self.famiglie[index]}: {self.counts[index]}"
+            if self.use_family[index]
+            else f"{self.nomi[index]}: {self.counts[index]}"
+        )
+
+    def describe(self, index: int) -> str:
+        return f"{self.famiglie[index]} - {self.nomi[index]}: {self.counts[index]}"
+
+    def taxon_total(self, index: int) -> int:
+        """Count of a pollen over all the slides."""
+        return sum(counts[index] for counts in self.slide_counts.values())
+
+    def day_records(self) -> List[Tuple[int, int, str, str, int]]:
+        """(vetrino, linea, nome, famiglia, conteggio) rows of all the
+        counted pollens, by slide, line and configuration order.
+        """
+        return [
+            (slide, line, self.nomi[index], self.famiglie[index], count)
+            for (slide, line, index), count in sorted(self.cells.items())
+        ]
+
+    def slide_rows(self) -> List[Tuple[str, str, int]]:
+        """(nome, famiglia, conteggio) rows of the active slide to be saved,
+        in the same order as the configuration, read from the arrays.
+        Retired pollens are saved only if they were counted.
+        """
+        return [
+            (nome, famiglia, conteggio)
+            for nome, famiglia, conteggio, active in zip(
+                self.nomi, self.famiglie, self.counts, self.active
+            )
+            if active or conteggio
+        ]
@@ -1,40 +1,35 @@
-from collections import deque
 from datetime import datetime
+from catalog import MatchReport
 from config import _TLW_HEIGHT, _TLW_WIDTH
-from pollen_class import Pollen
+from configuration import ConfigurationError, load_configuration
+from engine import CountSession
+from slide_file import Day, SlideFileError, parse_day, write_day, write_slide
+from store import Record, StoreError
+from tasks import Task, TaskCancelled
 from tkinter import END, Toplevel, ttk, StringVar, Tk, filedialog, Text
-from typing import TypeVar, Union
-import pandas as pd
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Union
 import os
 import logging
 from abc import ABC, abstractmethod
-import json
 
 
 custom_logger = logging.getLogger(name="pollen_logger")
-PF = TypeVar("PF", bound="PollenFrame")
 
 
-# Pollen class is used both as a pollen representation and a tkinter frame
 class PollenFrame(ttk.Frame):
-    """Class to manage different pollen types.
-    This class contains data about the pollen family, name and count.
-    It also manages the frame to represent the pollen family
-    and its key binding.
+    """Frame showing a single pollen of a CountSession.
+    The frame keeps no count state: it only knows the index of the pollen
+    inside the session and redraws itself when the session notifies it.
     """
 
-    def __init__(
-        self, master: ttk.Frame, fam: str, nome: str, use_family: bool, count: int = 0
-    ) -> None:
+    def __init__(self, master: ttk.Frame, session: CountSession, index: int) -> None:
         # Initialize the ttk.Frame class with a master frame
         super().__init__(master)
         self.master = master
-        self.pollen = Pollen(fam, nome, use_family, count)
-        # Stacks for the undo/redo functionality
-        # These stacks store the previous states of the Pollen inside this PollenFrame
-        # These are used to revert the state of the PollenFrame
-        self.undo_stack = deque()
-        self.redo_stack = deque()
+        self.session = session
+        self.index = index
+        # (row, column) of the frame inside the grid
+        self.cell = None
         # Tkinter labels to show relevant info
         self.label_binding = ttk.Label(self, style="BindKey.TLabel")
         self.label_binding.grid(column=0, row=0, padx=5)
@@ -45,95 +40,245 @@ class PollenFrame(ttk.Frame):
         self.key_bind = StringVar()
         # Set the variable value
         self._update_contents()
-        self.key_bind.set("")
+        self.key_bind.set(self.session.keys[index])
         # Set the label above to the variable value
         self.label["textvariable"] = self.contents
         self.label_binding["textvariable"] = self.key_bind
-        custom_logger.debug(f"Created frame for pollen {self.pollen.nome}")
+        custom_logger.debug("Created frame for pollen %s", self.session.nomi[index])
 
     def _update_contents(self) -> None:
-        self.contents.set(self.pollen.short_str())
+        self.contents.set(self.session.short_str(self.index))
 
-    def add(self, event) -> None:
-        """Callback function to increment pollen count."""
-        self.undo_stack.append(dict(self.pollen.__dict__))
-        self.pollen.add()
+    def refresh(self) -> None:
         self._update_contents()
-        self.event_generate("<<Changed>>", when="head")
+        self.key_bind.set(self.session.keys[self.index])
 
-    def reset(self):
-        self.undo_stack = deque()
-        self.redo_stack = deque()
-        self.pollen.reset()
-        self._update_contents()
+    def show(self, index: int) -> None:
+        """Recycle the frame to show another pollen."""
+        self.index = index
+        self.refresh()
 
-    def set_pollen(self, pollen: Pollen):
-        self.pollen = pollen
-        self._update_contents()
+    def add(self, event=None) -> None:
+        """Callback function to increment pollen count."""
+        self.session.add(self.index)
 
-    def undo(self):
-        self.redo_stack.append(dict(self.pollen.__dict__))
-        self.set_pollen(Pollen(**self.undo_stack.pop()))
 
-    def redo(self):
-        self.undo_stack.append(dict(self.pollen.__dict__))
-        self.set_pollen(Pollen(**self.redo_stack.pop()))
+class PollenGrid(ttk.Frame):
+    """Frame showing the pollens of a CountSession one page at a time.
+    Only a pool of rows * cols PollenFrame widgets exists: changing page or
+    filter recycles them, so the cost of drawing the grid does not depend on
+    the number of configured pollens. Pinned pollens are shown on every page,
+    the others can be reached through paging and the search filter.
+    Pollens that are not shown can still be counted with their key, and the
+    last counted pollen is always shown in the toolbar.
+    """
 
-    def set_binding(self, key: Union[str, int]) -> None:
-        # Bind the key to increase the pollen count
-        key = str(key)
-        if PollenFrame.is_number_key(key):
-            self.master.bind(key, self.add)
-        else:
-            self.master.bind(f"<{key}>", self.add)
-        # Set the variable
-        self.key_bind.set(f"{key}")
-        custom_logger.info(f"Changed binding of {self.pollen.nome} to {key}")
+    def __init__(
+        self, master: Union[ttk.Frame, Tk], session: CountSession, rows: int, cols: int
+    ) -> None:
+        super().__init__(master)
+        self.master = master
+        self.session = session
+        self.rows = rows
+        self.cols = cols
+        # Indexes of the pollens to show, in display order
+        self.order: List[int] = []
+        # (famiglia, nome) of the pollens shown on every page
+        self.pinned: Set[Tuple[str, str]] = set()
+        self.page = 0
+        self.n_pages = 1
+        # Recycled frames and pollen index -> frame currently showing it
+        self.pool: List[PollenFrame] = []
+        self.visible: Dict[int, PollenFrame] = {}
+        # Toolbar with search filter, paging and last counted pollen
+        self.toolbar = ttk.Frame(self)
+        self.toolbar.grid(row=0, column=0, padx=10, pady=5, sticky="ew")
+        ttk.Label(self.toolbar, text="Cerca", style="Generic.TLabel").pack(side="left")
+        self.search = StringVar()
+        self.search_entry = ttk.Entry(
+            self.toolbar, textvariable=self.search, style="Generic.TEntry", width=20
+        )
+        self.search_entry.pack(side="left", padx=5)
+        self.search.trace_add("write", lambda *args: self._on_search())
+        self.button_prev = ttk.Button(
+            self.toolbar, text="<", command=self.prev_page, style="Help.TButton"
+        )
+        self.button_prev.pack(side="left", padx=5)
+        self.page_text = StringVar()
+        ttk.Label(
+            self.toolbar, textvariable=self.page_text, style="Generic.TLabel"
+        ).pack(side="left")
+        self.button_next = ttk.Button(
+            self.toolbar, text=">", command=self.next_page, style="Help.TButton"
+        )
+        self.button_next.pack(side="left", padx=5)
+        self.last_text = StringVar()
+        ttk.Label(
+            self.toolbar, textvariable=self.last_text, style="Generic.TLabel"
+        ).pack(side="right")
+        # Active slide and line, with the total of the line
+        self.position_text = StringVar()
+        ttk.Label(
+            self.toolbar, textvariable=self.position_text, style="Generic.TLabel"
+        ).pack(side="right", padx=10)
+        # Container of the pollen frames
+        self.cells = ttk.Frame(self)
+        self.cells.grid(row=1, column=0, sticky="nsew")
+
+    @property
+    def page_size(self) -> int:
+        return self.rows * self.cols
+
+    def set_layout(self, rows: int, cols: int) -> None:
+        if (rows, cols) != (self.rows, self.cols):
+            self.rows = rows
+            self.cols = cols
+            for pollen in self.pool:
+                pollen.cell = None
+
+    def set_pollens(self, order: List[int], pinned: Set[Tuple[str, str]]) -> None:
+        self.order = order
+        self.pinned = pinned
+
+    def _matches(self, index: int, text: str) -> bool:
+        return (
+            text in self.session.nomi[index].casefold()
+            or text in self.session.famiglie[index].casefold()
+            or text == self.session.keys[index].casefold()
+        )
 
-    @staticmethod
-    def is_number_key(key: str):
-        try:
-            return int(key) in range(10)
-        except ValueError:
-            return False
+    def _visible_indexes(self) -> List[int]:
+        session = self.session
+        pinned = [
+            i
+            for i in self.order
+            if (session.famiglie[i], session.nomi[i]) in self.pinned
+        ][: self.page_size]
+        text = self.search.get().strip().casefold()
+        others = [
+            i
+            for i in self.order
+            if (session.famiglie[i], session.nomi[i]) not in self.pinned
+            and (not text or self._matches(i, text))
+        ]
+        per_page = max(self.page_size - len(pinned), 1)
+        self.n_pages = max((len(others) - 1) // per_page + 1, 1)
+        self.page = min(self.page, self.n_pages - 1)
+        start = self.page * per_page
+        return (pinned + others[start : start + per_page])[: self.page_size]
+
+    def draw(self) -> None:
+        """Show the current page, recycling the pooled frames."""
+        indexes = self._visible_indexes()
+        # Frames are created only when the page needs more of them
+        while len(self.pool) < len(indexes):
+            self.pool.append(
+                PollenFrame(self.cells, self.session, indexes[len(self.pool)])
+            )
+        self.visible = {}
+        for i, pollen in enumerate(self.pool):
+            if i >= len(indexes):
+                if pollen.cell is not None:
+                    pollen.grid_remove()
+                    pollen.cell = None
+                continue
+            pollen.show(indexes[i])
+            self.visible[indexes[i]] = pollen
+            cell = (i // self.cols, i % self.cols)
+            if pollen.cell != cell:
+                pollen.grid(row=cell[0], column=cell[1], padx=10, pady=10, sticky="w")
+                pollen.cell = cell
+        self.page_text.set(f"{self.page + 1}/{self.n_pages}")
+        self.refresh_position()
+
+    def refresh_position(self) -> None:
+        session = self.session
+        self.position_text.set(
+            f"Vetrino {session.slide} - Linea {session.line}: "
+            f"{session.line_total(session.slide, session.line)}"
+        )
 
-    @classmethod
-    def generate_with_binding(
-        cls: PF,
-        master: ttk.Frame,
-        fam: str,
-        nome: str,
-        key: str,
-        use_family: bool,
-        count: int = 0,
-    ) -> PF:
-        """Class method used to generate a new pollen instance
-        while at the same time binding it to a keyboard key.
+    def refresh(self, index: int) -> None:
+        pollen = self.visible.get(index)
+        if pollen is not None:
+            pollen.refresh()
+        self.last_text.set(f"Ultimo: {self.session.short_str(index)}")
+        self.refresh_position()
+
+    def refresh_many(self, indexes: List[int]) -> None:
+        """Refresh the frames of several pollens, the last one being
+        shown as the last counted pollen.
         """
-        # Instantiate pollen object
-        pln = cls(master, fam, nome, use_family, count)
-        # Bind the key to increase the pollen count
-        pln.set_binding(key)
-        custom_logger.info(f"Generated pollen {nome} bound to key {key}")
-        return pln
+        visible = self.visible
+        for index in indexes:
+            pollen = visible.get(index)
+            if pollen is not None:
+                pollen.refresh()
+        if indexes:
+            self.last_text.set(f"Ultimo: {self.session.short_str(indexes[-1])}")
+            self.refresh_position()
+
+    def refresh_all(self) -> None:
+        for pollen in self.visible.values():
+            pollen.refresh()
+        self.refresh_position()
+
+    def clear(self) -> None:
+        self.order = []
+        self.page = 0
+        self.draw()
+        self.last_text.set("")
+
+    def next_page(self, event=None) -> None:
+        if self.page < self.n_pages - 1:
+            self.page += 1
+            self.draw()
+
+    def prev_page(self, event=None) -> None:
+        if self.page > 0:
+            self.page -= 1
+            self.draw()
+
+    def _on_search(self) -> None:
+        self.page = 0
+        self.draw()
 
 
 class EntryFrame(Toplevel, ABC):
-    """This class manages the window used to save/load data."""
+    """This class manages the window used to save/load data.
+    Files are read and written by a background Task, so counting goes on
+    meanwhile: the window shows its progress and can cancel it.
+    """
 
     def __init__(self, master: Union[ttk.Frame, Tk]) -> None:
         super().__init__(master, takefocus=True)
         self.data = None
         self.master = master
         self.init_dir = "."
+        self.task: Optional[Task] = None
+        self.protocol("WM_DELETE_WINDOW", self._close)
         self._grid_config()
-        self.entry = ttk.Entry(self, takefocus=True, style="Generic.TEntry", width=100)
+        recent = self._recent()
+        if recent:
+            # The entry also offers the names of the last saved records
+            self.entry = ttk.Combobox(
+                self, takefocus=True, style="Generic.TEntry", width=100, values=recent
+            )
+        else:
+            self.entry = ttk.Entry(
+                self, takefocus=True, style="Generic.TEntry", width=100
+            )
         self.entry.grid(row=0, column=0, padx=5, pady=5, sticky="nsew")
         # Browse button
         self.button_cancel = ttk.Button(
             self, text="Cerca", command=self._select_file, style="Generic.TButton"
         )
         self.button_cancel.grid(row=0, column=2, padx=5, pady=5, sticky="e")
+        # Progress of the running task, shown by _start_task
+        self.progress = ttk.Progressbar(self, mode="indeterminate")
+        self.button_stop = ttk.Button(
+            self, text="Annulla", command=self._cancel, style="Generic.TButton"
+        )
         self._update_position()
 
     def _grid_config(self):
@@ -150,6 +295,59 @@ class EntryFrame(Toplevel, ABC):
         h = self.master.winfo_height()
         self.geometry("+%d+%d" % (x + w // 3, y + h // 3))
 
+    def _recent(self) -> List[str]:
+        return []
+
+    def _start_task(
+        self, work: Callable[[Task], Any], on_done: Callable[[Any], None]
+    ) -> None:
+        """Run work in the background, then on_done with its result."""
+        self.function_button.state(["disabled"])
+        self.geometry(f"{_TLW_WIDTH}x{2 * _TLW_HEIGHT}")
+        self.progress.grid(row=1, column=0, padx=5, pady=5, sticky="nsew")
+        self.button_stop.grid(row=1, column=1, columnspan=2, padx=5, pady=5)
+        self.task = Task(self.master, work, on_done, self._on_error, self._on_progress)
+
+    def _stop_task(self) -> None:
+        self.task = None
+        self.progress.grid_remove()
+        self.button_stop.grid_remove()
+        self.geometry(f"{_TLW_WIDTH}x{_TLW_HEIGHT}")
+        self.function_button.state(["!disabled"])
+
+    def _on_progress(self, done: int, total: Optional[int]) -> None:
+        if not self.winfo_exists():
+            return
+        if total:
+            self.progress.configure(mode="determinate", maximum=total, value=done)
+        else:
+            self.progress.step()
+
+    def _on_error(self, error: BaseException) -> None:
+        if isinstance(error, TaskCancelled):
+            custom_logger.info("Operation cancelled.")
+            if self.winfo_exists():
+                self._stop_task()
+            return
+        if isinstance(error, FileNotFoundError):
+            custom_logger.error("File not found.")
+        elif isinstance(
+            error, (OSError, SlideFileError, ConfigurationError, StoreError)
+        ):
+            custom_logger.error(f"{error}")
+        else:
+            custom_logger.error(f"{error}", exc_info=error)
+        if self.winfo_exists():
+            self.destroy()
+
+    def _cancel(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+
+    def _close(self) -> None:
+        self._cancel()
+        self.destroy()
+
     @abstractmethod
     def _select_file(self):
         pass
@@ -165,14 +363,7 @@ class SaveFrame(EntryFrame):
         )
         self.title("Salva file")
         self.function_button.grid(row=0, column=1, padx=5, pady=5, sticky="e")
-        self.data = SaveFrame._data_fields_to_save(
-            pd.DataFrame([vars(plnf.pollen) for plnf in self.master.pollen_frames])
-        )
-        self.metadata = self.master.data_extra
-
-    @staticmethod
-    def _data_fields_to_save(df):
-        return df[["nome", "famiglia", "conteggio"]]
+        self.metadata = self.master.extra_info()
 
     def _select_file(self):
         dirname = filedialog.askdirectory(
@@ -189,18 +380,86 @@ class SaveFrame(EntryFrame):
         filename = self.entry.get()
         filename = filename.strip().split(".")[0]
         if filename is not None:
-            self.metadata.to_csv(f"{filename}.csv", sep=";", index=False, mode="w")
-            self.data.to_csv(f"{filename}.csv", sep=";", index=False, mode="a")
-            custom_logger.info(
-                f"Finished saving data to csv file {os.path.abspath(filename)}."
+            # Snapshot of the counts: counting goes on during the write
+            self.data = self._rows()
+            self.metadata = self.master.extra_info()
+            store_rows = self._store_rows()
+            session_id = self.master.session_id
+            self._start_task(
+                lambda task: self._save_work(task, filename, store_rows, session_id),
+                lambda _: self._saved(filename),
             )
-            self.destroy()
         else:
             custom_logger.error("Error, wrong filename.")
 
+    def _save_work(
+        self,
+        task: Task,
+        filename: str,
+        store_rows: List[Tuple[int, int, str, str, int]],
+        session_id: str,
+    ) -> None:
+        """Write the file, then the database record, on the worker thread.
+        The database is the last step of the progress.
+        """
+        self._write(f"{filename}.csv", task.track(self.data, len(self.data) + 1))
+        # The file is written: the database is updated even if the
+        # window was closed meanwhile
+        store = self.master.store
+        if store is not None:
+            try:
+                store.save(
+                    f"{os.path.basename(filename)}.csv",
+                    self.metadata,
+                    store_rows,
+                    session_id,
+                )
+            except StoreError as e:
+                custom_logger.error(f"{e}")
+        task.done += 1
+
+    def _saved(self, filename: str) -> None:
+        custom_logger.info(
+            f"Finished saving data to csv file {os.path.abspath(filename)}."
+        )
+        if self.winfo_exists():
+            self.destroy()
+
+    def _rows(self) -> List[Tuple[str, str, int]]:
+        return self.master.session.slide_rows()
+
+    def _write(self, path: str, rows) -> None:
+        write_slide(path, self.metadata, rows)
+
+    def _store_rows(self) -> List[Tuple[int, int, str, str, int]]:
+        # Lines of the active slide
+        session = self.master.session
+        return [r for r in session.day_records() if r[0] == session.slide]
+
+
+class DaySaveFrame(SaveFrame):
+    """Frame used to save the counts of every slide and line in a
+    single day file.
+    """
+
+    def __init__(self, master: Union[ttk.Frame, Tk]) -> None:
+        super().__init__(master)
+        self.title("Salva giornata")
+
+    def _rows(self) -> List[Tuple[int, int, str, str, int]]:
+        return self.master.session.day_records()
+
+    def _write(self, path: str, rows) -> None:
+        write_day(path, self.metadata, rows)
+
+    def _store_rows(self) -> List[Tuple[int, int, str, str, int]]:
+        return self.data
+
 
 class LoadFrame(EntryFrame):
-    """Frame used to load the count of each pollen from a CSV file."""
+    """Frame used to load the count of each pollen from a slide or day file,
+    or from a record of the database.
+    """
 
     def __init__(self, master: Union[ttk.Frame, Tk]) -> None:
         super().__init__(master)
@@ -210,11 +469,9 @@ class LoadFrame(EntryFrame):
         self.title("Carica file")
         self.function_button.grid(row=0, column=1, padx=5, pady=5, sticky="e")
 
-    @staticmethod
-    def _load_config():
-        with open("./configuration.json", "r") as f:
-            custom_logger.info("Read configuration file.")
-            return json.load(f)
+    def _recent(self) -> List[str]:
+        store = self.master.store
+        return store.recent() if store is not None else []
 
     def _select_file(self):
         filename = filedialog.askopenfilename(
@@ -230,33 +487,58 @@ class LoadFrame(EntryFrame):
         custom_logger.info("Load data from csv file.")
         filename = self.entry.get().strip()
         if filename is not None and ".csv" in filename:
-            try:
-                configuration = pd.DataFrame(LoadFrame._load_config()["pollens"])
-                df_data = pd.read_csv(
-                    filename, sep=";", index_col=False, header=2
-                ).merge(configuration, how="left", on=["famiglia", "nome"])
-                # Remove pollens without a binding in configuration
-                df_data.dropna(subset=["key"], inplace=True, axis=0)
-                # Create pollen frames
-                vals = list(df_data.T.to_dict().values())
-                custom_logger.debug(f"Loaded pandas dataframe with data {vals}")
-                self.master.clear()
-                self.master.add_pollens(vals)
-                custom_logger.info(
-                    f"Finished loading from csv file {os.path.abspath(filename)}."
-                )
-                # Add metadata
-                self.master.data_extra = pd.read_csv(
-                    filename, sep=";", index_col=False, nrows=1
-                )
-            except FileNotFoundError as e:
-                custom_logger.error("File not found.")
-                raise e
-            finally:
-                self.destroy()
+            self._start_task(
+                lambda task: self._read(task, filename),
+                lambda day: self._loaded(filename, day),
+            )
         else:
             custom_logger.error("Error, wrong filename.")
 
+    def _read(self, task: Task, filename: str) -> Union[Day, Record]:
+        """Parse the file, or read the database record with that name,
+        on the worker thread.
+        """
+        store = self.master.store
+        if store is not None and not os.path.isfile(filename):
+            return store.load(filename)
+        with open(filename, "r", encoding="utf-8", newline="") as f:
+            return parse_day(task.track(f), filename)
+
+    def _loaded(self, filename: str, day: Union[Day, Record]) -> None:
+        # Closing the window cancels the load
+        if not self.winfo_exists():
+            return
+        try:
+            configuration = load_configuration()
+            catalog = configuration.catalog
+            report = MatchReport()
+            # Match the names to the configured pollens, remapping misspelled
+            # names and aliases and removing pollens without a binding:
+            # the others get an index in order of appearance
+            indexes = {}
+            cells = []
+            for vetrino, linea, nome, famiglia, conteggio in day.counts:
+                match = catalog.resolve(famiglia, nome)
+                report.add(famiglia, nome, match)
+                if match is None:
+                    continue
+                index = indexes.setdefault(match.index, len(indexes))
+                cells.append((vetrino, linea, index, conteggio))
+            vals = [configuration.pollens[i].to_dict() for i in indexes]
+            for line in report.lines():
+                custom_logger.warning(f"{filename}: {line}")
+            custom_logger.debug("Loaded %s with data %s", filename, cells)
+            self.master.load_counts(vals, cells)
+            custom_logger.info(
+                f"Finished loading from csv file {os.path.abspath(filename)}."
+            )
+            # Add metadata
+            self.master.set_data_extra(dict(day.metadata))
+        except ConfigurationError as e:
+            custom_logger.error(f"{e}")
+        finally:
+            self.destroy()
+
 
 class HelpFrame(Toplevel):
     """Frame shown when clicking the ? button."""
@@ -296,8 +578,6 @@ class ExtraInfoFrame(Toplevel):
         )
         self.entry_operatore = ttk.Entry(self, takefocus=True, style="Generic.TEntry")
         text = self.master.data_extra.get("operatore", "")
-        if isinstance(text, pd.Series):
-            text = text.iloc[0]
         self.entry_operatore.insert(0, text)
         self.entry_operatore.grid(
             row=0, column=1, columnspan=2, padx=5, pady=5, sticky="nsew"
@@ -308,8 +588,6 @@ class ExtraInfoFrame(Toplevel):
         )
         self.entry_data = ttk.Entry(self, takefocus=True, style="Generic.TEntry")
         text = self.master.data_extra.get("data", ExtraInfoFrame._now_date())
-        if isinstance(text, pd.Series):
-            text = text.iloc[0]
         self.entry_data.insert(0, text)
         self.entry_data.grid(
             row=1, column=1, columnspan=2, padx=5, pady=5, sticky="nsew"
@@ -337,8 +615,6 @@ class ExtraInfoFrame(Toplevel):
             width=55,
         )
         text = self.master.data_extra.get("linee_vetrino", "")
-        if isinstance(text, pd.Series):
-            text = text.iloc[0]
         self.text_vetrino.insert("1.0", text)
         self.text_vetrino.grid(
             row=3, column=1, columnspan=2, padx=5, pady=5, sticky="nsew"
@@ -377,8 +653,8 @@ class ExtraInfoFrame(Toplevel):
         operator = self.entry_operatore.get().strip()
         data = self.entry_data.get().strip()
         vetrino = self.text_vetrino.get("1.0", END).strip()
-        self.master.data_extra = pd.DataFrame(
-            {"operatore": [operator], "data": [data], "linee_vetrino": [vetrino]}
+        self.master.set_data_extra(
+            {"operatore": operator, "data": data, "linee_vetrino": vetrino}
         )
         self.destroy()
 
@@ -0,0 +1,110 @@
+from array import array
+from typing import List, Optional, Tuple
+from config import _UNDO_LIMIT
+
+
+class RunStack:
+    """Bounded stack of (pollen index, delta, position) runs stored in ring
+    arrays, the position being the slide line where the steps were counted.
+    Consecutive steps on the same pollen and line in the same direction are
+    coalesced into a single run, which is consumed one step at a time.
+    When the stack is full the oldest run is overwritten.
+    """
+
+    def __init__(self, limit: int = _UNDO_LIMIT) -> None:
+        if limit < 1:
+            raise ValueError("The stack limit must be a positive number.")
+        self.limit = limit
+        self.indexes = array("i", bytes(4 * limit))
+        self.deltas = array("i", bytes(4 * limit))
+        self.positions = array("i", bytes(4 * limit))
+        # Position of the next free slot and number of stored runs
+        self.top = 0
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def push(self, index: int, step: int, position: int = 0) -> None:
+        if self.size:
+            last = self.top - 1
+            if (
+                self.indexes[last] == index
+                and self.positions[last] == position
+                and (self.deltas[last] > 0) == (step > 0)
+            ):
+                self.deltas[last] += step
+                return
+        self.indexes[self.top] = index
+        self.deltas[self.top] = step
+        self.positions[self.top] = position
+        self.top = (self.top + 1) % self.limit
+        self.size = min(self.size + 1, self.limit)
+
+    def pop(self) -> Optional[Tuple[int, int, int]]:
+        """Remove a single step from the last run and return it."""
+        if not self.size:
+            return None
+        last = self.top - 1
+        index = self.indexes[last]
+        position = self.positions[last]
+        step = 1 if self.deltas[last] > 0 else -1
+        self.deltas[last] -= step
+        if not self.deltas[last]:
+            self.top = last % self.limit
+            self.size -= 1
+        return index, step, position
+
+    def runs(self) -> List[Tuple[int, int, int]]:
+        """(pollen index, delta, position) runs, from the oldest."""
+        start = self.top - self.size
+        return [
+            (self.indexes[i], self.deltas[i], self.positions[i])
+            for i in (n % self.limit for n in range(start, self.top))
+        ]
+
+    def clear(self) -> None:
+        self.top = 0
+        self.size = 0
+
+
+class OperationLog:
+    """Undo/redo log of the count operations of a session.
+    Every operation is a single +1/-1 step on one pollen in one slide line;
+    steps are coalesced into runs so long sequences of the same key take
+    one entry.
+    """
+
+    def __init__(self, limit: int = _UNDO_LIMIT) -> None:
+        self.undo_stack = RunStack(limit)
+        self.redo_stack = RunStack(limit)
+
+    def record(self, index: int, step: int = 1, position: int = 0) -> None:
+        self.undo_stack.push(index, step, position)
+        self.redo_stack.clear()
+
+    def undo(self) -> Optional[Tuple[int, int, int]]:
+        """Return the pollen index, the delta reverting the last step
+        and the position where it was counted.
+        """
+        op = self.undo_stack.pop()
+        if op is None:
+            return None
+        index, step, position = op
+        self.redo_stack.push(index, step, position)
+        return index, -step, position
+
+    def redo(self) -> Optional[Tuple[int, int, int]]:
+        """Return the pollen index, the delta replaying the last undone step
+        and the position where it was counted.
+        """
+        op = self.redo_stack.pop()
+        if op is None:
+            return None
+        index, step, position = op
+        self.undo_stack.push(index, step, position)
+        return index, step, position
+
+    def clear(self) -> None:
+        self.undo_stack.clear()
+        self.redo_stack.clear()
@@ -0,0 +1,273 @@
+"""Batch ingest of saved slide files into a columnar dataset.
+
+Every CSV file (slide or day file) found under the source directory is
+parsed, matched against the catalog of configuration.json and written as a
+Parquet part inside a dataset partitioned by date:
+
+    dataset/
+        _manifest.json
+        data=2022-04-01/part-<id>.parquet
+        ...
+
+The manifest tracks size and modification time of every ingested file,
+so running the ingest again only parses new or changed files and drops
+the parts of the files that have been removed.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Optional, Tuple
+import argparse
+import hashlib
+import importlib.util
+import json
+import logging
+import multiprocessing
+import os
+import sys
+from catalog import Catalog, MatchReport
+from config import _CONFIG_PATH
+from configuration import load_configuration
+from slide_file import iso_date, read_day
+
+
+custom_logger = logging.getLogger(name="pollen_logger")
+
+MANIFEST_FILE = "_manifest.json"
+PARTITION_COLUMN = "data"
+# Partition used for files without a valid date
+NULL_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+
+
+def _schema():
+    """Schema of the parts. The date is not stored in the files
+    since it is encoded in the partition directory.
+    """
+    import pyarrow as pa
+
+    return pa.schema(
+        [
+            ("file", pa.string()),
+            ("operatore", pa.string()),
+            ("linee_vetrino", pa.string()),
+            ("vetrino", pa.int64()),
+            ("linea", pa.int64()),
+            ("nome", pa.string()),
+            ("famiglia", pa.string()),
+            ("conteggio", pa.int64()),
+            ("in_configurazione", pa.bool_()),
+        ]
+    )
+
+
+def _check_dependencies() -> None:
+    # pyarrow is only looked up here: importing it before the worker
+    # processes are forked makes them crash
+    if importlib.util.find_spec("pyarrow") is None:
+        raise ImportError("The batch ingest needs pyarrow: pip install pyarrow")
+
+
+def load_catalog(config_path: str) -> Catalog:
+    """Return the catalog of the configured pollens."""
+    return load_configuration(config_path).catalog
+
+
+def _part_name(relpath: str) -> str:
+    digest = hashlib.sha1(relpath.encode("utf-8")).hexdigest()[:16]
+    return f"part-{digest}.parquet"
+
+
+def ingest_file(
+    path: str, relpath: str, dataset_dir: str, catalog: Catalog
+) -> Tuple[str, str, int, MatchReport]:
+    """Parse a single slide or day file and write its Parquet part.
+    Names matched in the catalog are written as configured, the others
+    as found and flagged. Runs inside the worker processes: returns the
+    relative path, the partition, the number of rows written and the
+    names remapped or not found.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    metadata, rows = read_day(path)[1:]
+    date = iso_date(metadata.get("data", ""))
+    partition = f"{PARTITION_COLUMN}={date or NULL_PARTITION}"
+    matches = MatchReport()
+    nomi, famiglie, configured = [], [], []
+    for row in rows:
+        nome, famiglia = row[2].strip(), row[3].strip()
+        match = catalog.resolve(famiglia, nome)
+        matches.add(famiglia, nome, match)
+        if match is not None:
+            nome, famiglia = match.nome, match.famiglia
+        nomi.append(nome)
+        famiglie.append(famiglia)
+        configured.append(match is not None)
+    n = len(rows)
+    table = pa.Table.from_pydict(
+        {
+            "file": [relpath] * n,
+            "operatore": [metadata.get("operatore", "").strip()] * n,
+            "linee_vetrino": [metadata.get("linee_vetrino", "")] * n,
+            "vetrino": [row[0] for row in rows],
+            "linea": [row[1] for row in rows],
+            "nome": nomi,
+            "famiglia": famiglie,
+            "conteggio": [row[4] for row in rows],
+            "in_configurazione": configured,
+        },
+        schema=_schema(),
+    )
+    part_dir = os.path.join(dataset_dir, partition)
+    os.makedirs(part_dir, exist_ok=True)
+    tmp_path = os.path.join(part_dir, f".{_part_name(relpath)}.tmp")
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, os.path.join(part_dir, _part_name(relpath)))
+    return relpath, partition, n, matches
+
+
+def _scan(source_dir: str) -> Dict[str, Dict[str, int]]:
+    files = {}
+    for root, _, names in os.walk(source_dir):
+        for name in names:
+            if name.lower().endswith(".csv"):
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                relpath = os.path.relpath(path, source_dir).replace(os.sep, "/")
+                files[relpath] = {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+    return files
+
+
+def _load_manifest(dataset_dir: str) -> Dict[str, Dict]:
+    path = os.path.join(dataset_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def _save_manifest(dataset_dir: str, manifest: Dict[str, Dict]) -> None:
+    path = os.path.join(dataset_dir, MANIFEST_FILE)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(f"{path}.tmp", path)
+
+
+def _remove_part(dataset_dir: str, relpath: str, partition: str) -> None:
+    path = os.path.join(dataset_dir, partition, _part_name(relpath))
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def ingest(
+    source_dir: str,
+    dataset_dir: str,
+    config_path: str = _CONFIG_PATH,
+    workers: Optional[int] = None,
+    full: bool = False,
+) -> Dict[str, List[str]]:
+    """Ingest all new or changed slide files of source_dir into dataset_dir.
+    Returns the relative paths of the ingested, removed and failed files,
+    and the names remapped to the configuration or not found in it.
+    """
+    _check_dependencies()
+    catalog = load_catalog(config_path)
+    os.makedirs(dataset_dir, exist_ok=True)
+    manifest = _load_manifest(dataset_dir)
+    files = _scan(source_dir)
+    changed = [
+        relpath
+        for relpath, stat in files.items()
+        if full
+        or relpath not in manifest
+        or manifest[relpath]["mtime_ns"] != stat["mtime_ns"]
+        or manifest[relpath]["size"] != stat["size"]
+    ]
+    removed = [relpath for relpath in manifest if relpath not in files]
+    for relpath in removed:
+        _remove_part(dataset_dir, relpath, manifest.pop(relpath)["partition"])
+    report = {"ingested": [], "removed": sorted(removed), "failed": []}
+    matches = MatchReport()
+    custom_logger.info(
+        f"Ingesting {len(changed)} of {len(files)} files from {source_dir}."
+    )
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                ingest_file,
+                os.path.join(source_dir, relpath),
+                relpath,
+                dataset_dir,
+                catalog,
+            ): relpath
+            for relpath in changed
+        }
+        for future in as_completed(futures):
+            relpath = futures[future]
+            try:
+                _, partition, _, file_matches = future.result()
+            except Exception as e:
+                custom_logger.error(f"Unable to ingest {relpath}: {e}")
+                report["failed"].append(relpath)
+                continue
+            # The file may have moved to another date
+            old = manifest.get(relpath)
+            if old is not None and old["partition"] != partition:
+                _remove_part(dataset_dir, relpath, old["partition"])
+            manifest[relpath] = dict(files[relpath], partition=partition)
+            report["ingested"].append(relpath)
+            matches.update(file_matches)
+    _save_manifest(dataset_dir, manifest)
+    report["ingested"].sort()
+    report["failed"].sort()
+    report["names"] = matches.lines()
+    return report
+
+
+def _workers(value: str) -> int:
+    workers = int(value)
+    if workers < 1:
+        raise argparse.ArgumentTypeError("must be at least 1")
+    return workers
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the arguments of the ingest, but the configuration file, to parser."""
+    parser.add_argument("source", help="Directory containing the slide CSV files")
+    parser.add_argument("dataset", help="Output dataset directory")
+    parser.add_argument(
+        "--workers", type=_workers, default=None, help="Number of worker processes"
+    )
+    parser.add_argument(
+        "--full", action="store_true", help="Ingest all files, ignoring the manifest"
+    )
+
+
+def run(args: argparse.Namespace) -> int:
+    """Run the ingest with the parsed arguments and print its report.
+    Returns the exit code, 1 if any file failed.
+    """
+    report = ingest(args.source, args.dataset, args.config, args.workers, args.full)
+    print(
+        f"Ingested {len(report['ingested'])} files, "
+        f"removed {len(report['removed'])}, failed {len(report['failed'])}."
+    )
+    for relpath in report["failed"]:
+        print(f"Failed: {relpath}")
+    for line in report["names"]:
+        print(f"Names: {line}")
+    return 1 if report["failed"] else 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Ingest saved slide files into a Parquet dataset partitioned by date."
+    )
+    add_arguments(parser)
+    parser.add_argument("--config", default=_CONFIG_PATH, help="Configuration file")
+    return run(parser.parse_args(argv))
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -0,0 +1,276 @@
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from config import _JOURNAL_BATCH, _JOURNAL_INTERVAL_MS
+from engine import (
+    CountSession,
+    OP_ADD,
+    OP_MOVE,
+    OP_REDO,
+    OP_RESET,
+    OP_SET,
+    OP_UNDO,
+    Run,
+)
+
+
+custom_logger = logging.getLogger(name="pollen_logger")
+
+_MAGIC = "POLLEN-JOURNAL 1"
+
+
+class JournalError(ValueError):
+    pass
+
+
+class Recovered(NamedTuple):
+    pollens: List[Dict]
+    # (slide, line, pollen index, count) cells of the checkpoint
+    cells: List[Tuple[int, int, int, int]]
+    position: Tuple[int, int]
+    metadata: Dict[str, str]
+    events: List[Tuple[str, int, int]]
+    # Undo and redo runs of the checkpoint
+    history: Tuple[List[Run], List[Run]]
+    # Id of the counting session for the aggregation server
+    session_id: str
+
+
+class Journal:
+    """Append-only write-ahead journal of a counting session.
+    The file starts with a checkpoint (the pollens, the counts of every
+    slide line, the active line, the undo history and the extra info)
+    followed by one line per event, as notified by the session:
+        add <index>
+        undo <index> <delta> <slide> <line>
+        redo <index> <delta> <slide> <line>
+        reset
+        set <index> <delta>
+        move <slide> <line>
+        meta <json>
+    Events are buffered on the Tk thread and handed over in groups to a
+    writer thread, which writes and fsyncs them, so a slow disk never
+    delays a keystroke. The file is removed when the session ends cleanly,
+    so a journal found at startup belongs to a session that crashed.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        batch: int = _JOURNAL_BATCH,
+        interval_ms: int = _JOURNAL_INTERVAL_MS,
+    ) -> None:
+        self.path = path
+        self.batch = batch
+        self.interval = interval_ms / 1000
+        self.pending: List[str] = []
+        self.last_commit = time.monotonic()
+        self.file = None
+        # Session being journaled, set by checkpoint
+        self.session: Optional[CountSession] = None
+        # Events committed but not yet written, taken by the writer thread.
+        # The file is only written holding _lock, so that a checkpoint
+        # never gets older events appended after it
+        self._queue: List[str] = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition()
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, name="journal", daemon=True)
+        self._thread.start()
+
+    def checkpoint(
+        self, session: CountSession, metadata: Dict[str, str], session_id: str = ""
+    ) -> None:
+        """Atomically replace the journal with a snapshot of the session."""
+        self.pending = []
+        self.session = session
+        header = {
+            "pollens": [
+                {
+                    "famiglia": famiglia,
+                    "nome": nome,
+                    "key": key,
+                    "use_family": bool(use_family),
+                    "active": bool(active),
+                }
+                for famiglia, nome, key, use_family, active in zip(
+                    session.famiglie,
+                    session.nomi,
+                    session.keys,
+                    session.use_family,
+                    session.active,
+                )
+            ],
+            "cells": [
+                [slide, line, index, count]
+                for (slide, line, index), count in session.cells.items()
+            ],
+            "position": [session.slide, session.line],
+            "history": session.history_runs(),
+            "data_extra": metadata,
+            "session_id": session_id,
+        }
+        tmp_path = f"{self.path}.tmp"
+        with self._lock:
+            with self._wakeup:
+                # The events still queued are part of the checkpoint
+                self._queue = []
+            if self.file is not None:
+                self.file.close()
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(f"{_MAGIC}\n{json.dumps(header)}\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            self.file = open(self.path, "a", encoding="utf-8")
+        self.last_commit = time.monotonic()
+        custom_logger.debug("Written journal checkpoint to %s", self.path)
+
+    def on_change(self, op: str, index: int, delta: int) -> None:
+        """Session listener appending each event to the journal."""
+        if op == OP_ADD:
+            self._append(f"add {index}\n")
+        elif op == OP_UNDO or op == OP_REDO:
+            session = self.session
+            self._append(f"{op} {index} {delta} {session.slide} {session.line}\n")
+        elif op == OP_RESET:
+            self._append(f"{op}\n")
+        elif op == OP_SET:
+            self._append(f"set {index} {delta}\n")
+        elif op == OP_MOVE:
+            self._append(f"move {self.session.slide} {self.session.line}\n")
+
+    def record_metadata(self, metadata: Dict[str, str]) -> None:
+        self._append(f"meta {json.dumps(metadata)}\n")
+
+    def _append(self, line: str) -> None:
+        self.pending.append(line)
+        if (
+            len(self.pending) >= self.batch
+            or time.monotonic() - self.last_commit >= self.interval
+        ):
+            self.commit()
+
+    def commit(self) -> None:
+        """Hand all the pending events over to the writer thread."""
+        self.last_commit = time.monotonic()
+        if not self.pending:
+            return
+        with self._wakeup:
+            self._queue.extend(self.pending)
+            self._wakeup.notify()
+        self.pending = []
+
+    def _run(self) -> None:
+        while True:
+            with self._wakeup:
+                while not self._queue and not self._stop:
+                    self._wakeup.wait()
+                if self._stop:
+                    return
+            with self._lock:
+                with self._wakeup:
+                    lines = self._queue
+                    self._queue = []
+                if not lines or self.file is None:
+                    continue
+                try:
+                    self.file.write("".join(lines))
+                    self.file.flush()
+                    os.fsync(self.file.fileno())
+                except OSError as e:
+                    custom_logger.error(f"Unable to write journal {self.path}: {e}")
+
+    def close(self) -> None:
+        """End the session cleanly, removing the journal."""
+        with self._wakeup:
+            self._stop = True
+            self._wakeup.notify()
+        self._thread.join()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.pending = []
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        custom_logger.info("Closed session journal.")
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(path) and os.path.getsize(path) > 0
+
+    @staticmethod
+    def read(path: str) -> Recovered:
+        """Parse a journal and return the pollens, cells and active line of
+        its checkpoint, the latest extra info and the events recorded after it.
+        A truncated last line, left by a crash mid-write, is ignored.
+        """
+        with open(path, "r", encoding="utf-8") as f:
+            lines = f.read().split("\n")
+        if len(lines) < 2 or lines[0] != _MAGIC:
+            raise JournalError(f"{path} is not a valid journal.")
+        try:
+            header = json.loads(lines[1])
+        except ValueError as e:
+            raise JournalError(f"{path} has a corrupted checkpoint.") from e
+        try:
+            pollens = header["pollens"]
+            metadata = header["data_extra"]
+            cells = [tuple(cell) for cell in header["cells"]]
+            position = tuple(header["position"])
+            undo, redo = header["history"]
+            session_id = header["session_id"]
+        except (KeyError, TypeError, ValueError) as e:
+            raise JournalError(f"{path} has an incomplete checkpoint.") from e
+        history = ([tuple(run) for run in undo], [tuple(run) for run in redo])
+        events = []
+        append = events.append
+        # The last element is either empty or a partially written line
+        for n, line in enumerate(lines[2:-1], start=3):
+            op, _, args = line.partition(" ")
+            try:
+                if op == OP_ADD:
+                    append((OP_ADD, int(args), 1))
+                elif op == OP_UNDO or op == OP_REDO:
+                    index, delta, slide, line = map(int, args.split(" "))
+                    # Undone steps are applied on the line they were counted on
+                    append((OP_MOVE, slide, line))
+                    append((op, index, delta))
+                elif op == OP_RESET:
+                    append((OP_RESET, -1, 0))
+                elif op == OP_SET:
+                    index, delta = args.split(" ")
+                    append((OP_SET, int(index), int(delta)))
+                elif op == OP_MOVE:
+                    slide, line = args.split(" ")
+                    append((OP_MOVE, int(slide), int(line)))
+                elif op == "meta":
+                    metadata = json.loads(args)
+                else:
+                    raise ValueError(f"unknown event {op}")
+            except ValueError as e:
+                custom_logger.error(f"Stopped reading journal {path} at line {n}: {e}")
+                break
+        return Recovered(
+            pollens,
+            cells,
+            position,
+            metadata,
+            events,
+            history,
+            session_id,
+        )
+
+
+def recover(path: str) -> Optional[Recovered]:
+    """Read the journal left by a crashed session, if any."""
+    if not Journal.exists(path):
+        return None
+    try:
+        return Journal.read(path)
+    except JournalError as e:
+        custom_logger.error(f"Unable to recover the previous session: {e}")
+        return None
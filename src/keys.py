@@ -0,0 +1,130 @@
+"""Key sequences bound to the pollens.
+
+A pollen can be bound to a single key ("b") or to a sequence of keys
+separated by spaces ("b e"), so that large catalogs are not limited by the
+number of keys of the keyboard. Sequences are resolved by a prefix tree:
+each keystroke follows one branch, costing a dictionary lookup whatever
+the number of pollens. A sequence left incomplete for longer than the
+timeout is dropped, and a key bound to a pollen can not also be the start
+of a longer sequence.
+"""
+
+from time import monotonic
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+from config import _KEY_SEQUENCE_TIMEOUT_MS
+
+# Branches of the tree are dicts, leaves are pollen indexes
+Node = Dict[str, Union["Node", int]]
+
+
+def split_keys(key: str) -> Tuple[str, ...]:
+    return tuple(str(key).split())
+
+
+def normalize_keys(key: str) -> str:
+    return " ".join(split_keys(key))
+
+
+def find_conflicts(keys: Iterable[str]) -> List[Tuple[str, str]]:
+    """(prefix, sequence) pairs of keys that start another sequence."""
+    bound = set(keys)
+    conflicts = []
+    for key in bound:
+        parts = split_keys(key)
+        for n in range(1, len(parts)):
+            prefix = " ".join(parts[:n])
+            if prefix in bound:
+                conflicts.append((prefix, key))
+    return sorted(conflicts)
+
+
+class KeyDispatcher:
+    """Prefix tree of the key sequences, and the sequence being typed."""
+
+    def __init__(self, timeout_ms: int = _KEY_SEQUENCE_TIMEOUT_MS) -> None:
+        self.root: Node = {}
+        self.node = self.root
+        self.timeout = timeout_ms / 1000
+        self.last = 0.0
+
+    @property
+    def pending(self) -> bool:
+        return self.node is not self.root
+
+    def add(self, key: str, index: int) -> bool:
+        """Bind a sequence to index, replacing any previous binding of the
+        same sequence. Returns False, binding nothing, if the sequence
+        starts or is the start of another one.
+        """
+        parts = split_keys(key)
+        if not parts:
+            return False
+        node = self.root
+        for part in parts[:-1]:
+            child = node.get(part)
+            if child is None:
+                break
+            if not isinstance(child, dict):
+                return False
+            node = child
+        else:
+            if isinstance(node.get(parts[-1]), dict):
+                return False
+        node = self.root
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = index
+        return True
+
+    def remove(self, key: str, index: int) -> None:
+        """Unbind a sequence, if still bound to index."""
+        parts = split_keys(key)
+        path = []
+        node = self.root
+        for part in parts[:-1]:
+            child = node.get(part)
+            if not isinstance(child, dict):
+                return
+            path.append((node, part))
+            node = child
+        if not parts or node.get(parts[-1]) != index:
+            return
+        del node[parts[-1]]
+        # Prune the branches left empty
+        for parent, part in reversed(path):
+            if parent[part]:
+                break
+            del parent[part]
+        self.reset()
+
+    def get(self, key: str) -> Optional[int]:
+        node = self.root
+        for part in split_keys(key):
+            if not isinstance(node, dict):
+                return None
+            node = node.get(part)
+            if node is None:
+                return None
+        return node if isinstance(node, int) else None
+
+    def reset(self) -> None:
+        self.node = self.root
+
+    def feed(self, key: str, now: Optional[float] = None) -> Optional[int]:
+        """Follow a keystroke, returning the index of the pollen when it
+        completes a sequence, None otherwise.
+        """
+        now = monotonic() if now is None else now
+        node = self.node
+        if node is not self.root and now - self.last > self.timeout:
+            node = self.root
+        self.last = now
+        child = node.get(key)
+        if child is None and node is not self.root:
+            # A key that does not continue the sequence starts a new one
+            child = self.root.get(key)
+        if isinstance(child, dict):
+            self.node = child
+            return None
+        self.node = self.root
+        return child
@@ -0,0 +1,160 @@
+"""Keystroke latency instrumentation.
+
+Every counted keystroke is stamped at each stage of its way to the screen:
+
+    key     the Tk key event reaches the application
+    engine  the session has updated the count and notifies its listeners
+    label   the pollen frame and the "Ultimo" label have been updated
+    render  Tk is idle again, after redrawing the updated widgets
+
+The time elapsed from the key event to each later stage is recorded in a
+log-bucketed histogram, so recording costs a few integer operations and the
+memory used does not grow with the number of keystrokes.
+"""
+
+from array import array
+from datetime import datetime
+from time import perf_counter
+from typing import Dict, List, Optional, Tuple
+import json
+import logging
+import os
+
+
+custom_logger = logging.getLogger(name="pollen_logger")
+
+STAGES = ("engine", "label", "render")
+PERCENTILES = (50, 90, 99, 99.9)
+# Every power of two is split in 2**_SUB_BITS buckets (error below 7%)
+_SUB_BITS = 3
+_SUB_COUNT = 1 << _SUB_BITS
+# Enough buckets for latencies up to about one minute, in microseconds
+_N_BUCKETS = 27 * _SUB_COUNT
+
+
+def _bucket(us: int) -> int:
+    if us < 2 * _SUB_COUNT:
+        return us
+    shift = us.bit_length() - _SUB_BITS - 1
+    return min(shift * _SUB_COUNT + (us >> shift), _N_BUCKETS - 1)
+
+
+def _bucket_range(bucket: int) -> Tuple[int, int]:
+    """Lowest value and width of a bucket, in microseconds."""
+    if bucket < 2 * _SUB_COUNT:
+        return bucket, 1
+    shift = bucket // _SUB_COUNT - 1
+    return (bucket % _SUB_COUNT + _SUB_COUNT) << shift, 1 << shift
+
+
+class LatencyHistogram:
+    """Histogram of latencies with buckets of logarithmic width."""
+
+    def __init__(self) -> None:
+        self.buckets = array("q", bytes(8 * _N_BUCKETS))
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float) -> None:
+        self.buckets[_bucket(int(seconds * 1e6))] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p: float) -> Optional[float]:
+        """Approximate p-th percentile in seconds, None if empty."""
+        if self.count == 0:
+            return None
+        rank = p / 100 * self.count
+        seen = 0
+        for bucket, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                low, width = _bucket_range(bucket)
+                return min((low + width / 2) / 1e6, self.max)
+        return self.max
+
+    def summary(self) -> Dict[str, Optional[float]]:
+        data = {"count": self.count}
+        if self.count:
+            data["mean_ms"] = self.total / self.count * 1e3
+            data["max_ms"] = self.max * 1e3
+            for p in PERCENTILES:
+                data[f"p{p:g}_ms"] = self.percentile(p) * 1e3
+        return data
+
+
+class LatencyTracker:
+    """Latency histograms of the keystrokes of a counting session.
+    key_pressed starts a keystroke, stage closes one of its stages.
+    Keystrokes arriving before Tk gets idle are all closed by rendered.
+    """
+
+    def __init__(self) -> None:
+        self.started_at = datetime.now()
+        self.histograms = {stage: LatencyHistogram() for stage in STAGES}
+        self.current: Optional[float] = None
+        self.pending: List[float] = []
+
+    def key_pressed(self) -> None:
+        self.current = perf_counter()
+
+    def key_ignored(self) -> None:
+        self.current = None
+
+    def stage(self, name: str) -> None:
+        if self.current is not None:
+            self.histograms[name].record(perf_counter() - self.current)
+
+    def key_handled(self) -> bool:
+        """Close the current keystroke, waiting for the next render.
+        Returns True if a render callback must be scheduled.
+        """
+        if self.current is None:
+            return False
+        self.pending.append(self.current)
+        self.current = None
+        return len(self.pending) == 1
+
+    def labels_updated(self) -> None:
+        """Close the label stage of the keystrokes waiting for the render,
+        when the labels are refreshed in batches.
+        """
+        now = perf_counter()
+        record = self.histograms["label"].record
+        for start in self.pending:
+            record(now - start)
+
+    def rendered(self) -> None:
+        now = perf_counter()
+        record = self.histograms["render"].record
+        for start in self.pending:
+            record(now - start)
+        self.pending = []
+
+    def summary(self) -> Dict:
+        return {
+            "started_at": self.started_at.isoformat(timespec="seconds"),
+            "ended_at": datetime.now().isoformat(timespec="seconds"),
+            "stages": {
+                stage: histogram.summary()
+                for stage, histogram in self.histograms.items()
+            },
+        }
+
+    def dump(self, log_dir: str) -> Optional[str]:
+        """Write the percentiles of the session in log_dir.
+        Returns the path of the file, None if no keystroke was counted.
+        """
+        if self.histograms["engine"].count == 0:
+            return None
+        summary = self.summary()
+        path = os.path.join(
+            log_dir, f"latency_{self.started_at.strftime('%Y%m%dT%H%M%S')}.json"
+        )
+        with open(path, "w") as f:
+            json.dump(summary, f, indent=2)
+        custom_logger.info("Keystroke latency: %s", json.dumps(summary["stages"]))
+        return path
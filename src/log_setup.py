@@ -0,0 +1,98 @@
+import gzip
+import json
+import logging
+import os
+import queue
+import shutil
+import time
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from config import (
+    _LOG_BACKUP_COUNT,
+    _LOG_FILE,
+    _LOG_LEVEL,
+    _LOG_MAX_BYTES,
+    _LOG_ROTATE_S,
+)
+
+
+class JsonFormatter(logging.Formatter):
+    """Format each record as a single JSON object per line."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(
+                timespec="milliseconds"
+            ),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+
+class RotatingCompressedFileHandler(RotatingFileHandler):
+    """File handler rotating when the file exceeds max_bytes or is older
+    than rotate_s seconds. Rotated files are compressed with gzip.
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        max_bytes: int = _LOG_MAX_BYTES,
+        rotate_s: float = _LOG_ROTATE_S,
+        backup_count: int = _LOG_BACKUP_COUNT,
+    ) -> None:
+        super().__init__(
+            filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8"
+        )
+        self.rotate_s = rotate_s
+        self.opened_at = (
+            os.path.getmtime(filename) if os.path.exists(filename) else time.time()
+        )
+        self.namer = lambda name: f"{name}.gz"
+        self.rotator = self._compress
+
+    @staticmethod
+    def _compress(source: str, dest: str) -> None:
+        with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(source)
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if time.time() - self.opened_at >= self.rotate_s:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self) -> None:
+        super().doRollover()
+        self.opened_at = time.time()
+
+
+class _LazyQueueHandler(QueueHandler):
+    """Queue handler leaving the formatting of the message to the listener
+    thread: the thread emitting the record only pays for enqueuing it.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def setup_logging(log_dir: str, level: str = _LOG_LEVEL) -> QueueListener:
+    """Send the records of the pollen logger to a rotating file in log_dir
+    through a background thread. Stop the returned listener at exit to
+    flush the pending records.
+    """
+    level = os.getenv("POLLEN_LOG_LEVEL", level).upper()
+    file_handler = RotatingCompressedFileHandler(os.path.join(log_dir, _LOG_FILE))
+    file_handler.setFormatter(JsonFormatter())
+    records = queue.SimpleQueue()
+    listener = QueueListener(records, file_handler, respect_handler_level=True)
+    custom_logger = logging.getLogger(name="pollen_logger")
+    custom_logger.addHandler(_LazyQueueHandler(records))
+    custom_logger.setLevel(level)
+    listener.start()
+    return listener
@@ -1,13 +1,24 @@
-from datetime import datetime
-from app import Application
-from tkinter import ttk
-from config import _FONT, _FONT_SIZE_MAIN, _FONT_SIZE_HELP, _FONT_SIZE_FOOTER
+from config import _FONT, _FONT_SIZE_MAIN, _FONT_SIZE_HELP, _FONT_SIZE_FOOTER, _LOG_DIR
+from log_setup import setup_logging
 import logging
+import multiprocessing
 import os
 import platform
+import sys
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    # With arguments run the command line tools, without loading tkinter
+    if len(sys.argv) > 1:
+        from cli import main
+
+        logging.basicConfig(level=logging.WARNING)
+        sys.exit(main())
+
+    from app import Application
+    from tkinter import ttk
+
     # Create logs directory based on OS
     if "windows" in platform.system().lower():
         app_data_dir = os.getenv("LOCALAPPDATA") or "."
@@ -15,7 +26,7 @@ if __name__ == "__main__":
     else:
         app_data_dir = os.getenv("HOME") or "."
         pollen_dir = os.path.join(app_data_dir, ".pollen")
-    log_dir = os.path.join(pollen_dir, "logs")
+    log_dir = os.path.join(pollen_dir, _LOG_DIR)
     if not os.path.exists(pollen_dir):
         os.makedirs(pollen_dir)
         os.makedirs(log_dir)
@@ -23,16 +34,13 @@ if __name__ == "__main__":
         if not os.path.exists(log_dir):
             os.makedirs(log_dir)
 
+    # Records are written to a rotating file by a background thread
+    log_listener = setup_logging(log_dir)
     custom_logger = logging.getLogger(name="pollen_logger")
-    file_handler = logging.FileHandler(
-        filename=f"{log_dir}/log_{datetime.now().strftime('%Y%m%dT%H%M%S')}.log"
-    )
-    custom_logger.addHandler(file_handler)
-    custom_logger.setLevel(logging.DEBUG)
     custom_logger.info("Starting app")
 
     # Generate app
-    app = Application.start()
+    app = Application.start(pollen_dir)
 
     # Custom styles
     style = ttk.Style(app)
@@ -78,3 +86,5 @@ if __name__ == "__main__":
     )
     # Main event loop
     app.mainloop()
+    custom_logger.info("Closing app")
+    log_listener.stop()
@@ -0,0 +1,255 @@
+"""Reader and writer for the slide file format.
+
+A slide file is a semicolon separated file made of two sections:
+a metadata block (header and a single row of values) followed by
+the counts block, with a header and one row per pollen:
+
+    operatore;data;linee_vetrino;versione
+    Mario;01/04/2022;"1,2,3,4";2
+    nome;famiglia;conteggio
+    Betula;Betula;12
+    ...
+
+Files written before the format was versioned have no "versione"
+column and are read as version 1; their metadata block may be empty
+when no extra info was entered.
+
+A day file holds the counts of several slides in a single file, with the
+same metadata block and one row per pollen counted on each slide line:
+
+    vetrino;linea;nome;famiglia;conteggio
+    1;1;Betula;Betula;5
+    1;2;Betula;Betula;7
+    ...
+
+Files are written to a temporary file in the same directory, which then
+replaces the target, so a crash never leaves a half-written file.
+"""
+
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+import csv
+import logging
+import os
+
+
+custom_logger = logging.getLogger(name="pollen_logger")
+
+FORMAT_VERSION = 2
+VERSION_FIELD = "versione"
+METADATA_FIELDS = ("operatore", "data", "linee_vetrino")
+COUNT_FIELDS = ("nome", "famiglia", "conteggio")
+DAY_FIELDS = ("vetrino", "linea") + COUNT_FIELDS
+_DELIMITER = ";"
+
+
+class SlideFileError(ValueError):
+    """Raised when a slide file does not follow the expected layout."""
+
+    def __init__(self, name: str, line: int, message: str) -> None:
+        super().__init__(f"{name}, line {line}: {message}")
+        self.name = name
+        self.line = line
+        self.message = message
+
+    def __reduce__(self):
+        # Keep the error picklable, so it can cross process boundaries
+        return SlideFileError, (self.name, self.line, self.message)
+
+
+class Day(NamedTuple):
+    version: int
+    metadata: Dict[str, str]
+    # (vetrino, linea, nome, famiglia, conteggio) rows, in file order
+    counts: List[Tuple[int, int, str, str, int]]
+
+
+def iso_date(text: str) -> Optional[str]:
+    """Convert the "data" metadata (gg/mm/aaaa) to an ISO date,
+    None if missing or invalid.
+    """
+    try:
+        return datetime.strptime(text.strip(), "%d/%m/%Y").date().isoformat()
+    except (AttributeError, ValueError):
+        return None
+
+
+def _parse_metadata(reader, header: List[str], name: str) -> Dict[str, str]:
+    values = next(reader, None)
+    if values is None:
+        raise SlideFileError(name, reader.line_num, "missing metadata values")
+    if len(values) != len(header):
+        raise SlideFileError(
+            name,
+            reader.line_num,
+            f"expected {len(header)} metadata values, found {len(values)}",
+        )
+    return dict(zip(header, values))
+
+
+def _parse_header(reader, name: str) -> Tuple[int, Dict[str, str]]:
+    """Parse the metadata block, returning format version and metadata."""
+    header = next(reader, None)
+    if header is None:
+        raise SlideFileError(name, reader.line_num, "empty file")
+    if any(header):
+        metadata = _parse_metadata(reader, header, name)
+    else:
+        # Files saved without extra info have an empty metadata block
+        metadata = {}
+    version = metadata.pop(VERSION_FIELD, "1")
+    try:
+        version = int(version)
+    except ValueError:
+        raise SlideFileError(name, reader.line_num, f"invalid version {version!r}")
+    if version > FORMAT_VERSION:
+        raise SlideFileError(
+            name,
+            reader.line_num,
+            f"unsupported version {version}, the latest known is {FORMAT_VERSION}",
+        )
+    return version, metadata
+
+
+@contextmanager
+def _reading(reader, name: str):
+    """Raise the decoding and CSV errors met reading the lines of a file
+    as SlideFileError, so callers skip the file like any malformed one.
+    """
+    try:
+        yield
+    except UnicodeDecodeError as e:
+        # Lines are decoded in blocks: the error is on this line or a later one
+        raise SlideFileError(
+            name,
+            reader.line_num + 1,
+            f"not UTF-8 text from here on ({e.reason}), save the file as UTF-8",
+        ) from e
+    except csv.Error as e:
+        raise SlideFileError(name, reader.line_num, f"invalid CSV: {e}") from e
+
+
+def _parse_int(reader, name: str, value: str, what: str) -> int:
+    try:
+        return int(value)
+    except ValueError:
+        raise SlideFileError(name, reader.line_num, f"invalid {what} {value!r}")
+
+
+def parse_day(rows: Iterable[str], name: str = "<stream>") -> Day:
+    """Parse metadata and counts of a day file in a single pass over its
+    lines. Slide files are read as a day made of the first line of the
+    first slide.
+    """
+    reader = csv.reader(rows, delimiter=_DELIMITER)
+    with _reading(reader, name):
+        version, metadata = _parse_header(reader, name)
+        header = next(reader, None)
+        if header is None:
+            raise SlideFileError(name, reader.line_num, "missing counts header")
+        try:
+            i_nome, i_famiglia, i_conteggio = (header.index(f) for f in COUNT_FIELDS)
+        except ValueError:
+            raise SlideFileError(
+                name,
+                reader.line_num,
+                f"counts header must contain {', '.join(COUNT_FIELDS)}",
+            )
+        i_vetrino = header.index("vetrino") if "vetrino" in header else None
+        i_linea = header.index("linea") if "linea" in header else None
+        n_fields = len(header)
+        counts = []
+        append = counts.append
+        for row in reader:
+            if not row:
+                continue
+            if len(row) != n_fields:
+                raise SlideFileError(
+                    name,
+                    reader.line_num,
+                    f"expected {n_fields} fields, found {len(row)}",
+                )
+            vetrino = 1 if i_vetrino is None else row[i_vetrino]
+            linea = 1 if i_linea is None else row[i_linea]
+            append(
+                (
+                    _parse_int(reader, name, vetrino, "slide"),
+                    _parse_int(reader, name, linea, "line"),
+                    row[i_nome],
+                    row[i_famiglia],
+                    _parse_int(reader, name, row[i_conteggio], "count"),
+                )
+            )
+        return Day(version, metadata, counts)
+
+
+def read_day(path: str) -> Day:
+    try:
+        with open(path, "r", encoding="utf-8", newline="") as f:
+            return parse_day(f, path)
+    except SlideFileError:
+        raise
+    except ValueError as e:
+        # e.g. a path with a null character
+        raise SlideFileError(path, 0, f"unable to read the file: {e}") from e
+
+
+def _write_metadata(writer, metadata: Dict[str, str]) -> None:
+    header = list(METADATA_FIELDS) + [
+        k for k in metadata if k not in METADATA_FIELDS and k != VERSION_FIELD
+    ]
+    writer.writerow(header + [VERSION_FIELD])
+    writer.writerow([metadata.get(k, "") for k in header] + [FORMAT_VERSION])
+
+
+@contextmanager
+def atomic_write(path: str, binary: bool = False):
+    """Open a temporary file that atomically replaces path when closed."""
+    tmp_path = f"{path}.tmp"
+    try:
+        if binary:
+            f = open(tmp_path, "wb")
+        else:
+            f = open(tmp_path, "w", encoding="utf-8", newline="")
+        with f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_slide(
+    path: str,
+    metadata: Dict[str, str],
+    counts: Iterable[Tuple[str, str, int]],
+) -> None:
+    """Write a slide file in the latest format version.
+    counts are (nome, famiglia, conteggio) rows.
+    """
+    with atomic_write(path) as f:
+        writer = csv.writer(f, delimiter=_DELIMITER, lineterminator="\n")
+        _write_metadata(writer, metadata)
+        writer.writerow(COUNT_FIELDS)
+        writer.writerows(counts)
+    custom_logger.debug("Written slide file %s", path)
+
+
+def write_day(
+    path: str,
+    metadata: Dict[str, str],
+    counts: Iterable[Tuple[int, int, str, str, int]],
+) -> None:
+    """Write the counts of a whole day in a single file.
+    counts are (vetrino, linea, nome, famiglia, conteggio) rows.
+    """
+    with atomic_write(path) as f:
+        writer = csv.writer(f, delimiter=_DELIMITER, lineterminator="\n")
+        _write_metadata(writer, metadata)
+        writer.writerow(DAY_FIELDS)
+        writer.writerows(counts)
+    custom_logger.debug("Written day file %s", path)
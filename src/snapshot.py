@@ -0,0 +1,278 @@
+"""Binary snapshot format of a counting day.
+
+A snapshot holds the same data as a day file (metadata and the counts of
+every slide line) in a compact layout that can be memory-mapped and read
+without parsing. All integers are little-endian:
+
+    header      magic "POLLSNAP", version (u16), reserved (u16),
+                n_cells, n_taxa, n_metadata, n_strings, strings_size (u32),
+                padded to 40 bytes
+    conteggio   i64[n_cells]
+    vetrino     i32[n_cells]
+    linea       i32[n_cells]
+    taxon       u32[n_cells]        index in the taxa table
+    taxa        u32[2 * n_taxa]     (famiglia, nome) string ids
+    metadata    u32[2 * n_metadata] (key, value) string ids
+    offsets     u32[n_strings + 1]  start of every string in the blob
+    strings     UTF-8 blob, every distinct name stored once
+    crc         u32, CRC32 of all the preceding bytes
+
+Files are converted from and to day (or slide) files without losses:
+
+    python snapshot.py to-snapshot day.csv day.snap
+    python snapshot.py to-csv day.snap day.csv
+"""
+
+from array import array
+from typing import Dict, Iterable, List, Optional, Tuple
+import argparse
+import logging
+import mmap
+import struct
+import sys
+import zlib
+from slide_file import FORMAT_VERSION, Day, atomic_write, read_day, write_day
+
+
+custom_logger = logging.getLogger(name="pollen_logger")
+
+MAGIC = b"POLLSNAP"
+SNAPSHOT_VERSION = 1
+EXTENSION = ".snap"
+_HEADER = struct.Struct("<8sHHIIIII")
+_HEADER_SIZE = 40
+_CRC = struct.Struct("<I")
+
+
+class SnapshotError(ValueError):
+    """Raised when a file is not a valid snapshot."""
+
+
+def _little_endian(typecode: str, values: Iterable[int]) -> bytes:
+    data = array(typecode, values)
+    if sys.byteorder != "little":
+        data.byteswap()
+    return data.tobytes()
+
+
+def write_snapshot(
+    path: str,
+    metadata: Dict[str, str],
+    counts: Iterable[Tuple[int, int, str, str, int]],
+) -> None:
+    """Write (vetrino, linea, nome, famiglia, conteggio) rows as a snapshot,
+    replacing path atomically.
+    """
+    string_ids: Dict[str, int] = {}
+    taxon_ids: Dict[Tuple[int, int], int] = {}
+
+    def string_id(text: str) -> int:
+        return string_ids.setdefault(text, len(string_ids))
+
+    conteggi, vetrini, linee, taxa = [], [], [], []
+    for vetrino, linea, nome, famiglia, conteggio in counts:
+        taxon = (string_id(famiglia), string_id(nome))
+        vetrini.append(vetrino)
+        linee.append(linea)
+        taxa.append(taxon_ids.setdefault(taxon, len(taxon_ids)))
+        conteggi.append(conteggio)
+    meta = [string_id(str(text)) for item in metadata.items() for text in item]
+    blobs = [text.encode("utf-8") for text in string_ids]
+    offsets = [0]
+    for blob in blobs:
+        offsets.append(offsets[-1] + len(blob))
+    header = _HEADER.pack(
+        MAGIC,
+        SNAPSHOT_VERSION,
+        0,
+        len(conteggi),
+        len(taxon_ids),
+        len(metadata),
+        len(string_ids),
+        offsets[-1],
+    ).ljust(_HEADER_SIZE, b"\0")
+    sections = [
+        header,
+        _little_endian("q", conteggi),
+        _little_endian("i", vetrini),
+        _little_endian("i", linee),
+        _little_endian("I", taxa),
+        _little_endian("I", (i for taxon in taxon_ids for i in taxon)),
+        _little_endian("I", meta),
+        _little_endian("I", offsets),
+        b"".join(blobs),
+    ]
+    crc = 0
+    for section in sections:
+        crc = zlib.crc32(section, crc)
+    with atomic_write(path, binary=True) as f:
+        f.writelines(sections)
+        f.write(_CRC.pack(crc))
+    custom_logger.debug("Written snapshot %s", path)
+
+
+class Snapshot:
+    """Memory-mapped snapshot.
+    The count arrays are views on the file, read only when accessed:
+    opening a snapshot only reads its header, checks the CRC and
+    decodes the string table.
+    """
+
+    def __init__(self, path: str, verify: bool = True) -> None:
+        self.path = path
+        with open(path, "rb") as f:
+            try:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError as e:
+                # Empty files cannot be mapped
+                raise SnapshotError(f"{path} is not a valid snapshot.") from e
+        try:
+            self._open(verify)
+        except Exception:
+            self.close()
+            raise
+
+    def _open(self, verify: bool) -> None:
+        data = self._map
+        size = len(data)
+        if size < _HEADER_SIZE + _CRC.size or data[:8] != MAGIC:
+            raise SnapshotError(f"{self.path} is not a valid snapshot.")
+        (
+            _,
+            self.version,
+            _,
+            n_cells,
+            n_taxa,
+            n_metadata,
+            n_strings,
+            strings_size,
+        ) = _HEADER.unpack_from(data)
+        if self.version > SNAPSHOT_VERSION:
+            raise SnapshotError(
+                f"{self.path} has version {self.version}, "
+                f"newer than the supported {SNAPSHOT_VERSION}."
+            )
+        expected = (
+            _HEADER_SIZE
+            + 20 * n_cells
+            + 8 * n_taxa
+            + 8 * n_metadata
+            + 4 * (n_strings + 1)
+            + strings_size
+            + _CRC.size
+        )
+        if size != expected:
+            raise SnapshotError(
+                f"{self.path} is truncated or corrupted: "
+                f"{size} bytes instead of {expected}."
+            )
+        view = memoryview(data)
+        self._views = [view]
+        if verify:
+            body = view[: size - _CRC.size]
+            self._views.append(body)
+            if zlib.crc32(body) != _CRC.unpack_from(data, size - _CRC.size)[0]:
+                raise SnapshotError(f"{self.path} is corrupted: wrong checksum.")
+        self.n_cells = n_cells
+        offset = _HEADER_SIZE
+        self.conteggi, offset = self._array(view, offset, "q", n_cells)
+        self.vetrini, offset = self._array(view, offset, "i", n_cells)
+        self.linee, offset = self._array(view, offset, "i", n_cells)
+        self.taxon_ids, offset = self._array(view, offset, "I", n_cells)
+        taxa, offset = self._array(view, offset, "I", 2 * n_taxa)
+        meta, offset = self._array(view, offset, "I", 2 * n_metadata)
+        offsets, offset = self._array(view, offset, "I", n_strings + 1)
+        blob = bytes(view[offset : offset + strings_size])
+        strings = [
+            blob[offsets[i] : offsets[i + 1]].decode("utf-8") for i in range(n_strings)
+        ]
+        # (famiglia, nome) of every taxon id
+        self.taxa: List[Tuple[str, str]] = [
+            (strings[taxa[i]], strings[taxa[i + 1]]) for i in range(0, len(taxa), 2)
+        ]
+        self.metadata: Dict[str, str] = {
+            strings[meta[i]]: strings[meta[i + 1]] for i in range(0, len(meta), 2)
+        }
+
+    def _array(self, view: memoryview, offset: int, typecode: str, n: int):
+        end = offset + n * array(typecode).itemsize
+        if sys.byteorder == "little":
+            values = view[offset:end].cast(typecode)
+            self._views.append(values)
+        else:
+            values = array(typecode, view[offset:end])
+            values.byteswap()
+        return values, end
+
+    def __len__(self) -> int:
+        return self.n_cells
+
+    def __enter__(self) -> "Snapshot":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        # Views on the map must be released before closing it
+        for view in reversed(getattr(self, "_views", [])):
+            view.release()
+        self._views = []
+        self._map.close()
+
+    def totals(self) -> Dict[Tuple[str, str], int]:
+        """Total count of every taxon, summed over slides and lines."""
+        sums = [0] * len(self.taxa)
+        for taxon, conteggio in zip(self.taxon_ids, self.conteggi):
+            sums[taxon] += conteggio
+        return dict(zip(self.taxa, sums))
+
+    def rows(self) -> List[Tuple[int, int, str, str, int]]:
+        """(vetrino, linea, nome, famiglia, conteggio) rows, in file order."""
+        taxa = self.taxa
+        return [
+            (vetrino, linea, taxa[taxon][1], taxa[taxon][0], conteggio)
+            for vetrino, linea, taxon, conteggio in zip(
+                self.vetrini, self.linee, self.taxon_ids, self.conteggi
+            )
+        ]
+
+    def day(self) -> Day:
+        return Day(FORMAT_VERSION, dict(self.metadata), self.rows())
+
+
+def read_snapshot(path: str) -> Day:
+    with Snapshot(path) as snapshot:
+        return snapshot.day()
+
+
+def to_snapshot(source: str, target: str) -> int:
+    """Convert a day or slide file to a snapshot, returning the rows."""
+    day = read_day(source)
+    write_snapshot(target, day.metadata, day.counts)
+    return len(day.counts)
+
+
+def to_csv(source: str, target: str) -> int:
+    """Convert a snapshot to a day file, returning the rows."""
+    day = read_snapshot(source)
+    write_day(target, day.metadata, day.counts)
+    return len(day.counts)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Convert between day files and binary snapshots."
+    )
+    parser.add_argument("direction", choices=("to-snapshot", "to-csv"))
+    parser.add_argument("source")
+    parser.add_argument("target")
+    args = parser.parse_args(argv)
+    convert = to_snapshot if args.direction == "to-snapshot" else to_csv
+    n = convert(args.source, args.target)
+    print(f"Converted {n} rows to {args.target}.")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,563 @@
+"""Optional SQLite store of the saved counts.
+
+Every saved slide (or day) is stored as a record, identified by its name,
+with its metadata and one row per pollen counted on each slide line:
+
+    records(id, name, data, operatore, linee_vetrino, metadata, saved_at,
+            sessione)
+    counts(record_id, vetrino, linea, famiglia, nome, conteggio)
+
+Totals by taxon are materialized per day, ISO week and season (calendar
+year), along with the peak day and the start and end of the season, i.e.
+the days when 5% and 95% of the season total is reached:
+
+    daily_totals(data, famiglia, nome, conteggio)
+    weekly_totals(settimana, famiglia, nome, conteggio, giorni)
+    season_totals(stagione, famiglia, nome, conteggio, picco_data,
+                  picco_conteggio, inizio, fine)
+
+They are updated in the same transaction as every save or import, and only
+for the days, weeks and seasons of the records that changed. Records saved
+by the app carry the id of its counting session: a slide saved more than
+once in a session, by itself ("Salva file") and within its day ("Salva
+giornata"), is counted once, from the record saved last. Records of other
+sessions and imported files are always counted.
+
+The database runs in WAL mode, so the app can keep writing while reports
+read it, and it is indexed on date, operator and taxon, so historical
+queries do not need to scan every file. Existing slide and day files can be
+imported in bulk, their names matched to configuration.json as when loading
+them in the app:
+
+    python store.py import counts.db <slides directory> --config configuration.json
+    python store.py query counts.db --nome Betula --operatore Mario \\
+        --from 2022-04-01 --to 2022-04-30
+    python store.py season counts.db 2022
+"""
+
+from datetime import date, datetime, timedelta
+from itertools import groupby
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+import argparse
+import json
+import logging
+import os
+import sqlite3
+from catalog import Catalog, MatchReport
+from config import _CONFIG_PATH
+from configuration import load_configuration
+from slide_file import SlideFileError, iso_date, read_day
+
+
+custom_logger = logging.getLogger(name="pollen_logger")
+
+SCHEMA_VERSION = 4
+# Fractions of the season total marking the start and the end of the season
+SEASON_START = 0.05
+SEASON_END = 0.95
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    data TEXT,
+    operatore TEXT NOT NULL DEFAULT '',
+    linee_vetrino TEXT NOT NULL DEFAULT '',
+    metadata TEXT NOT NULL DEFAULT '{}',
+    saved_at TEXT NOT NULL,
+    sessione TEXT NOT NULL DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS counts (
+    record_id INTEGER NOT NULL REFERENCES records(id) ON DELETE CASCADE,
+    vetrino INTEGER NOT NULL,
+    linea INTEGER NOT NULL,
+    famiglia TEXT NOT NULL,
+    nome TEXT NOT NULL,
+    conteggio INTEGER NOT NULL,
+    PRIMARY KEY (record_id, vetrino, linea, famiglia, nome)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS records_data ON records(data);
+CREATE INDEX IF NOT EXISTS records_operatore ON records(operatore, data);
+CREATE INDEX IF NOT EXISTS records_saved_at ON records(saved_at);
+CREATE INDEX IF NOT EXISTS counts_taxon ON counts(nome, famiglia, record_id);
+CREATE INDEX IF NOT EXISTS counts_famiglia ON counts(famiglia, record_id);
+CREATE TABLE IF NOT EXISTS daily_totals (
+    data TEXT NOT NULL,
+    famiglia TEXT NOT NULL,
+    nome TEXT NOT NULL,
+    conteggio INTEGER NOT NULL,
+    PRIMARY KEY (data, famiglia, nome)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS weekly_totals (
+    settimana TEXT NOT NULL,
+    famiglia TEXT NOT NULL,
+    nome TEXT NOT NULL,
+    conteggio INTEGER NOT NULL,
+    giorni INTEGER NOT NULL,
+    PRIMARY KEY (settimana, famiglia, nome)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS season_totals (
+    stagione INTEGER NOT NULL,
+    famiglia TEXT NOT NULL,
+    nome TEXT NOT NULL,
+    conteggio INTEGER NOT NULL,
+    picco_data TEXT,
+    picco_conteggio INTEGER,
+    inizio TEXT,
+    fine TEXT,
+    PRIMARY KEY (stagione, famiglia, nome)
+) WITHOUT ROWID;
+"""
+
+
+def _current_counts(where: str) -> str:
+    """Query of the counts of the records matching where, keeping for each
+    slide saved more than once by the same session only the lines of the
+    last saved record. Records without a session are all kept.
+    """
+    return (
+        "WITH slides AS (SELECT r.id, c.vetrino, ROW_NUMBER() OVER ("
+        "PARTITION BY r.data, COALESCE(NULLIF(r.sessione, ''), r.id), c.vetrino "
+        "ORDER BY r.saved_at DESC, r.id DESC) AS n "
+        "FROM records r JOIN counts c ON c.record_id = r.id "
+        f"WHERE {where} GROUP BY r.id, c.vetrino) "
+        "SELECT r.id, r.data, r.name, r.linee_vetrino, c.vetrino, c.famiglia, "
+        "c.nome, c.conteggio FROM slides s "
+        "JOIN records r ON r.id = s.id "
+        "JOIN counts c ON c.record_id = s.id AND c.vetrino = s.vetrino "
+        "WHERE s.n = 1"
+    )
+
+
+class StoreError(RuntimeError):
+    pass
+
+
+class Record(NamedTuple):
+    name: str
+    metadata: Dict[str, str]
+    # (vetrino, linea, nome, famiglia, conteggio) rows
+    counts: List[Tuple[int, int, str, str, int]]
+
+
+def _canonical(
+    catalog: Catalog,
+    counts: Iterable[Tuple[int, int, str, str, int]],
+    matches: MatchReport,
+) -> List[Tuple[int, int, str, str, int]]:
+    """Rows with the names matched in catalog replaced by the configured ones."""
+    rows = []
+    for vetrino, linea, nome, famiglia, conteggio in counts:
+        nome, famiglia = nome.strip(), famiglia.strip()
+        match = catalog.resolve(famiglia, nome)
+        matches.add(famiglia, nome, match)
+        if match is not None:
+            nome, famiglia = match.nome, match.famiglia
+        rows.append((vetrino, linea, nome, famiglia, conteggio))
+    return rows
+
+
+class Store:
+    """SQLite database of saved slides and days."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        try:
+            # The app opens the store on the Tk thread and saves and loads
+            # the records on the single worker thread of its tasks
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute("PRAGMA foreign_keys=ON")
+            version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+            if version > SCHEMA_VERSION:
+                raise StoreError(
+                    f"{path} has schema version {version}, "
+                    f"the latest known is {SCHEMA_VERSION}"
+                )
+            with self.connection:
+                self.connection.executescript(_SCHEMA)
+                columns = {
+                    row[1]
+                    for row in self.connection.execute("PRAGMA table_info(records)")
+                }
+                if "sessione" not in columns:
+                    self.connection.execute(
+                        "ALTER TABLE records "
+                        "ADD COLUMN sessione TEXT NOT NULL DEFAULT ''"
+                    )
+                if version < SCHEMA_VERSION:
+                    # Databases created before the rollups get them built
+                    self._rebuild_rollups()
+                self.connection.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+        except sqlite3.Error as e:
+            raise StoreError(f"Unable to open the database {path}: {e}") from e
+        custom_logger.info(f"Opened database {path}.")
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def _save(
+        self,
+        name: str,
+        metadata: Dict[str, str],
+        counts: Iterable[Tuple[int, int, str, str, int]],
+        session: str = "",
+    ) -> Set[str]:
+        """Write a record, returning the dates whose totals changed."""
+        dates = {iso_date(metadata.get("data", ""))}
+        old = self.connection.execute(
+            "SELECT data FROM records WHERE name = ?", (name,)
+        ).fetchone()
+        if old is not None:
+            dates.add(old[0])
+        self.connection.execute(
+            "INSERT INTO records "
+            "(name, data, operatore, linee_vetrino, metadata, saved_at, sessione) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET data=excluded.data, "
+            "operatore=excluded.operatore, linee_vetrino=excluded.linee_vetrino, "
+            "metadata=excluded.metadata, saved_at=excluded.saved_at, "
+            "sessione=excluded.sessione",
+            (
+                name,
+                iso_date(metadata.get("data", "")),
+                metadata.get("operatore", "").strip(),
+                metadata.get("linee_vetrino", ""),
+                json.dumps(metadata),
+                datetime.now().isoformat(timespec="seconds"),
+                session,
+            ),
+        )
+        record_id = self.connection.execute(
+            "SELECT id FROM records WHERE name = ?", (name,)
+        ).fetchone()[0]
+        self.connection.execute("DELETE FROM counts WHERE record_id = ?", (record_id,))
+        # Rows repeated on the same line are summed
+        self.connection.executemany(
+            "INSERT INTO counts VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(record_id, vetrino, linea, famiglia, nome) "
+            "DO UPDATE SET conteggio = conteggio + excluded.conteggio",
+            (
+                (record_id, vetrino, linea, famiglia.strip(), nome.strip(), conteggio)
+                for vetrino, linea, nome, famiglia, conteggio in counts
+            ),
+        )
+        dates.discard(None)
+        return dates
+
+    def _refresh_day(self, day: str) -> None:
+        self.connection.execute("DELETE FROM daily_totals WHERE data = ?", (day,))
+        self.connection.execute(
+            "INSERT INTO daily_totals "
+            "SELECT data, famiglia, nome, SUM(conteggio) "
+            f"FROM ({_current_counts('r.data = ?')}) GROUP BY famiglia, nome",
+            (day,),
+        )
+
+    def _refresh_week(self, year: int, week: int) -> None:
+        label = f"{year}-W{week:02d}"
+        monday = date.fromisocalendar(year, week, 1)
+        self.connection.execute(
+            "DELETE FROM weekly_totals WHERE settimana = ?", (label,)
+        )
+        self.connection.execute(
+            "INSERT INTO weekly_totals "
+            "SELECT ?, famiglia, nome, SUM(conteggio), COUNT(*) FROM daily_totals "
+            "WHERE data BETWEEN ? AND ? GROUP BY famiglia, nome",
+            (label, monday.isoformat(), (monday + timedelta(days=6)).isoformat()),
+        )
+
+    def _refresh_season(self, year: int) -> None:
+        self.connection.execute("DELETE FROM season_totals WHERE stagione = ?", (year,))
+        days = self.connection.execute(
+            "SELECT famiglia, nome, data, conteggio FROM daily_totals "
+            "WHERE data BETWEEN ? AND ? ORDER BY famiglia, nome, data",
+            (f"{year}-01-01", f"{year}-12-31"),
+        )
+        rows = []
+        for (famiglia, nome), taxon_days in groupby(days, key=lambda r: r[:2]):
+            taxon_days = [(data, conteggio) for _, _, data, conteggio in taxon_days]
+            total = sum(conteggio for _, conteggio in taxon_days)
+            peak = start = end = None
+            if total > 0:
+                peak = max(taxon_days, key=lambda d: d[1])
+                cumulative = 0
+                for data, conteggio in taxon_days:
+                    cumulative += conteggio
+                    if start is None and cumulative >= SEASON_START * total:
+                        start = data
+                    if cumulative >= SEASON_END * total:
+                        end = data
+                        break
+            rows.append(
+                (
+                    year,
+                    famiglia,
+                    nome,
+                    total,
+                    peak and peak[0],
+                    peak and peak[1],
+                    start,
+                    end,
+                )
+            )
+        self.connection.executemany(
+            "INSERT INTO season_totals VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows
+        )
+
+    def _refresh_rollups(self, dates: Iterable[str]) -> None:
+        """Recompute the totals of the days, weeks and seasons of dates."""
+        dates = sorted(set(dates))
+        for day in dates:
+            self._refresh_day(day)
+        weeks = {date.fromisoformat(day).isocalendar()[:2] for day in dates}
+        for year, week in sorted(weeks):
+            self._refresh_week(year, week)
+        for year in sorted({int(day[:4]) for day in dates}):
+            self._refresh_season(year)
+
+    def _rebuild_rollups(self) -> None:
+        for table in ("daily_totals", "weekly_totals", "season_totals"):
+            self.connection.execute(f"DELETE FROM {table}")
+        self._refresh_rollups(
+            row[0]
+            for row in self.connection.execute(
+                "SELECT DISTINCT data FROM records WHERE data IS NOT NULL"
+            )
+        )
+
+    def rebuild_rollups(self) -> None:
+        """Recompute all the totals from the stored counts."""
+        with self.connection:
+            self._rebuild_rollups()
+
+    def save(
+        self,
+        name: str,
+        metadata: Dict[str, str],
+        counts: Iterable[Tuple[int, int, str, str, int]],
+        session: str = "",
+    ) -> None:
+        """Store a record, replacing the one with the same name.
+        counts are (vetrino, linea, nome, famiglia, conteggio) rows, session
+        the id of the counting session that saved them, if any.
+        """
+        try:
+            with self.connection:
+                self._refresh_rollups(self._save(name, metadata, counts, session))
+        except sqlite3.Error as e:
+            raise StoreError(f"Unable to save {name} to {self.path}: {e}") from e
+        custom_logger.info(f"Saved {name} to database {self.path}.")
+
+    def load(self, name: str) -> Record:
+        row = self.connection.execute(
+            "SELECT id, metadata FROM records WHERE name = ?", (name,)
+        ).fetchone()
+        if row is None:
+            raise StoreError(f"{name} not found in database {self.path}")
+        counts = self.connection.execute(
+            "SELECT vetrino, linea, nome, famiglia, conteggio FROM counts "
+            "WHERE record_id = ? ORDER BY vetrino, linea",
+            (row[0],),
+        ).fetchall()
+        return Record(name, json.loads(row[1]), counts)
+
+    def recent(self, limit: int = 20) -> List[str]:
+        """Names of the last saved records, most recent first."""
+        return [
+            row[0]
+            for row in self.connection.execute(
+                "SELECT name FROM records ORDER BY saved_at DESC, id DESC LIMIT ?",
+                (limit,),
+            )
+        ]
+
+    def import_files(
+        self, paths: Iterable[Tuple[str, str]], catalog: Optional[Catalog] = None
+    ) -> Dict[str, List[str]]:
+        """Store (name, path) slide or day files in a single transaction.
+        Names found in catalog are stored as configured, the others as found.
+        Returns the names of the imported and failed files, and the names
+        remapped to the configuration or not found in it.
+        """
+        report = {"imported": [], "failed": []}
+        matches = MatchReport()
+        dates = set()
+        with self.connection:
+            for name, path in paths:
+                try:
+                    day = read_day(path)
+                except (OSError, SlideFileError) as e:
+                    custom_logger.error(f"Unable to import {path}: {e}")
+                    report["failed"].append(name)
+                    continue
+                counts = day.counts
+                if catalog is not None:
+                    counts = _canonical(catalog, counts, matches)
+                dates.update(self._save(name, day.metadata, counts))
+                report["imported"].append(name)
+            # Totals are refreshed once for the whole import
+            self._refresh_rollups(dates)
+        custom_logger.info(
+            f"Imported {len(report['imported'])} files into {self.path}."
+        )
+        report["names"] = matches.lines()
+        return report
+
+    def import_directory(
+        self, directory: str, catalog: Optional[Catalog] = None
+    ) -> Dict[str, List[str]]:
+        """Import every CSV file found under directory, named by its path
+        relative to directory.
+        """
+        paths = []
+        for root, _, names in os.walk(directory):
+            for name in sorted(names):
+                if name.lower().endswith(".csv"):
+                    path = os.path.join(root, name)
+                    relpath = os.path.relpath(path, directory).replace(os.sep, "/")
+                    paths.append((relpath, path))
+        return self.import_files(paths, catalog)
+
+    def query(
+        self,
+        nome: Optional[str] = None,
+        famiglia: Optional[str] = None,
+        operatore: Optional[str] = None,
+        date_from: Optional[str] = None,
+        date_to: Optional[str] = None,
+    ) -> List[Tuple[str, str, str, str, str, int]]:
+        """Total count of every pollen in each record matching the filters,
+        as (data, operatore, name, famiglia, nome, conteggio) rows.
+        Dates are ISO dates, both ends included.
+        """
+        where = []
+        args = []
+        for clause, value in (
+            ("c.nome = ?", nome),
+            ("c.famiglia = ?", famiglia),
+            ("r.operatore = ?", operatore),
+            ("r.data >= ?", date_from),
+            ("r.data <= ?", date_to),
+        ):
+            if value is not None:
+                where.append(clause)
+                args.append(value)
+        sql = (
+            "SELECT r.data, r.operatore, r.name, c.famiglia, c.nome, "
+            "SUM(c.conteggio) FROM records r JOIN counts c ON c.record_id = r.id"
+        )
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " GROUP BY r.id, c.famiglia, c.nome ORDER BY r.data, r.name"
+        return self.connection.execute(sql, args).fetchall()
+
+    def slide_counts(
+        self, date_from: Optional[str] = None, date_to: Optional[str] = None
+    ) -> List[Tuple[str, str, int, str, str, str, int]]:
+        """Counts of every dated slide, summed over its lines, as
+        (data, name, vetrino, linee_vetrino, famiglia, nome, conteggio) rows.
+        Slides saved more than once by a session are read from the last record.
+        """
+        where = ["r.data IS NOT NULL"]
+        args = []
+        if date_from is not None:
+            where.append("r.data >= ?")
+            args.append(date_from)
+        if date_to is not None:
+            where.append("r.data <= ?")
+            args.append(date_to)
+        return self.connection.execute(
+            "SELECT data, name, vetrino, linee_vetrino, famiglia, nome, "
+            f"SUM(conteggio) FROM ({_current_counts(' AND '.join(where))}) "
+            "GROUP BY id, vetrino, famiglia, nome",
+            args,
+        ).fetchall()
+
+    def daily_totals(
+        self, date_from: Optional[str] = None, date_to: Optional[str] = None
+    ) -> List[Tuple[str, str, str, int]]:
+        """(data, famiglia, nome, conteggio) totals, both dates included."""
+        return self.connection.execute(
+            "SELECT data, famiglia, nome, conteggio FROM daily_totals "
+            "WHERE data BETWEEN ? AND ? ORDER BY data, famiglia, nome",
+            (date_from or "0000-00-00", date_to or "9999-99-99"),
+        ).fetchall()
+
+    def weekly_totals(self, year: int) -> List[Tuple[str, str, str, int, int]]:
+        """(settimana, famiglia, nome, conteggio, giorni) totals of the ISO
+        weeks of year.
+        """
+        return self.connection.execute(
+            "SELECT settimana, famiglia, nome, conteggio, giorni FROM weekly_totals "
+            "WHERE settimana LIKE ? ORDER BY settimana, famiglia, nome",
+            (f"{year}-W%",),
+        ).fetchall()
+
+    def season_summary(self, year: int) -> List[Tuple]:
+        """(famiglia, nome, conteggio, picco_data, picco_conteggio, inizio,
+        fine) of every taxon counted in the season of year.
+        """
+        return self.connection.execute(
+            "SELECT famiglia, nome, conteggio, picco_data, picco_conteggio, "
+            "inizio, fine FROM season_totals WHERE stagione = ? "
+            "ORDER BY famiglia, nome",
+            (year,),
+        ).fetchall()
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Manage the database of counts.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    parser_import = subparsers.add_parser("import", help="Import slide files")
+    parser_import.add_argument("database", help="Database file")
+    parser_import.add_argument("source", help="Directory containing the CSV files")
+    parser_import.add_argument(
+        "--config", default=_CONFIG_PATH, help="Configuration file"
+    )
+    parser_query = subparsers.add_parser("query", help="Query the stored counts")
+    parser_query.add_argument("database", help="Database file")
+    parser_query.add_argument("--nome", default=None)
+    parser_query.add_argument("--famiglia", default=None)
+    parser_query.add_argument("--operatore", default=None)
+    parser_query.add_argument("--from", dest="date_from", default=None)
+    parser_query.add_argument("--to", dest="date_to", default=None)
+    parser_season = subparsers.add_parser("season", help="Show a season summary")
+    parser_season.add_argument("database", help="Database file")
+    parser_season.add_argument("year", type=int)
+    parser_rollups = subparsers.add_parser(
+        "rollups", help="Rebuild the daily, weekly and season totals"
+    )
+    parser_rollups.add_argument("database", help="Database file")
+    args = parser.parse_args(argv)
+    store = Store(args.database)
+    try:
+        if args.command == "import":
+            catalog = load_configuration(args.config).catalog
+            report = store.import_directory(args.source, catalog)
+            print(
+                f"Imported {len(report['imported'])} files, "
+                f"failed {len(report['failed'])}."
+            )
+            for name in report["failed"]:
+                print(f"Failed: {name}")
+            for line in report["names"]:
+                print(f"Names: {line}")
+        elif args.command == "season":
+            print("famiglia;nome;conteggio;picco_data;picco_conteggio;inizio;fine")
+            for row in store.season_summary(args.year):
+                print(";".join("" if v is None else str(v) for v in row))
+        elif args.command == "rollups":
+            store.rebuild_rollups()
+        else:
+            for row in store.query(
+                args.nome, args.famiglia, args.operatore, args.date_from, args.date_to
+            ):
+                print(";".join(str(v) for v in row))
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,102 @@
+"""Background tasks of the Tk app.
+
+File reads and writes run on a worker thread, so that counting keeps
+working while a slow disk or network share is busy. Tk is not thread
+safe: the worker never touches the widgets, and the Tk thread polls the
+task with after, getting its progress and, once finished, its result.
+Tasks run one at a time, in the order in which they were started.
+"""
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, Optional, TypeVar
+from config import _TASK_POLL_MS
+import logging
+import threading
+
+
+custom_logger = logging.getLogger(name="pollen_logger")
+T = TypeVar("T")
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _submit(work: Callable[..., Any], *args) -> Future:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="io")
+    return _executor.submit(work, *args)
+
+
+def wait_for_tasks() -> None:
+    """Wait for the started tasks to finish."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+
+class TaskCancelled(Exception):
+    pass
+
+
+class Task:
+    """Run work(task) on the worker thread.
+    on_done(result) or on_error(exception) are then called on the Tk
+    thread, and on_progress(done, total) while the task runs, total being
+    None when unknown. The work checks for cancellation through check
+    or track, raising TaskCancelled.
+    """
+
+    def __init__(
+        self,
+        master,
+        work: Callable[["Task"], T],
+        on_done: Callable[[T], None],
+        on_error: Callable[[BaseException], None],
+        on_progress: Optional[Callable[[int, Optional[int]], None]] = None,
+        poll_ms: int = _TASK_POLL_MS,
+    ) -> None:
+        self.master = master
+        self.on_done = on_done
+        self.on_error = on_error
+        self.on_progress = on_progress
+        self.poll_ms = poll_ms
+        # Written by the worker, read by the Tk thread
+        self.done = 0
+        self.total: Optional[int] = None
+        self._cancel = threading.Event()
+        self.future = _submit(work, self)
+        self.master.after(self.poll_ms, self._poll)
+
+    @property
+    def running(self) -> bool:
+        return not self.future.done()
+
+    def cancel(self) -> None:
+        self._cancel.set()
+
+    def check(self) -> None:
+        if self._cancel.is_set():
+            raise TaskCancelled()
+
+    def track(self, items: Iterable[T], total: Optional[int] = None) -> Iterator[T]:
+        """Iterate over items counting the progress, until cancelled."""
+        self.total = total
+        is_set = self._cancel.is_set
+        for item in items:
+            if is_set():
+                raise TaskCancelled()
+            self.done += 1
+            yield item
+
+    def _poll(self) -> None:
+        if not self.future.done():
+            if self.on_progress is not None:
+                self.on_progress(self.done, self.total)
+            self.master.after(self.poll_ms, self._poll)
+            return
+        error = self.future.exception()
+        if error is not None:
+            self.on_error(error)
+        else:
+            self.on_done(self.future.result())
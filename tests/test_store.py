@@ -0,0 +1,52 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "src"))
+
+from slide_file import write_slide  # noqa: E402
+from store import Store  # noqa: E402
+
+
+def _slide(directory, name, operatore, conteggio):
+    path = os.path.join(directory, name)
+    metadata = {"operatore": operatore, "data": "01/04/2022", "linee_vetrino": ""}
+    write_slide(path, metadata, [("Betula", "Betulaceae", conteggio)])
+    return name, path
+
+
+def test_files_of_the_same_date_are_all_counted(tmp_path):
+    store = Store(str(tmp_path / "counts.db"))
+    try:
+        report = store.import_files(
+            [
+                _slide(str(tmp_path), "a.csv", "Mario", 10),
+                _slide(str(tmp_path), "b.csv", "Luigi", 7),
+            ]
+        )
+        assert report["imported"] == ["a.csv", "b.csv"]
+        assert store.daily_totals() == [("2022-04-01", "Betulaceae", "Betula", 17)]
+        assert sorted(row[1] for row in store.slide_counts()) == ["a.csv", "b.csv"]
+    finally:
+        store.close()
+
+
+def test_slide_saved_again_in_the_day_of_its_session_is_counted_once(tmp_path):
+    store = Store(str(tmp_path / "counts.db"))
+    metadata = {"operatore": "Mario", "data": "01/04/2022"}
+    try:
+        store.save("slide.csv", metadata, [(1, 1, "Betula", "Betulaceae", 5)], "s1")
+        store.save(
+            "day.csv",
+            metadata,
+            [(1, 1, "Betula", "Betulaceae", 6), (2, 1, "Betula", "Betulaceae", 3)],
+            "s1",
+        )
+        store.save("other.csv", metadata, [(1, 1, "Betula", "Betulaceae", 2)], "s2")
+        assert store.daily_totals() == [("2022-04-01", "Betulaceae", "Betula", 11)]
+        assert sorted(row[1:3] for row in store.slide_counts()) == [
+            ("day.csv", 1),
+            ("day.csv", 2),
+            ("other.csv", 1),
+        ]
+    finally:
+        store.close()